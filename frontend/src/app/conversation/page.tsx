@@ -6,6 +6,14 @@ import Image from 'next/image';
 import { Button } from '@/components/ui/button';
 import { Mic, MicOff, Send, StopCircle, Clock, Circle } from 'lucide-react';
 import toast from 'react-hot-toast';
+import {
+  CONVERSATION_API,
+  CONVERSATION_WS,
+  openConversationSocket,
+  sendSocketMessage,
+  startBackendConversation,
+  streamMessage,
+} from '@/utils/conversationStream';
 
 // 模擬語音識別服務
 declare global {
@@ -37,6 +45,11 @@ export default function ConversationPage() {
   const [isBrowserSupported, setIsBrowserSupported] = useState(true);
   const [isSecureContext, setIsSecureContext] = useState(true);
   
+  // 後端對話ID（設定了 NEXT_PUBLIC_CONVERSATION_API 時使用串流回覆）
+  const backendConversationRef = useRef<number | null>(null);
+  // 對話 WebSocket（設定了 NEXT_PUBLIC_CONVERSATION_WS 時，語音識別的每句話都走這條連線）
+  const socketRef = useRef<WebSocket | null>(null);
+  const socketReplyStartedRef = useRef(false);
   const recognitionRef = useRef<any>(null);
   const messagesEndRef = useRef<HTMLDivElement>(null);
 
@@ -222,6 +235,29 @@ export default function ConversationPage() {
       }
     }
     
+    // 在後端建立對話，失敗時退回本地模擬回覆
+    if (CONVERSATION_API) {
+      try {
+        backendConversationRef.current = await startBackendConversation();
+        if (CONVERSATION_WS) {
+          socketRef.current = await openConversationSocket(backendConversationRef.current, {
+            onDelta: appendReplyChunk,
+            onReply: () => {
+              socketReplyStartedRef.current = false;
+              setIsLoading(false);
+            },
+            onError: (error) => {
+              console.error('對話通道錯誤:', error);
+              setIsLoading(false);
+            },
+          });
+        }
+      } catch (error) {
+        console.error('建立後端對話失敗:', error);
+        toast.error('無法連接對話服務，將使用模擬回覆');
+      }
+    }
+    
     setConversationStarted(true);
     setImageEnlarged(true);
     
@@ -251,6 +287,14 @@ export default function ConversationPage() {
       }
     }
     
+    // 通知後端結束對話，服務端完成評分後關閉連線
+    if (socketRef.current) {
+      if (socketRef.current.readyState === WebSocket.OPEN) {
+        socketRef.current.send(JSON.stringify({ type: 'end' }));
+      }
+      socketRef.current = null;
+    }
+    
     // 停止計時器
     if (timerInterval) {
       clearInterval(timerInterval);
@@ -475,6 +519,16 @@ export default function ConversationPage() {
     setMessages(prev => [...prev, userMessage]);
     setIsLoading(true);
     
+    if (socketRef.current && socketRef.current.readyState === WebSocket.OPEN) {
+      sendSocketMessage(socketRef.current, text);
+      return;
+    }
+    
+    if (backendConversationRef.current !== null) {
+      await streamReply(backendConversationRef.current, text);
+      return;
+    }
+    
     try {
       // 模擬API調用延遲
       await new Promise(resolve => setTimeout(resolve, 1000));
@@ -498,6 +552,46 @@ export default function ConversationPage() {
     }
   };
   
+  // WebSocket 回覆片段：每輪第一個片段新增病人消息，之後逐段追加
+  const appendReplyChunk = (chunk: string) => {
+    if (!socketReplyStartedRef.current) {
+      socketReplyStartedRef.current = true;
+      setIsLoading(false);
+      setMessages(prev => [...prev, { role: 'assistant' as const, content: chunk, timestamp: elapsedTime + 1 }]);
+      return;
+    }
+    setMessages(prev => {
+      const last = prev[prev.length - 1];
+      return [...prev.slice(0, -1), { ...last, content: last.content + chunk }];
+    });
+  };
+  
+  // 以串流方式接收後端回覆：收到第一個片段就顯示，之後逐段追加
+  const streamReply = async (conversationId: number, text: string) => {
+    let started = false;
+    try {
+      await streamMessage(conversationId, text, {
+        onDelta: (chunk) => {
+          if (!started) {
+            started = true;
+            setIsLoading(false);
+            setMessages(prev => [...prev, { role: 'assistant' as const, content: chunk, timestamp: elapsedTime + 1 }]);
+            return;
+          }
+          setMessages(prev => {
+            const last = prev[prev.length - 1];
+            return [...prev.slice(0, -1), { ...last, content: last.content + chunk }];
+          });
+        },
+      });
+    } catch (error) {
+      console.error('串流回覆時出錯:', error);
+      toast.error('無法獲取回覆，請稍後再試');
+    } finally {
+      setIsLoading(false);
+    }
+  };
+  
   // 從向量搜索獲取回覆
   const getResponseFromVectorSearch = (query: string) => {
     // 這裡應該是實際的向量搜索邏輯
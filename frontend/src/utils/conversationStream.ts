@@ -0,0 +1,159 @@
+// 對話後端（Django）的 API 地址與虛擬病人ID，未設定時對話頁使用本地模擬回覆
+export const CONVERSATION_API = process.env.NEXT_PUBLIC_CONVERSATION_API || '';
+export const VIRTUAL_PATIENT_ID = process.env.NEXT_PUBLIC_VIRTUAL_PATIENT_ID || '';
+
+export interface StreamedMessage {
+  id: number;
+  role: string;
+  content: string;
+  score: number | null;
+}
+
+export interface StreamDone {
+  messages: StreamedMessage[];
+  score: Record<string, any>;
+  timings?: Record<string, number>;
+}
+
+interface StreamHandlers {
+  onDelta: (text: string) => void;
+  onDone?: (data: StreamDone) => void;
+}
+
+function authHeaders(): Record<string, string> {
+  const token = localStorage.getItem('token');
+  return {
+    'Content-Type': 'application/json',
+    ...(token ? { Authorization: `Bearer ${token}` } : {}),
+  };
+}
+
+// 在後端建立對話，返回對話ID
+export async function startBackendConversation(): Promise<number> {
+  const response = await fetch(`${CONVERSATION_API}/async/patients/${VIRTUAL_PATIENT_ID}/start/`, {
+    method: 'POST',
+    headers: authHeaders(),
+  });
+  if (!response.ok) {
+    throw new Error(`開始對話失敗: ${response.status}`);
+  }
+  const conversation = await response.json();
+  return conversation.id;
+}
+
+// 解析一個 SSE 事件塊（event: ... / data: ...）
+function parseEvent(block: string): { event: string; data: any } | null {
+  let event = 'message';
+  const dataLines: string[] = [];
+  for (const line of block.split('\n')) {
+    if (line.startsWith('event:')) {
+      event = line.slice(6).trim();
+    } else if (line.startsWith('data:')) {
+      dataLines.push(line.slice(5).trimStart());
+    }
+  }
+  if (dataLines.length === 0) return null;
+  return { event, data: JSON.parse(dataLines.join('\n')) };
+}
+
+// 發送消息並以 Server-Sent Events 接收回覆：回覆片段一到就回調 onDelta，
+// 最後的 done 事件帶有已保存的消息ID。EventSource 不支持 POST 和自定義標頭，因此直接讀取 fetch 串流。
+export async function streamMessage(conversationId: number, content: string, handlers: StreamHandlers): Promise<StreamDone> {
+  const response = await fetch(`${CONVERSATION_API}/async/${conversationId}/stream/`, {
+    method: 'POST',
+    headers: authHeaders(),
+    body: JSON.stringify({ content }),
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`發送消息失敗: ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let done: StreamDone | null = null;
+
+  while (true) {
+    const { value, done: finished } = await reader.read();
+    if (finished) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let separator = buffer.indexOf('\n\n');
+    while (separator !== -1) {
+      const parsed = parseEvent(buffer.slice(0, separator));
+      buffer = buffer.slice(separator + 2);
+      separator = buffer.indexOf('\n\n');
+      if (!parsed) continue;
+
+      if (parsed.event === 'delta') {
+        handlers.onDelta(parsed.data.text);
+      } else if (parsed.event === 'done') {
+        done = parsed.data as StreamDone;
+        handlers.onDone?.(done);
+      } else if (parsed.event === 'error') {
+        throw new Error(parsed.data.error);
+      }
+    }
+  }
+
+  if (!done) {
+    throw new Error('回覆串流意外中斷');
+  }
+  return done;
+}
+
+// WebSocket 通道地址（例如 wss://example.com/ws/conversations），設定後語音輸入的每句話走同一條連線
+export const CONVERSATION_WS = process.env.NEXT_PUBLIC_CONVERSATION_WS || '';
+
+interface SocketHandlers {
+  onDelta: (text: string) => void;
+  onReply?: (frame: { message_ids: number[]; text: string }) => void;
+  onScore?: (frame: { message_id: number; score: number | null; running: Record<string, any> }) => void;
+  onEnded?: (conversation: Record<string, any>) => void;
+  onError?: (error: string) => void;
+}
+
+// 打開對話的 WebSocket 連線：連線後只驗證一次，收到 ready 幀後返回
+export function openConversationSocket(conversationId: number, handlers: SocketHandlers): Promise<WebSocket> {
+  return new Promise((resolve, reject) => {
+    const socket = new WebSocket(`${CONVERSATION_WS}/${conversationId}/`);
+    let ready = false;
+
+    socket.onopen = () => {
+      socket.send(JSON.stringify({ type: 'auth', token: localStorage.getItem('token') || '' }));
+    };
+    socket.onmessage = (event) => {
+      const frame = JSON.parse(event.data);
+      switch (frame.type) {
+        case 'ready':
+          ready = true;
+          resolve(socket);
+          break;
+        case 'delta':
+          handlers.onDelta(frame.text);
+          break;
+        case 'reply':
+          handlers.onReply?.(frame);
+          break;
+        case 'score':
+          handlers.onScore?.(frame);
+          break;
+        case 'ended':
+          handlers.onEnded?.(frame.conversation);
+          break;
+        case 'error':
+          if (!ready) reject(new Error(frame.error));
+          handlers.onError?.(frame.error);
+          break;
+      }
+    };
+    socket.onclose = () => {
+      if (!ready) reject(new Error('WebSocket 連線已關閉'));
+    };
+  });
+}
+
+// 通過 WebSocket 發送一輪提問
+export function sendSocketMessage(socket: WebSocket, content: string) {
+  socket.send(JSON.stringify({ type: 'message', content }));
+}
@@ -0,0 +1,107 @@
+"""HNSW 近似最近鄰索引與精確 NumPy 搜索的比較：recall@k 與查詢延遲（p50/p99）
+
+    python scripts/benchmark_ann.py --rows 50000 --dim 384 --queries 500 --ef 64 128 256 512
+
+最後給出建議：召回率達到 --target-recall 的最小 ef 比精確搜索快時才值得建 HNSW 索引，
+否則在該規模下應繼續使用精確搜索（numpy 實現的 HNSW 每步有固定開銷，數萬行以內通常不佔優）。
+
+默認使用分簇的隨機單位向量模擬大量問診語句（同一問題的多種說法聚在一起）；
+--save 可把建好的索引寫入文件，下次以 --load 直接載入，跳過建圖。
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'virtual_patient'))
+
+from rag.vector_store import HNSWIndex, normalize_rows, top_k_indices  # noqa: E402
+
+
+def clustered_vectors(rows, dim, clusters, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim))
+    return normalize_rows(centers[rng.integers(clusters, size=rows)] + 0.5 * rng.standard_normal((rows, dim)))
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def report(name, latencies, recall=None):
+    """打印一行結果並返回 p50（秒）"""
+    latencies = sorted(latencies)
+    line = f'{name:>12}: p50 {percentile(latencies, 0.5) * 1000:.3f}ms, p99 {percentile(latencies, 0.99) * 1000:.3f}ms'
+    if recall is not None:
+        line += f', recall@k {recall:.4f}'
+    print(line)
+    return percentile(latencies, 0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HNSW 與精確搜索比較')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--clusters', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--M', type=int, default=16)
+    parser.add_argument('--ef-construction', type=int, default=100)
+    parser.add_argument('--ef', type=int, nargs='+', default=[64, 128, 256, 512])
+    parser.add_argument('--target-recall', type=float, default=0.9, help='可接受的最低 recall@k')
+    parser.add_argument('--save', help='建好後寫入的索引文件')
+    parser.add_argument('--load', help='直接載入的索引文件（須由相同參數生成）')
+    args = parser.parse_args()
+
+    data = clustered_vectors(args.rows, args.dim, args.clusters, seed=0)
+    queries = clustered_vectors(args.queries, args.dim, args.clusters, seed=1)
+
+    if args.load:
+        start = time.perf_counter()
+        index = HNSWIndex.load(args.load)
+        print(f'載入索引 {len(index)} 行，用時 {time.perf_counter() - start:.2f}s')
+    else:
+        index = HNSWIndex(args.dim, M=args.M, ef_construction=args.ef_construction)
+        start = time.perf_counter()
+        index.add(data)
+        elapsed = time.perf_counter() - start
+        print(f'建圖 {args.rows} 行，用時 {elapsed:.1f}s（{args.rows / elapsed:.0f} 行/s）')
+        if args.save:
+            index.save(args.save)
+
+    exact_results = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        exact_results.append(set(top_k_indices(data @ query, args.top_k).tolist()))
+        latencies.append(time.perf_counter() - start)
+    exact_p50 = report('exact', latencies)
+
+    results = []
+    for ef in args.ef:
+        latencies = []
+        hits = 0
+        for query, exact in zip(queries, exact_results):
+            start = time.perf_counter()
+            _, rows = index.search(query, args.top_k, ef=ef)
+            latencies.append(time.perf_counter() - start)
+            hits += len(exact & set(rows.tolist()))
+        recall = hits / (len(queries) * args.top_k)
+        results.append((ef, recall, report(f'hnsw ef={ef}', latencies, recall)))
+
+    usable = [(ef, recall, p50) for ef, recall, p50 in sorted(results) if recall >= args.target_recall]
+    if not usable:
+        print(f'建議: 沒有 ef 達到 recall@k {args.target_recall}，請提高 --M、--ef-construction 或 --ef；在此之前使用精確搜索')
+    elif usable[0][2] >= exact_p50:
+        ef, recall, p50 = usable[0]
+        print(f'建議: 達到目標召回率的 ef={ef}（p50 {p50 * 1000:.3f}ms）不比精確搜索（p50 {exact_p50 * 1000:.3f}ms）快，'
+              f'{args.rows} 行時應繼續使用精確搜索')
+    else:
+        ef, recall, p50 = usable[0]
+        print(f'建議: M={index.M}, ef={ef}，recall@k {recall:.4f}，p50 {p50 * 1000:.3f}ms（精確搜索 {exact_p50 * 1000:.3f}ms）')
+
+
+if __name__ == '__main__':
+    main()
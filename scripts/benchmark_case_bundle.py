@@ -0,0 +1,91 @@
+"""病例冷載入時間比較：JSON（解析 + 編碼 + 編譯）與二進位病例文件（mmap）
+
+    python scripts/benchmark_case_bundle.py --dialog dialog_rag_sample.json --scoring scoring_criteria_rag.json --repeat 20
+
+JSON 路徑與 worker 第一次遇到病例時相同：讀取 JSON、構建病人索引、編譯評分標準和案例關鍵詞自動機；
+病例文件路徑只做 mmap 與從映射的表還原結構。--scale 把對話項目複製多份以模擬較大的病例。
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'virtual_patient'))
+
+from rag.case_bundle import CaseBundle, write_case_bundle  # noqa: E402
+from rag.embeddings import HashingEncoder  # noqa: E402
+from rag.keyword_matcher import CaseKeywordMatcher  # noqa: E402
+from rag.patient_index import PatientIndex  # noqa: E402
+from rag.rubric import CompiledRubric  # noqa: E402
+
+
+def scaled_dialog(dialog_json, scale):
+    items = []
+    for copy_index in range(scale):
+        for position, item in enumerate(dialog_json):
+            item = copy.deepcopy(item)
+            item['id'] = f'{item.get("id", position)}-{copy_index}'
+            if '觸發語句' in item:
+                item['觸發語句'] = [f'{phrase}（{copy_index}）' for phrase in item['觸發語句']]
+            for key in ('嵌入內容', 'question'):
+                if key in item:
+                    item[key] = f'{item[key]}（{copy_index}）'
+            items.append(item)
+    return items
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='病例冷載入時間比較')
+    parser.add_argument('--dialog', required=True)
+    parser.add_argument('--scoring', required=True)
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.dialog, 'r', encoding='utf-8') as f:
+        dialog_json = scaled_dialog(json.load(f), args.scale)
+
+    with tempfile.TemporaryDirectory() as directory:
+        dialog_path = os.path.join(directory, 'dialog.json')
+        with open(dialog_path, 'w', encoding='utf-8') as f:
+            json.dump(dialog_json, f, ensure_ascii=False)
+        with open(args.scoring, 'r', encoding='utf-8') as f:
+            scoring_json = json.load(f)
+        path = write_case_bundle(os.path.join(directory, 'case.vpcase'), 1, dialog_json, scoring_json, HashingEncoder())
+
+        json_times = []
+        bundle_times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            with open(dialog_path, 'r', encoding='utf-8') as f:
+                dialog = json.load(f)
+            with open(args.scoring, 'r', encoding='utf-8') as f:
+                scoring = json.load(f)
+            encoder = HashingEncoder()
+            rubric = CompiledRubric.build(scoring, encoder)
+            PatientIndex.build(1, dialog, encoder)
+            CaseKeywordMatcher(rubric, dialog)
+            json_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            bundle = CaseBundle(path)
+            encoder = HashingEncoder()
+            bundle.compiled_rubric(encoder)
+            bundle.patient_index(encoder)
+            bundle.keyword_matcher()
+            bundle_times.append(time.perf_counter() - start)
+
+        print(f'病例文件 {os.path.getsize(path)} 字節，{len(dialog_json)} 個對話項目，{len(scoring_json)} 條評分標準')
+        print(f'  JSON: 中位數 {median(json_times) * 1000:.2f}ms')
+        print(f'病例文件: 中位數 {median(bundle_times) * 1000:.2f}ms（{median(json_times) / median(bundle_times):.1f}x）')
+
+
+if __name__ == '__main__':
+    main()
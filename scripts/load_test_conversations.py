@@ -0,0 +1,122 @@
+"""對話端點壓力測試：比較同步 DRF 視圖與原生異步視圖在單個 ASGI worker 下的並發能力
+
+先以單個 worker 啟動服務：
+    cd virtual_patient
+    uvicorn virtual_patient.asgi:application --workers 1
+
+再運行（每個模擬學生依次開始對話、發送若干消息、結束對話）：
+    python scripts/load_test_conversations.py --username testuser --password ... --patient 1 --sessions 200
+
+只使用標準庫，客戶端以線程模擬並發學生。
+"""
+import argparse
+import json
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+QUESTIONS = [
+    '小朋友叫什麼名字？',
+    '今天大便幾次？',
+    '有沒有發燒？',
+    '有沒有嘔吐？',
+    '最近吃了什麼東西？',
+]
+
+ENDPOINTS = {
+    'sync': {
+        'start': '{base}/patients/{patient}/start_conversation/',
+        'send': '{base}/{conversation}/send_message/',
+        'end': '{base}/{conversation}/end_conversation/',
+    },
+    'async': {
+        'start': '{base}/async/patients/{patient}/start/',
+        'send': '{base}/async/{conversation}/send/',
+        'end': '{base}/async/{conversation}/end/',
+    },
+}
+
+
+def post(url, token=None, data=None, timeout=120):
+    body = json.dumps(data or {}).encode('utf-8')
+    request = urllib.request.Request(url, data=body, method='POST', headers={'Content-Type': 'application/json'})
+    if token:
+        request.add_header('Authorization', f'Bearer {token}')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def obtain_token(accounts_url, username, password):
+    return post(f'{accounts_url}/token/', data={'username': username, 'password': password})['access']
+
+
+def run_session(mode, args, token):
+    """模擬一個學生的完整對話，返回每個請求的耗時（秒）與錯誤數"""
+    urls = ENDPOINTS[mode]
+    latencies = []
+    errors = 0
+
+    def timed_post(url, data=None):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            return post(url, token, data)
+        except (urllib.error.URLError, OSError, ValueError):
+            errors += 1
+            return None
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    conversation = timed_post(urls['start'].format(base=args.base_url, patient=args.patient))
+    if conversation is None:
+        return latencies, errors
+    for turn in range(args.turns):
+        url = urls['send'].format(base=args.base_url, conversation=conversation['id'])
+        timed_post(url, {'content': QUESTIONS[turn % len(QUESTIONS)]})
+    timed_post(urls['end'].format(base=args.base_url, conversation=conversation['id']))
+    return latencies, errors
+
+
+def run_mode(mode, args, token):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        results = list(executor.map(lambda _: run_session(mode, args, token), range(args.sessions)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for session, _ in results for latency in session)
+    errors = sum(session_errors for _, session_errors in results)
+    if not latencies:
+        print(f'{mode}: 沒有完成任何請求')
+        return
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f'{mode:>5}: {args.sessions} 個並發對話, {len(latencies)} 個請求, 用時 {elapsed:.2f}s, '
+        f'{len(latencies) / elapsed:.1f} req/s, '
+        f'p50 {statistics.median(latencies) * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms, '
+        f'最大 {latencies[-1] * 1000:.0f}ms, 錯誤 {errors}'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='對話端點壓力測試')
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000/api/conversations')
+    parser.add_argument('--accounts-url', default='http://127.0.0.1:8000/api/accounts')
+    parser.add_argument('--token', help='JWT access token（或使用 --username/--password 取得）')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--patient', type=int, required=True, help='虛擬病人ID')
+    parser.add_argument('--sessions', type=int, default=200, help='並發對話數')
+    parser.add_argument('--turns', type=int, default=5, help='每個對話發送的消息數')
+    parser.add_argument('--mode', choices=['sync', 'async', 'both'], default='both')
+    args = parser.parse_args()
+
+    token = args.token or obtain_token(args.accounts_url, args.username, args.password)
+    modes = ['sync', 'async'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        run_mode(mode, args, token)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from rag.dialog_generator import MATCH_THRESHOLD, DialogGenerator
+from rag.generative import PatientReplyGenerator, get_generative_client
+from rag.keyword_matcher import get_case_matcher
+from rag.patient_index import IndexVersionUnavailable, get_patient_index
+from rag.rubric import get_compiled_rubric
+
+logger = logging.getLogger(__name__)
+
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def timed(func, *args, **kwargs):
+    """執行函數並返回 (結果, 耗時毫秒)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, elapsed_ms(start)
+
+
+_turn_executor = None
+_turn_executor_lock = threading.Lock()
+
+
+def get_turn_executor():
+    """對話檢索與同步評分共用的有界線程池（CONVERSATION_TURN_WORKERS）"""
+    global _turn_executor
+    if _turn_executor is None:
+        with _turn_executor_lock:
+            if _turn_executor is None:
+                max_workers = getattr(settings, 'CONVERSATION_TURN_WORKERS', 4)
+                _turn_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='turn')
+    return _turn_executor
+
+
+class ConversationHandler:
+    """單一對話的處理器：共享的病人索引加上少量對話狀態
+
+    評分狀態不在處理器中：累計的覆蓋情況保存在 Conversation.criteria_coverage，
+    每次評分時由 build_score_engine 恢復。
+    """
+
+    def __init__(self, conversation_id, virtual_patient, patient_index, rubric, dialog_generator):
+        self.conversation_id = conversation_id
+        self.virtual_patient_id = virtual_patient.id
+        self.patient_index = patient_index
+        self.vector_store = patient_index.vector_store
+        self.dialog_generator = dialog_generator
+        # 評分標準與對話腳本的關鍵詞合併為一個自動機，每輪只掃描一次，命中結果同時用於評分和對話檢索
+        self.keyword_matcher = get_case_matcher(rubric, patient_index)
+
+    @classmethod
+    def create(cls, conversation_id, virtual_patient, index_version=None):
+        """為對話建立處理器
+
+        index_version 為對話開始時的索引版本：重建進行中的對話時沿用該版本，不切換到病例的新版本。
+        """
+        patient_index = get_patient_index(virtual_patient, index_version)
+
+        # 評分標準按內容雜湊編譯一次，所有對話共享
+        rubric = get_compiled_rubric(virtual_patient.scoring_json)
+
+        # 對話腳本取自索引本身：病例更新後新版本索引在後台構建期間，回覆與檢索仍使用同一版本
+        dialog_json = patient_index.dialog_json
+
+        # 檢索分數不足時的生成式回退（設定了 RAG_GENERATIVE_BACKEND 才啟用）
+        fallback = None
+        client = get_generative_client()
+        if client is not None:
+            fallback = PatientReplyGenerator(client, dialog_json, patient_index.version)
+
+        threshold = getattr(settings, 'RAG_MATCH_THRESHOLD', MATCH_THRESHOLD)
+        dialog_generator = DialogGenerator(dialog_json, fallback=fallback, threshold=threshold)
+        return cls(conversation_id, virtual_patient, patient_index, rubric, dialog_generator)
+
+    @classmethod
+    def rehydrate(cls, conversation):
+        """根據數據庫中的對話記錄重建處理器
+
+        檢索式對話沒有逐輪狀態，評分狀態保存在對話上，因此不需要重放消息，
+        只需沿用對話開始時的索引版本。
+        """
+        return cls.create(conversation.id, conversation.virtual_patient, conversation.index_version)
+
+    def embed_query(self, text):
+        """編碼學生提問一次，供評分和對話檢索共用"""
+        return self.vector_store.embed([text])[0]
+
+    def match_keywords(self, content):
+        """以案例自動機掃描提問一次，結果供對話檢索與評分共用"""
+        return self.keyword_matcher.match(content)
+
+    def retrieve(self, content, query_vector=None, keyword_matches=None):
+        """詞彙 + 向量混合檢索，關鍵詞命中的對話項目參與排名；未提供查詢嵌入時，詞彙匹配明確的提問不經過編碼器"""
+        if keyword_matches is None:
+            keyword_matches = self.match_keywords(content)
+        return self.patient_index.retrieve(
+            content, query_vector=query_vector, encode=self.embed_query, keyword_items=keyword_matches.dialog_items
+        )
+
+    def reply(self, content, query_vector=None, keyword_matches=None):
+        """以混合檢索結果取得病人回覆"""
+        results = self.retrieve(content, query_vector, keyword_matches)
+        return self.dialog_generator.get_response(content, self.vector_store, results=results)
+
+    def respond(self, content):
+        """只做對話檢索，返回 (病人回覆, 各階段耗時)
+
+        不預先編碼提問，詞彙匹配明確時整輪不調用編碼器。
+        """
+        start = time.perf_counter()
+        patient_response = self.reply(content)
+        retrieval_ms = elapsed_ms(start)
+        return patient_response, {'retrieval_ms': retrieval_ms, 'total_ms': retrieval_ms}
+
+    def run_turn(self, content, score_engine, executor=None):
+        """查詢嵌入只算一次，對話檢索與評分在線程池中並行執行
+
+        返回 (病人回覆, 評分結果, 各階段耗時)。
+        """
+        start = time.perf_counter()
+        query_vector = self.embed_query(content)
+        keyword_matches = self.match_keywords(content)
+        timings = {'embed_ms': elapsed_ms(start)}
+
+        executor = executor or get_turn_executor()
+        retrieval = executor.submit(
+            timed, self.reply, content, query_vector=query_vector, keyword_matches=keyword_matches
+        )
+        scoring = executor.submit(timed, self.score, content, score_engine, query_vector, keyword_matches)
+        patient_response, timings['retrieval_ms'] = retrieval.result()
+        score_result, timings['scoring_ms'] = scoring.result()
+        timings['total_ms'] = elapsed_ms(start)
+        return patient_response, score_result, timings
+
+    async def arespond(self, content, executor=None):
+        """respond 的異步版本，在線程池中執行以免阻塞事件循環"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor or get_turn_executor(), self.respond, content)
+
+    async def arun_turn(self, content, score_engine, executor=None):
+        """run_turn 的異步版本：嵌入完成後以兩個並行任務執行檢索與評分"""
+        loop = asyncio.get_running_loop()
+        executor = executor or get_turn_executor()
+        start = time.perf_counter()
+        query_vector = await loop.run_in_executor(executor, self.embed_query, content)
+        keyword_matches = self.match_keywords(content)
+        timings = {'embed_ms': elapsed_ms(start)}
+
+        retrieval = loop.run_in_executor(executor, functools.partial(
+            timed, self.reply, content, query_vector=query_vector, keyword_matches=keyword_matches
+        ))
+        scoring = loop.run_in_executor(executor, timed, self.score, content, score_engine, query_vector, keyword_matches)
+        (patient_response, timings['retrieval_ms']), (score_result, timings['scoring_ms']) = await asyncio.gather(retrieval, scoring)
+        timings['total_ms'] = elapsed_ms(start)
+        return patient_response, score_result, timings
+
+    def score(self, content, score_engine, query_vector, keyword_matches=None):
+        """以已計算的查詢嵌入和關鍵詞掃描結果為學生提問評分"""
+        if keyword_matches is None:
+            keyword_matches = self.match_keywords(content)
+        return score_engine.score_response(content, query_vector=query_vector, keyword_matches=keyword_matches.criteria)
+
+    def to_state(self):
+        """導出可序列化的對話狀態，供共享會話存儲使用"""
+        return {
+            'virtual_patient_id': self.virtual_patient_id,
+            'index_version': self.patient_index.version,
+            'dialog': self.dialog_generator.get_state(),
+        }
+
+    @classmethod
+    def from_state(cls, conversation_id, state):
+        """根據保存的狀態重建處理器，病人索引從共享緩存取得"""
+        from .models import VirtualPatient
+
+        virtual_patient = VirtualPatient.objects.get(pk=state['virtual_patient_id'])
+        handler = cls.create(conversation_id, virtual_patient, state.get('index_version'))
+        handler.dialog_generator.set_state(state.get('dialog', {}))
+        return handler
+
+
+def get_or_rehydrate_handler(conversation, store):
+    """從會話存儲取得處理器，缺失時從數據庫重建並放回存儲
+
+    已結束、沒有關聯虛擬病人或對話開始時的索引版本已無法重建的對話返回 None。
+    """
+    try:
+        handler = store.get(conversation.id)
+        if handler is None and conversation.virtual_patient_id and conversation.completed_at is None:
+            handler = ConversationHandler.rehydrate(conversation)
+            store.set(conversation.id, handler)
+    except IndexVersionUnavailable:
+        logger.warning('對話 %s 的索引版本 %s 已不可用', conversation.id, conversation.index_version)
+        return None
+    return handler
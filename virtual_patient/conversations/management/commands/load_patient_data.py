@@ -1,42 +1,192 @@
-import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
 from conversations.models import VirtualPatient
+from rag.cases import directory_entries, manifest_entries, read_case
+from rag.dialog_items import diff_dialog_items, dialog_phrases
+from rag.embedding_bundle import bundle_path, write_bundle
+from rag.patient_index import PatientIndex, dialog_content_hash, sync_patient_data
+from rag.vector_store import VectorStore
 
 class Command(BaseCommand):
     help = '從JSON文件載入虛擬病人數據'
 
     def add_arguments(self, parser):
-        parser.add_argument('--name', type=str, required=True, help='虛擬病人名稱')
-        parser.add_argument('--description', type=str, required=True, help='虛擬病人描述')
-        parser.add_argument('--dialog', type=str, required=True, help='對話JSON文件路徑')
-        parser.add_argument('--scoring', type=str, required=True, help='評分JSON文件路徑')
+        parser.add_argument('--name', type=str, help='虛擬病人名稱')
+        parser.add_argument('--description', type=str, help='虛擬病人描述')
+        parser.add_argument('--dialog', type=str, help='對話JSON文件路徑')
+        parser.add_argument('--scoring', type=str, help='評分JSON文件路徑')
+        # 批量匯入
+        parser.add_argument('--manifest', type=str, help='病例清單JSON：[{"name", "description", "dialog", "scoring"}]')
+        parser.add_argument('--dir', type=str, help='病例目錄：每個子目錄含 dialog.json、scoring.json 和可選的 case.json')
+        parser.add_argument('--workers', type=int, help='解析與檢查病例的進程數（默認為 CPU 數）')
+        parser.add_argument('--batch-size', type=int, default=256, help='批量匯入時每批編碼的語句數')
 
     def handle(self, *args, **kwargs):
+        if kwargs['manifest'] or kwargs['dir']:
+            self.bulk_import(kwargs)
+            return
+
+        missing = [option for option in ('name', 'description', 'dialog', 'scoring') if not kwargs[option]]
+        if missing:
+            self.stdout.write(self.style.ERROR(f'錯誤: 缺少參數 {", ".join("--" + option for option in missing)}'))
+            return
+
         name = kwargs['name']
         description = kwargs['description']
-        dialog_path = kwargs['dialog']
-        scoring_path = kwargs['scoring']
-        
+
         try:
-            with open(dialog_path, 'r', encoding='utf-8') as f:
-                dialog_json = json.load(f)
-            
-            with open(scoring_path, 'r', encoding='utf-8') as f:
-                scoring_json = json.load(f)
-            
-            patient, created = VirtualPatient.objects.update_or_create(
-                name=name,
-                defaults={
-                    'description': description,
-                    'dialog_json': dialog_json,
-                    'scoring_json': scoring_json
-                }
-            )
-            
+            case = read_case(kwargs)
+            if case['errors']:
+                raise ValueError('；'.join(case['errors']))
+            dialog_json = case['dialog_json']
+            scoring_json = case['scoring_json']
+
+            with transaction.atomic():
+                existing = VirtualPatient.objects.select_for_update().filter(name=name).first()
+                old_dialog = existing.dialog_json if existing else None
+                patient, created = VirtualPatient.objects.update_or_create(
+                    name=name,
+                    defaults={
+                        'description': description,
+                        'dialog_json': dialog_json,
+                        'scoring_json': scoring_json
+                    }
+                )
+
             if created:
                 self.stdout.write(self.style.SUCCESS(f'成功創建虛擬病人 "{name}"'))
             else:
                 self.stdout.write(self.style.SUCCESS(f'成功更新虛擬病人 "{name}"'))
-                
+                diff = diff_dialog_items(old_dialog, dialog_json)
+                self.stdout.write(
+                    f'對話項目：新增 {len(diff["added"])}，修改 {len(diff["changed"])}，'
+                    f'刪除 {len(diff["removed"])}，未變 {len(diff["unchanged"])}'
+                )
+
+            self.update_bundle(patient, old_dialog, dialog_json)
+
         except Exception as e:
-            self.stdout.write(self.style.ERROR(f'錯誤: {str(e)}'))
\ No newline at end of file
+            self.stdout.write(self.style.ERROR(f'錯誤: {str(e)}'))
+
+    def update_bundle(self, patient, old_dialog, dialog_json):
+        """設定了 RAG_EMBEDDING_BUNDLE_DIR 時寫入新版本的嵌入文件，並按文件行序重寫 PatientData
+
+        舊版本的嵌入文件存在時從它增量構建，只編碼新增或改動的觸發語句；
+        新版本寫入新文件，舊文件保留給仍在使用舊版本的 worker。
+        """
+        bundle_dir = getattr(settings, 'RAG_EMBEDDING_BUNDLE_DIR', None)
+        if not bundle_dir:
+            sync_patient_data(patient.id)
+            return
+        previous = None
+        if old_dialog is not None and bundle_path(bundle_dir, patient.id, dialog_content_hash(old_dialog)).exists():
+            previous = PatientIndex.build(patient.id, old_dialog, bundle_dir=bundle_dir)
+        index = PatientIndex.build(patient.id, dialog_json, bundle_dir=bundle_dir, previous=previous)
+        path = bundle_path(bundle_dir, patient.id, index.version)
+        if index.encoded or not path.exists():
+            index.write_bundle(bundle_dir)
+        sync_patient_data(patient.id, bundle_dir)
+        reused = len(index.live_rows) - index.encoded
+        self.stdout.write(self.style.SUCCESS(f'嵌入文件 {path}：編碼 {index.encoded} 條語句，沿用 {reused} 條'))
+
+    def bulk_import(self, kwargs):
+        """批量匯入病例：進程池並行解析與檢查，一個事務內批量寫入，跨病例批量編碼
+
+        任何病例檢查失敗時不寫入任何數據。
+        """
+        start = time.perf_counter()
+        entries = manifest_entries(kwargs['manifest']) if kwargs['manifest'] else directory_entries(kwargs['dir'])
+        if not entries:
+            self.stdout.write(self.style.ERROR('錯誤: 沒有找到病例'))
+            return
+
+        workers = kwargs['workers'] or min(os.cpu_count() or 1, len(entries))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                cases = list(pool.map(read_case, entries, chunksize=max(1, len(entries) // (workers * 4))))
+        else:
+            cases = [read_case(entry) for entry in entries]
+
+        names = [case['name'] for case in cases]
+        duplicates = sorted(name for name, count in Counter(names).items() if count > 1)
+        invalid = [case for case in cases if case['errors']]
+        if invalid or duplicates:
+            for case in invalid:
+                self.stdout.write(self.style.ERROR(f'"{case["name"]}": {"；".join(case["errors"])}'))
+            if duplicates:
+                self.stdout.write(self.style.ERROR(f'病人名稱重複: {", ".join(duplicates)}'))
+            self.stdout.write(self.style.ERROR(f'錯誤: {len(invalid)} 個病例檢查失敗，未匯入任何病例'))
+            return
+
+        with transaction.atomic():
+            existing = VirtualPatient.objects.select_for_update().in_bulk(names, field_name='name')
+            patients = []
+            updated = []
+            created = []
+            for case in cases:
+                patient = existing.get(case['name']) or VirtualPatient(name=case['name'])
+                patient.description = case['description']
+                patient.dialog_json = case['dialog_json']
+                patient.scoring_json = case['scoring_json']
+                (updated if patient.pk else created).append(patient)
+                patients.append(patient)
+            # bulk_update 不會自動更新 updated_at，worker 依賴它發現新版本病例
+            now = timezone.now()
+            for patient in updated:
+                patient.updated_at = now
+            VirtualPatient.objects.bulk_update(updated, ['description', 'dialog_json', 'scoring_json', 'updated_at'])
+            VirtualPatient.objects.bulk_create(created)
+
+        phrases = sum(len(dialog_phrases(case['dialog_json'])[0]) for case in cases)
+        encoded = self.write_bundles(patients, kwargs['batch_size'])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'匯入 {len(cases)} 個病例（新建 {len(created)}，更新 {len(updated)}），'
+            f'{phrases} 條觸發語句（編碼 {encoded} 條），用時 {elapsed:.2f}s，'
+            f'{len(cases) / elapsed:.1f} 病例/s，{phrases / elapsed:.0f} 語句/s'
+        ))
+
+    def write_bundles(self, patients, batch_size):
+        """設定了 RAG_EMBEDDING_BUNDLE_DIR 時為所有病例寫入嵌入文件，返回編碼的語句數
+
+        已有同版本嵌入文件的病例跳過；其餘病例的觸發語句去重後分批一起編碼。
+        所有病例的 PatientData 最後按各自的嵌入文件重寫。
+        """
+        bundle_dir = getattr(settings, 'RAG_EMBEDDING_BUNDLE_DIR', None)
+        if not bundle_dir:
+            for patient in patients:
+                sync_patient_data(patient.id)
+            return 0
+        pending = []
+        for patient in patients:
+            version = dialog_content_hash(patient.dialog_json)
+            if not bundle_path(bundle_dir, patient.id, version).exists():
+                pending.append((patient, version, *dialog_phrases(patient.dialog_json)))
+
+        unique = list(dict.fromkeys(phrase for _, _, phrases, _ in pending for phrase in phrases))
+        vector_store = VectorStore()
+        rows = {phrase: row for row, phrase in enumerate(unique)}
+        embeddings = [vector_store.embed(unique[i:i + batch_size]) for i in range(0, len(unique), batch_size)]
+
+        if embeddings:
+            matrix = np.concatenate(embeddings)
+            for patient, version, phrases, item_ids in pending:
+                write_bundle(
+                    bundle_path(bundle_dir, patient.id, version),
+                    matrix[[rows[phrase] for phrase in phrases]],
+                    ids=item_ids,
+                    texts=phrases,
+                    model_id=vector_store.encoder.model_id,
+                    version=version,
+                )
+        for patient in patients:
+            sync_patient_data(patient.id, bundle_dir)
+        return len(unique)
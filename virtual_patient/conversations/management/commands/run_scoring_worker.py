@@ -0,0 +1,31 @@
+import time
+from django.core.management.base import BaseCommand
+from conversations.scoring_queue import DatabaseScoringQueue, get_scoring_queue
+
+class Command(BaseCommand):
+    help = '處理數據庫評分隊列中的學生消息'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='處理完目前的待評分任務後退出')
+        parser.add_argument('--sleep', type=float, default=0.5, help='隊列為空時的輪詢間隔（秒）')
+
+    def handle(self, *args, **kwargs):
+        queue = get_scoring_queue()
+        if not isinstance(queue, DatabaseScoringQueue):
+            queue = DatabaseScoringQueue()
+
+        processed = 0
+        failed = 0
+        while True:
+            job = queue.process_one()
+            if job is None:
+                if kwargs['once']:
+                    break
+                time.sleep(kwargs['sleep'])
+                continue
+            processed += 1
+            if job.status != job.DONE:
+                failed += 1
+                self.stdout.write(self.style.WARNING(f'消息 {job.message_id} 評分失敗: {job.error}'))
+
+        self.stdout.write(self.style.SUCCESS(f'已處理 {processed} 個評分任務，失敗 {failed} 個'))
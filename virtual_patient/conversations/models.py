@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 from accounts.models import User
 
 class Patient(models.Model):
@@ -15,33 +17,111 @@ class Patient(models.Model):
     def __str__(self):
         return self.name
 
+class VirtualPatient(models.Model):
+    """OSCE 虛擬病人案例：對話腳本與評分標準"""
+    name = models.CharField(max_length=100, unique=True)
+    description = models.TextField()
+    dialog_json = models.JSONField(default=list)  # 對話腳本（觸發語句、標準回覆等）
+    scoring_json = models.JSONField(default=list)  # 評分標準
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        app_label = 'conversations'
+    
+    def __str__(self):
+        return self.name
+
+class DialogVersion(models.Model):
+    """對話開始時所用病例對話的快照，按 (虛擬病人, 索引版本) 只保存一份
+
+    病例更新或進程重啟後，進行中的對話以它重建對話開始時版本的索引。
+    """
+    virtual_patient = models.ForeignKey(VirtualPatient, on_delete=models.CASCADE, related_name='dialog_versions')
+    version = models.CharField(max_length=16)  # 對話 JSON 的內容雜湊，與 Conversation.index_version 相同
+    dialog_json = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        app_label = 'conversations'
+        unique_together = ['virtual_patient', 'version']
+    
+    def __str__(self):
+        return f"{self.virtual_patient.name} - {self.version}"
+
 class Conversation(models.Model):
     """用戶與虛擬病人的對話會話"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations')
-    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='conversations')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='conversations', null=True, blank=True)
+    virtual_patient = models.ForeignKey(VirtualPatient, on_delete=models.CASCADE, related_name='conversations', null=True, blank=True)
     title = models.CharField(max_length=200, blank=True)
     score = models.IntegerField(default=0)  # 用戶在此對話中的得分
     feedback = models.TextField(blank=True)  # 系統對此對話的評價
+    # 每輪評分後增量更新的匯總，結束對話時不需再讀取全部消息
+    turn_count = models.IntegerField(default=0)  # 學生提問輪數
+    score_total = models.IntegerField(default=0)  # 學生提問得分總和
+    category_scores = models.JSONField(default=dict, blank=True)  # 分類 -> 得分
+    criteria_coverage = models.JSONField(default=dict, blank=True)  # 評分項目ID -> {得分, 細項}
+    index_version = models.CharField(max_length=16, blank=True)  # 對話開始時的病例索引版本，病例更新後仍沿用
+    completed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
-        return f"{self.user.username} - {self.patient.name} - {self.created_at.strftime('%Y-%m-%d')}"
+        patient = self.virtual_patient or self.patient
+        return f"{self.user.username} - {patient.name if patient else ''} - {self.created_at.strftime('%Y-%m-%d')}"
 
     class Meta:
         app_label = 'conversations'
+    
+    @property
+    def average_score(self):
+        """每輪提問的平均得分"""
+        return self.score_total / self.turn_count if self.turn_count else 0
+    
+    def record_turn(self, score, category_scores, criteria_coverage):
+        """累加一輪學生提問的得分
+
+        輪數與總分以 F 表達式原子累加；分類得分和覆蓋情況為評分引擎的完整快照，直接覆蓋。
+        """
+        Conversation.objects.filter(pk=self.pk).update(
+            turn_count=F('turn_count') + 1,
+            score_total=F('score_total') + score,
+            category_scores=category_scores,
+            criteria_coverage=criteria_coverage,
+            updated_at=timezone.now(),
+        )
+        self.turn_count += 1
+        self.score_total += score
+        self.category_scores = category_scores
+        self.criteria_coverage = criteria_coverage
+    
+    def finalize(self, breakdown):
+        """結束對話：寫入平均分，並一次批量插入各評分項目的明細"""
+        with transaction.atomic():
+            self.score = round(self.average_score)
+            self.completed_at = timezone.now()
+            self.save(update_fields=['score', 'completed_at', 'updated_at'])
+            ScoreItem.objects.filter(conversation=self).delete()
+            ScoreItem.objects.bulk_create([ScoreItem(conversation=self, **item) for item in breakdown])
 
 class Message(models.Model):
     """對話中的單條消息"""
-    SENDER_CHOICES = (
-        ('user', '用戶'),
-        ('patient', '虛擬病人'),
-        ('system', '系統'),
+    STUDENT = 'user'
+    PATIENT = 'patient'
+    SYSTEM = 'system'
+    ROLE_CHOICES = (
+        (STUDENT, '用戶'),
+        (PATIENT, '虛擬病人'),
+        (SYSTEM, '系統'),
     )
     
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
-    sender = models.CharField(max_length=10, choices=SENDER_CHOICES)
+    role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
+    score = models.IntegerField(null=True, blank=True)  # 學生提問的得分
+    feedback = models.TextField(blank=True)
+    matched_criteria = models.JSONField(default=list, blank=True)  # 命中的評分項目及細項，供重建對話狀態
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -49,4 +129,52 @@ class Message(models.Model):
         ordering = ['created_at']
     
     def __str__(self):
-        return f"{self.sender}: {self.content[:50]}"
+        return f"{self.role}: {self.content[:50]}"
+
+class ScoreItem(models.Model):
+    """對話結束時每個評分項目的得分明細"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='score_items')
+    category = models.CharField(max_length=100)
+    criterion_id = models.CharField(max_length=200)
+    name = models.CharField(max_length=200)
+    score = models.IntegerField(default=0)
+    max_score = models.IntegerField(default=0)
+    completed = models.BooleanField(default=False)
+    sub_items = models.JSONField(default=list, blank=True)  # 全部細項
+    covered_sub_items = models.JSONField(default=list, blank=True)  # 已問到的細項
+    
+    class Meta:
+        app_label = 'conversations'
+    
+    def __str__(self):
+        return f"{self.category} - {self.name}: {self.score}/{self.max_score}"
+
+
+class ScoringJob(models.Model):
+    """待評分的學生消息（數據庫隊列，由 run_scoring_worker 處理）"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, '等待中'),
+        (RUNNING, '處理中'),
+        (DONE, '已完成'),
+        (FAILED, '失敗'),
+    )
+    
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='scoring_jobs')
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='scoring_job')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    claimed_at = models.DateTimeField(null=True, blank=True)  # 領取時間，超過租約仍在處理中視為 worker 已退出
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        app_label = 'conversations'
+        indexes = [models.Index(fields=['status', 'id'])]
+    
+    def __str__(self):
+        return f"{self.conversation_id} - {self.message_id}: {self.status}"
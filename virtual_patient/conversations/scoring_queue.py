@@ -0,0 +1,257 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from rag.rubric import get_compiled_rubric
+from rag.scoring import ScoreEngine
+
+logger = logging.getLogger(__name__)
+
+
+def score_feedback(score_result):
+    """根據評分結果生成消息上的反饋文字"""
+    feedback = f"相似度: {score_result['similarity']:.2f}"
+    if score_result['hits']:
+        feedback += f"\n匹配問題: {'、'.join(hit['id'] for hit in score_result['hits'])}"
+    return feedback
+
+
+def score_fields(score_result):
+    """評分結果對應的 Message 欄位"""
+    return {
+        'score': score_result['score'],
+        'feedback': score_feedback(score_result),
+        'matched_criteria': [
+            {'id': hit['id'], 'sub_items': hit['sub_items']} for hit in score_result['hits']
+        ],
+    }
+
+
+def build_score_engine(conversation):
+    """根據對話上保存的覆蓋情況恢復評分狀態"""
+    score_engine = ScoreEngine(get_compiled_rubric(conversation.virtual_patient.scoring_json))
+    score_engine.replay([
+        {'id': criterion_id, 'sub_items': covered.get('sub_items', [])}
+        for criterion_id, covered in conversation.criteria_coverage.items()
+    ])
+    return score_engine
+
+
+def score_message(message_id):
+    """為一條學生消息評分並累加對話的得分匯總
+
+    評分狀態從對話上保存的覆蓋情況恢復，不依賴會話存儲中的處理器，
+    因此進程內線程與獨立 worker 進程的結果一致。已評分的消息直接跳過。
+    """
+    from .models import Conversation, Message
+
+    with transaction.atomic():
+        message = Message.objects.get(pk=message_id)
+        # 鎖住對話行，同一對話的評分依次進行
+        conversation = Conversation.objects.select_for_update().select_related('virtual_patient').get(pk=message.conversation_id)
+        message.refresh_from_db(fields=['score'])
+        if message.score is not None:
+            return message
+
+        score_engine = build_score_engine(conversation)
+        score_result = score_engine.score_response(message.content)
+
+        fields = score_fields(score_result)
+        for name, value in fields.items():
+            setattr(message, name, value)
+        message.save(update_fields=list(fields))
+        conversation.record_turn(
+            score_result['score'],
+            score_engine.category_scores(),
+            score_engine.coverage()
+        )
+    return message
+
+
+class BaseScoringQueue:
+    """評分隊列的基類"""
+
+    def __init__(self, job=score_message):
+        self.job = job
+
+    def enqueue(self, conversation_id, message_id):
+        """在保存消息的事務內調用，提交後安排評分"""
+        raise NotImplementedError
+
+    def wait(self, conversation_id, timeout=None):
+        """等待對話的所有評分任務完成，全部完成時返回 True"""
+        raise NotImplementedError
+
+
+class ImmediateScoringQueue(BaseScoringQueue):
+    """同步評分（開發與測試用）"""
+
+    def enqueue(self, conversation_id, message_id):
+        self.job(message_id)
+
+    def wait(self, conversation_id, timeout=None):
+        return True
+
+
+class LocalScoringQueue(BaseScoringQueue):
+    """進程內線程池評分
+
+    同一對話的任務串行執行（後一個任務等待前一個完成），不同對話並行。
+    wait 只能看到本進程提交的任務：多個 worker 進程部署時，結束對話可能在其他進程
+    仍有未評分的消息時就完成結算，此時應改用 DatabaseScoringQueue。
+    """
+
+    def __init__(self, max_workers=2, job=score_message):
+        super().__init__(job)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scoring')
+        self._tails = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, conversation_id, message_id):
+        # 事務提交後工作線程才能讀到消息
+        transaction.on_commit(lambda: self.submit(conversation_id, message_id))
+
+    def submit(self, conversation_id, message_id):
+        with self._lock:
+            previous = self._tails.get(conversation_id)
+            future = self.executor.submit(self._run, previous, message_id)
+            self._tails[conversation_id] = future
+        future.add_done_callback(lambda done: self._forget(conversation_id, done))
+        return future
+
+    def _run(self, previous, message_id):
+        # 前一個任務在線程池隊列中排在前面，等待它不會造成死鎖
+        if previous is not None:
+            wait([previous])
+        try:
+            return self.job(message_id)
+        except Exception:
+            logger.exception('評分失敗: 消息 %s', message_id)
+            raise
+        finally:
+            close_old_connections()
+
+    def _forget(self, conversation_id, future):
+        with self._lock:
+            if self._tails.get(conversation_id) is future:
+                del self._tails[conversation_id]
+
+    def wait(self, conversation_id, timeout=None):
+        with self._lock:
+            future = self._tails.get(conversation_id)
+        if future is None:
+            return True
+        done, _ = wait([future], timeout=timeout)
+        return bool(done)
+
+
+class DatabaseScoringQueue(BaseScoringQueue):
+    """數據庫隊列：消息與評分任務在同一事務寫入，由 run_scoring_worker 進程處理
+
+    領取任務時記錄 claimed_at；處理中超過 lease 秒的任務視為 worker 已退出，
+    下次領取時放回等待中重試，達到 max_attempts 次後標記為失敗。
+    """
+
+    def __init__(self, poll_interval=0.2, max_attempts=3, lease=300, job=score_message):
+        super().__init__(job)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease = lease
+
+    def enqueue(self, conversation_id, message_id):
+        from .models import ScoringJob
+
+        ScoringJob.objects.create(conversation_id=conversation_id, message_id=message_id)
+
+    def pending(self, conversation_id=None):
+        from .models import ScoringJob
+
+        jobs = ScoringJob.objects.filter(status__in=[ScoringJob.PENDING, ScoringJob.RUNNING])
+        if conversation_id is not None:
+            jobs = jobs.filter(conversation_id=conversation_id)
+        return jobs
+
+    def wait(self, conversation_id, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending(conversation_id).exists():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def reclaim_expired(self):
+        """把租約已過期的處理中任務放回等待中，已用完重試次數的標記為失敗，返回處理的任務數"""
+        from .models import ScoringJob
+
+        expired = ScoringJob.objects.filter(status=ScoringJob.RUNNING, claimed_at__lt=timezone.now() - timedelta(seconds=self.lease))
+        failed = expired.filter(attempts__gte=self.max_attempts).update(
+            status=ScoringJob.FAILED, error='處理超時，worker 可能已退出', updated_at=timezone.now()
+        )
+        retried = expired.filter(attempts__lt=self.max_attempts).update(
+            status=ScoringJob.PENDING, updated_at=timezone.now()
+        )
+        if failed or retried:
+            logger.warning('評分任務租約過期: 重試 %s 個，失敗 %s 個', retried, failed)
+        return failed + retried
+
+    def claim(self):
+        """按順序領取一個任務；同一對話已有任務在處理時跳過該對話"""
+        from .models import ScoringJob
+
+        self.reclaim_expired()
+        running = ScoringJob.objects.filter(status=ScoringJob.RUNNING).values('conversation_id')
+        candidates = ScoringJob.objects.filter(status=ScoringJob.PENDING).exclude(conversation_id__in=running).order_by('id')
+        for job in candidates[:10]:
+            # 條件更新保證多個 worker 不會領到同一任務
+            claimed_at = timezone.now()
+            claimed = ScoringJob.objects.filter(pk=job.pk, status=ScoringJob.PENDING).update(
+                status=ScoringJob.RUNNING, attempts=job.attempts + 1, claimed_at=claimed_at
+            )
+            if claimed:
+                job.status = ScoringJob.RUNNING
+                job.attempts += 1
+                job.claimed_at = claimed_at
+                return job
+        return None
+
+    def process_one(self):
+        """處理一個任務，沒有待處理任務時返回 None"""
+        from .models import ScoringJob
+
+        job = self.claim()
+        if job is None:
+            return None
+        try:
+            self.job(job.message_id)
+        except Exception as error:
+            logger.exception('評分失敗: 消息 %s', job.message_id)
+            job.status = ScoringJob.FAILED if job.attempts >= self.max_attempts else ScoringJob.PENDING
+            job.error = str(error)
+        else:
+            job.status = ScoringJob.DONE
+            job.error = ''
+        job.save(update_fields=['status', 'error', 'updated_at'])
+        return job
+
+
+_scoring_queue = None
+_scoring_queue_lock = threading.Lock()
+
+
+def get_scoring_queue():
+    """根據 CONVERSATION_SCORING_QUEUE 設定建立評分隊列（進程內單例）"""
+    global _scoring_queue
+    if _scoring_queue is None:
+        with _scoring_queue_lock:
+            if _scoring_queue is None:
+                config = getattr(settings, 'CONVERSATION_SCORING_QUEUE', {})
+                backend = import_string(config.get('BACKEND', 'conversations.scoring_queue.LocalScoringQueue'))
+                _scoring_queue = backend(**config.get('OPTIONS', {}))
+    return _scoring_queue
@@ -1,21 +1,41 @@
 from rest_framework import serializers
-from .models import Patient, Conversation, Message
+from .models import Patient, VirtualPatient, Conversation, Message, ScoreItem
 
 class PatientSerializer(serializers.ModelSerializer):
     class Meta:
         model = Patient
         fields = '__all__'
 
+class VirtualPatientSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = VirtualPatient
+        fields = ['id', 'name', 'description', 'created_at', 'updated_at']
+
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ['id', 'sender', 'content', 'created_at']
-        read_only_fields = ['id', 'created_at']
+        fields = ['id', 'role', 'content', 'score', 'feedback', 'created_at']
+        read_only_fields = ['id', 'score', 'feedback', 'created_at']
+
+class ScoreItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ScoreItem
+        fields = ['category', 'criterion_id', 'name', 'score', 'max_score', 'completed', 'sub_items', 'covered_sub_items']
+
+class RunningScoreSerializer(serializers.ModelSerializer):
+    average_score = serializers.FloatField(read_only=True)
+    
+    class Meta:
+        model = Conversation
+        fields = ['id', 'turn_count', 'score_total', 'average_score', 'category_scores', 'completed_at']
+        read_only_fields = fields
 
 class ConversationSerializer(serializers.ModelSerializer):
     messages = MessageSerializer(many=True, read_only=True)
+    score_items = ScoreItemSerializer(many=True, read_only=True)
+    average_score = serializers.FloatField(read_only=True)
     
     class Meta:
         model = Conversation
-        fields = ['id', 'user', 'patient', 'title', 'score', 'feedback', 'created_at', 'updated_at', 'messages']
-        read_only_fields = ['id', 'created_at', 'updated_at'] 
\ No newline at end of file
+        fields = ['id', 'user', 'patient', 'virtual_patient', 'title', 'score', 'feedback', 'turn_count', 'score_total', 'average_score', 'category_scores', 'criteria_coverage', 'completed_at', 'created_at', 'updated_at', 'messages', 'score_items']
+        read_only_fields = ['id', 'user', 'turn_count', 'score_total', 'category_scores', 'criteria_coverage', 'created_at', 'updated_at'] 
\ No newline at end of file
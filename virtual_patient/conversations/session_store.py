@@ -0,0 +1,183 @@
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class BaseSessionStore:
+    """對話處理器存儲的基類"""
+
+    def get(self, conversation_id):
+        """取得對話處理器，不存在或已過期時返回 None"""
+        raise NotImplementedError
+
+    def set(self, conversation_id, handler):
+        """保存對話處理器（每輪對話後調用以持久化狀態）"""
+        raise NotImplementedError
+
+    def delete(self, conversation_id):
+        raise NotImplementedError
+
+    def __contains__(self, conversation_id):
+        return self.get(conversation_id) is not None
+
+
+class LocalMemorySessionStore(BaseSessionStore):
+    """進程內 LRU + TTL 存儲，條目數上限控制常駐內存"""
+
+    def __init__(self, max_entries=1000, ttl=3600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id):
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return None
+            handler, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[conversation_id]
+                return None
+            self._entries[conversation_id] = (handler, self.clock() + self.ttl)
+            self._entries.move_to_end(conversation_id)
+            return handler
+
+    def set(self, conversation_id, handler):
+        with self._lock:
+            self._entries[conversation_id] = (handler, self.clock() + self.ttl)
+            self._entries.move_to_end(conversation_id)
+            self._evict()
+
+    def delete(self, conversation_id):
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+
+    def _evict(self):
+        now = self.clock()
+        expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteSessionStore(BaseSessionStore):
+    """以 SQLite 文件保存對話狀態，供同一主機上的多個 worker 共享
+
+    只保存 ConversationHandler.to_state() 的小型狀態，
+    病人索引由各 worker 的共享緩存提供。
+    每次保存狀態時寫入新的修訂號；進程內以 (對話ID, 修訂號) 緩存已重建的處理器（LRU，cache_size 條），
+    修訂號未變（沒有其他 worker 寫過）時直接返回，不再重建。
+    """
+
+    def __init__(self, path, ttl=3600, handler_class='conversations.handlers.ConversationHandler', clock=time.time,
+                 cache_size=1000):
+        self.path = str(path)
+        self.ttl = ttl
+        self.clock = clock
+        self.handler_class = import_string(handler_class) if isinstance(handler_class, str) else handler_class
+        self.cache_size = cache_size
+        self._handlers = OrderedDict()  # 對話ID -> (修訂號, 處理器)
+        self._handlers_lock = threading.Lock()
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS conversation_sessions ('
+                "conversation_id INTEGER PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL, revision TEXT NOT NULL DEFAULT '')"
+            )
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(conversation_sessions)')}
+            if 'revision' not in columns:
+                conn.execute("ALTER TABLE conversation_sessions ADD COLUMN revision TEXT NOT NULL DEFAULT ''")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, conversation_id):
+        conn = self._connection()
+        row = conn.execute(
+            'SELECT revision, expires_at FROM conversation_sessions WHERE conversation_id = ?',
+            (conversation_id,),
+        ).fetchone()
+        if row is None:
+            self._forget(conversation_id)
+            return None
+        revision, expires_at = row
+        if expires_at <= self.clock():
+            self.delete(conversation_id)
+            return None
+
+        with self._handlers_lock:
+            cached = self._handlers.get(conversation_id)
+            if cached is not None and cached[0] == revision:
+                self._handlers.move_to_end(conversation_id)
+                return cached[1]
+
+        row = conn.execute(
+            'SELECT state, revision FROM conversation_sessions WHERE conversation_id = ?',
+            (conversation_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        state, revision = row
+        handler = self.handler_class.from_state(conversation_id, json.loads(state))
+        self._remember(conversation_id, revision, handler)
+        return handler
+
+    def set(self, conversation_id, handler):
+        now = self.clock()
+        revision = secrets.token_hex(8)
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO conversation_sessions (conversation_id, state, expires_at, revision) VALUES (?, ?, ?, ?)',
+                (conversation_id, json.dumps(handler.to_state(), ensure_ascii=False), now + self.ttl, revision),
+            )
+            conn.execute('DELETE FROM conversation_sessions WHERE expires_at <= ?', (now,))
+        self._remember(conversation_id, revision, handler)
+
+    def delete(self, conversation_id):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM conversation_sessions WHERE conversation_id = ?', (conversation_id,))
+        self._forget(conversation_id)
+
+    def _remember(self, conversation_id, revision, handler):
+        with self._handlers_lock:
+            self._handlers[conversation_id] = (revision, handler)
+            self._handlers.move_to_end(conversation_id)
+            while len(self._handlers) > self.cache_size:
+                self._handlers.popitem(last=False)
+
+    def _forget(self, conversation_id):
+        with self._handlers_lock:
+            self._handlers.pop(conversation_id, None)
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """根據 CONVERSATION_SESSION_STORE 設定建立會話存儲（進程內單例）"""
+    global _session_store
+    if _session_store is None:
+        with _session_store_lock:
+            if _session_store is None:
+                config = getattr(settings, 'CONVERSATION_SESSION_STORE', {})
+                backend = import_string(config.get('BACKEND', 'conversations.session_store.LocalMemorySessionStore'))
+                _session_store = backend(**config.get('OPTIONS', {}))
+    return _session_store
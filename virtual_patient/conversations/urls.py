@@ -1,9 +1,19 @@
-from django.urls import path
-from .views import PatientListView, ConversationListView, ConversationDetailView, MessageView
+from django.urls import path, include
+from rest_framework.routers import DefaultRouter
+from .views import (
+    VirtualPatientViewSet, ConversationViewSet,
+    start_conversation_async, send_message_async, stream_message_async, end_conversation_async,
+)
+
+router = DefaultRouter()
+router.register(r'patients', VirtualPatientViewSet, basename='virtual-patient')
+router.register(r'', ConversationViewSet, basename='conversation')
 
 urlpatterns = [
-    path('patients/', PatientListView.as_view(), name='patient-list'),
-    path('', ConversationListView.as_view(), name='conversation-list'),
-    path('<int:pk>/', ConversationDetailView.as_view(), name='conversation-detail'),
-    path('<int:conversation_id>/messages/', MessageView.as_view(), name='message-create'),
-] 
\ No newline at end of file
+    # 原生異步端點（以 ASGI 運行時不佔用 worker 線程）
+    path('async/patients/<int:pk>/start/', start_conversation_async, name='async-start-conversation'),
+    path('async/<int:pk>/send/', send_message_async, name='async-send-message'),
+    path('async/<int:pk>/stream/', stream_message_async, name='async-stream-message'),
+    path('async/<int:pk>/end/', end_conversation_async, name='async-end-conversation'),
+    path('', include(router.urls)),
+]
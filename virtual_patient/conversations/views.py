@@ -1,16 +1,159 @@
 from rest_framework import viewsets, permissions, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from .models import VirtualPatient, Conversation, Message
-from .serializers import VirtualPatientSerializer, ConversationSerializer, MessageSerializer
-from rag.scoring import ScoreEngine
-from rag.vector_store import VectorStore
-from rag.dialog_generator import DialogGenerator
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from .models import VirtualPatient, Conversation, DialogVersion, Message
+from rag.dialog_items import dialog_items
+from rag.embeddings import get_encoder
+from rag.generative import get_generative_client
+from rag.patient_index import patient_indexes
+from rag.phrase_table import get_phrase_table
+from rag.rubric import get_compiled_rubric
+from .serializers import VirtualPatientSerializer, ConversationSerializer, MessageSerializer, RunningScoreSerializer
+from .handlers import ConversationHandler, elapsed_ms, get_or_rehydrate_handler, get_turn_executor, timed
+from .session_store import get_session_store
+from .scoring_queue import build_score_engine, get_scoring_queue, score_fields, score_message
+import asyncio
+import concurrent.futures
+import functools
 import json
-from django.utils import timezone
+import time
 
-# 全局變量存儲對話生成器和向量存儲
-conversation_handlers = {}
+# 對話處理器存儲（由 CONVERSATION_SESSION_STORE 設定後端）
+conversation_handlers = get_session_store()
+
+# 學生消息的評分隊列（由 CONVERSATION_SCORING_QUEUE 設定後端）
+scoring_queue = get_scoring_queue()
+SCORING_WAIT_TIMEOUT = 30  # 結束對話時等待評分完成的最長秒數
+SCORING_MODE = getattr(settings, 'CONVERSATION_SCORING_MODE', 'queue')  # 'queue' 或 'sync'
+
+def parse_since(params):
+    """解析 ?since=<消息ID> 參數"""
+    since = params.get('since')
+    if since is None:
+        return None
+    try:
+        return int(since)
+    except ValueError:
+        raise ValidationError({"since": "必須是消息ID"})
+
+def turn_payload(conversation, messages, timings=None):
+    """增量響應：新消息加上對話目前的得分匯總，以及本輪各階段耗時（毫秒）"""
+    payload = {
+        'messages': MessageSerializer(messages, many=True).data,
+        'score': RunningScoreSerializer(conversation).data,
+    }
+    if timings is not None:
+        payload['timings'] = timings
+    return payload
+
+def record_index_version(conversation, handler):
+    """記錄對話使用的索引版本並保存該版本的對話快照，病例更新或重啟後重建處理器時仍使用這個版本"""
+    index = handler.patient_index
+    DialogVersion.objects.get_or_create(
+        virtual_patient_id=conversation.virtual_patient_id,
+        version=index.version,
+        defaults={'dialog_json': index.dialog_json},
+    )
+    Conversation.objects.filter(pk=conversation.pk).update(index_version=index.version)
+    conversation.index_version = index.version
+
+def send_welcome_message(conversation, virtual_patient):
+    """以對話腳本的第一句作為虛擬病人的歡迎消息"""
+    items = dialog_items(virtual_patient.dialog_json)
+    if items and items[0]['triggers']:
+        Message.objects.create(
+            conversation=conversation,
+            role=Message.PATIENT,
+            content=items[0]['triggers'][0]
+        )
+
+SCORE_FIELDS = ['turn_count', 'score_total', 'category_scores', 'criteria_coverage']
+
+def sync_score_engine(conversation):
+    """同步評分前先等待這個對話排隊中的評分任務，再從最新的覆蓋情況恢復評分狀態"""
+    scoring_queue.wait(conversation.id, timeout=SCORING_WAIT_TIMEOUT)
+    conversation.refresh_from_db(fields=SCORE_FIELDS)
+    return build_score_engine(conversation)
+
+def save_turn(conversation, content, patient_response, score_engine=None, score_result=None):
+    """一個事務內批量插入學生與病人消息
+
+    同步評分時鎖住對話行再累加得分匯總；評分開始後覆蓋情況已被其他評分改動時，
+    按最新狀態重新評分（與 score_message 相同），以免覆蓋其他輪的結果或重複計分。
+    否則登記評分任務。返回新增的兩條消息。
+    """
+    with transaction.atomic():
+        sync_scoring = score_result is not None
+        if sync_scoring:
+            locked = Conversation.objects.select_for_update().get(pk=conversation.pk)
+            if locked.criteria_coverage != conversation.criteria_coverage:
+                score_result = None
+        new_messages = Message.objects.bulk_create([
+            Message(
+                conversation=conversation,
+                role=Message.STUDENT,
+                content=content,
+                **(score_fields(score_result) if score_result else {})
+            ),
+            Message(
+                conversation=conversation,
+                role=Message.PATIENT,
+                content=patient_response
+            ),
+        ])
+        if score_result:
+            conversation.record_turn(
+                score_result['score'],
+                score_engine.category_scores(),
+                score_engine.coverage()
+            )
+        elif sync_scoring:
+            new_messages[0] = score_message(new_messages[0].id)
+        else:
+            scoring_queue.enqueue(conversation.id, new_messages[0].id)
+    if sync_scoring:
+        conversation.refresh_from_db(fields=SCORE_FIELDS)
+    return new_messages
+
+def finalize_conversation(conversation):
+    """得分匯總已在每輪增量更新，這裡只寫入平均分和評分明細
+
+    鎖住對話行後重新讀取，已結束的對話不再寫入，並發的結束請求只有一個會生效。
+    返回是否由這次調用結束對話。
+    """
+    with transaction.atomic():
+        Conversation.objects.select_for_update().only('id').get(pk=conversation.pk)
+        conversation.refresh_from_db()
+        if conversation.completed_at is not None:
+            return False
+        breakdown = []
+        if conversation.virtual_patient:
+            rubric = get_compiled_rubric(conversation.virtual_patient.scoring_json)
+            breakdown = rubric.breakdown(conversation.criteria_coverage)
+        conversation.finalize(breakdown)
+    return True
+
+def runtime_stats():
+    """收集本進程各共享組件的統計；各 worker 進程分別計數"""
+    stats = {'retrieval': patient_indexes.retrieval_stats()}
+    encoder = get_encoder()
+    if hasattr(encoder, 'stats'):
+        stats['embedding_cache'] = encoder.stats()
+    if getattr(settings, 'RAG_SHARED_PHRASE_TABLE', False):
+        stats['phrase_table'] = get_phrase_table().stats()
+    client = get_generative_client()
+    if client is not None:
+        stats['generative'] = client.stats()
+    return stats
 
 class VirtualPatientViewSet(viewsets.ModelViewSet):
     queryset = VirtualPatient.objects.all()
@@ -27,41 +170,24 @@ class VirtualPatientViewSet(viewsets.ModelViewSet):
             virtual_patient=virtual_patient
         )
         
-        # 初始化對話處理器
-        vector_store = VectorStore()
-        dialog_data = virtual_patient.dialog_json
-        
-        # 為對話問題創建向量索引
-        questions = [item['question'] for item in dialog_data]
-        vector_store.add_collection("dialog_questions", questions)
-        
-        # 加載評分標準
-        scoring_criteria = virtual_patient.scoring_json
-        score_engine = ScoreEngine()
-        score_engine.load_criteria(scoring_criteria, f"patient_{conversation.id}")
-        
-        # 創建對話生成器
-        dialog_generator = DialogGenerator(dialog_data)
+        # 初始化對話處理器（病人檢索索引為共享的唯讀索引，同一版本只構建一次）
+        handler = ConversationHandler.create(conversation.id, virtual_patient)
+        record_index_version(conversation, handler)
         
         # 存儲對話處理器
-        conversation_handlers[conversation.id] = {
-            'vector_store': vector_store,
-            'score_engine': score_engine,
-            'dialog_generator': dialog_generator
-        }
+        conversation_handlers.set(conversation.id, handler)
         
         # 發送歡迎消息
-        if dialog_data and len(dialog_data) > 0:
-            welcome_message = dialog_data[0]['question']
-            Message.objects.create(
-                conversation=conversation,
-                role=Message.PATIENT,
-                content=welcome_message
-            )
+        send_welcome_message(conversation, virtual_patient)
         
         # 返回對話信息
         serializer = ConversationSerializer(conversation)
         return Response(serializer.data)
+    
+    @action(detail=False, methods=['get'], permission_classes=[permissions.IsAdminUser])
+    def stats(self, request):
+        """本進程的檢索、嵌入緩存、共享語句表與生成服務統計（僅管理員）"""
+        return Response(runtime_stats())
 
 class ConversationViewSet(viewsets.ModelViewSet):
     serializer_class = ConversationSerializer
@@ -69,84 +195,289 @@ class ConversationViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return Conversation.objects.filter(user=self.request.user)
     
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+    
     @action(detail=True, methods=['post'])
     def send_message(self, request, pk=None):
         """發送消息到對話"""
         conversation = self.get_object()
         content = request.data.get('content', '')
         
+        if conversation.completed_at:
+            return Response(
+                {"error": "對話已結束"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
         if not content:
             return Response(
                 {"error": "消息內容不能為空"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # 獲取對話處理器
-        handler = conversation_handlers.get(conversation.id)
+        # 獲取對話處理器（不在存儲中時從消息記錄重建）
+        handler = get_or_rehydrate_handler(conversation, conversation_handlers)
         if not handler:
             return Response(
                 {"error": "對話會話已過期，請重新開始"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # 創建學生消息
-        student_message = Message.objects.create(
-            conversation=conversation,
-            role=Message.STUDENT,
-            content=content
-        )
-        
-        # 評分回答
-        score_result = handler['score_engine'].score_response(
-            content, 
-            f"patient_{conversation.id}"
-        )
-        
-        # 更新消息評分
-        student_message.score = score_result['score']
-        feedback = f"相似度: {score_result['similarity']:.2f}"
-        if score_result['matched_criteria']:
-            feedback += f"\n匹配問題: {score_result['matched_criteria']}"
-        student_message.feedback = feedback
-        student_message.save()
+        # 考試模式（?scoring=sync）需要立即得到評分：共享查詢嵌入，檢索與評分並行；
+        # 其餘情況評分在後台隊列進行，學生不必等待評分就能得到病人回覆
+        sync_scoring = request.query_params.get('scoring', SCORING_MODE) == 'sync'
+        score_engine = score_result = None
+        if sync_scoring:
+            score_engine = sync_score_engine(conversation)
+            patient_response, score_result, timings = handler.run_turn(content, score_engine)
+        else:
+            patient_response, timings = handler.respond(content)
         
-        # 獲取虛擬病人的回應
-        patient_response = handler['dialog_generator'].get_response(
-            content, 
-            handler['vector_store']
-        )
+        new_messages = save_turn(conversation, content, patient_response, score_engine, score_result)
         
-        # 創建虛擬病人消息
-        patient_message = Message.objects.create(
-            conversation=conversation,
-            role=Message.PATIENT,
-            content=patient_response
-        )
+        # 保存更新後的對話狀態
+        conversation_handlers.set(conversation.id, handler)
         
-        # 返回對話
-        serializer = ConversationSerializer(conversation)
-        return Response(serializer.data)
+        # 只返回新消息和已完成評分的得分匯總；重新連線的客戶端可用 ?since=<消息ID> 補齊之前漏掉的消息
+        since = parse_since(request.query_params)
+        if since is not None:
+            new_messages = conversation.messages.filter(id__gt=since).order_by('id')
+        return Response(turn_payload(conversation, new_messages, timings))
+    
+    @action(detail=True, methods=['get'])
+    def messages(self, request, pk=None):
+        """取得消息ID大於 since 的消息及目前的得分匯總"""
+        conversation = self.get_object()
+        new_messages = conversation.messages.order_by('id')
+        since = parse_since(request.query_params)
+        if since is not None:
+            new_messages = new_messages.filter(id__gt=since)
+        return Response(turn_payload(conversation, new_messages))
     
     @action(detail=True, methods=['post'])
     def end_conversation(self, request, pk=None):
         """結束對話"""
         conversation = self.get_object()
         
-        # 計算總分
-        messages = Message.objects.filter(
-            conversation=conversation,
-            role=Message.STUDENT
-        )
-        total_score = sum(m.score or 0 for m in messages)
-        avg_score = total_score / len(messages) if messages else 0
+        if conversation.completed_at:
+            return Response(ConversationSerializer(conversation).data)
         
-        # 更新對話
-        conversation.score = avg_score
-        conversation.completed_at = timezone.now()
-        conversation.save()
+        # 只等待這個對話尚未完成的評分任務
+        if not scoring_queue.wait(conversation.id, timeout=SCORING_WAIT_TIMEOUT):
+            return Response(
+                {"error": "評分尚未完成，請稍後再試"}, 
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        finalize_conversation(conversation)
         
         # 清理處理器
-        if conversation.id in conversation_handlers:
-            del conversation_handlers[conversation.id]
+        conversation_handlers.delete(conversation.id)
         
-        return Response(ConversationSerializer(conversation).data)
\ No newline at end of file
+        return Response(ConversationSerializer(conversation).data)
+
+
+# 原生異步視圖（ASGI）：CPU 密集的嵌入與相似度計算放到線程池，數據庫操作使用異步 ORM，
+# 等待期間不佔用 worker 線程，一個 uvicorn worker 可同時服務大量對話
+
+async def authenticate_async(request):
+    """以 JWT 驗證異步視圖的請求，失敗時返回 None"""
+    try:
+        result = await sync_to_async(JWTAuthentication().authenticate)(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+def async_endpoint(view):
+    """異步視圖的共同處理：只接受 POST、JWT 驗證"""
+    @csrf_exempt
+    @require_POST
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await authenticate_async(request)
+        if user is None:
+            return JsonResponse({"error": "身份驗證失敗"}, status=401)
+        return await view(request, user, *args, **kwargs)
+    return wrapper
+
+def json_response(data, status=200):
+    return JsonResponse(data, status=status, json_dumps_params={'ensure_ascii': False})
+
+async def get_user_conversation(user, pk):
+    try:
+        return await Conversation.objects.select_related('virtual_patient').aget(pk=pk, user=user)
+    except Conversation.DoesNotExist:
+        return None
+
+@async_endpoint
+async def start_conversation_async(request, user, pk):
+    """開始與虛擬病人的對話（異步）"""
+    try:
+        virtual_patient = await VirtualPatient.objects.aget(pk=pk)
+    except VirtualPatient.DoesNotExist:
+        return json_response({"error": "虛擬病人不存在"}, status=404)
+    
+    conversation = await Conversation.objects.acreate(user=user, virtual_patient=virtual_patient)
+    
+    # 首次使用時構建病人索引和編譯評分標準，在線程池中進行
+    loop = asyncio.get_running_loop()
+    handler = await loop.run_in_executor(get_turn_executor(), ConversationHandler.create, conversation.id, virtual_patient)
+    await sync_to_async(record_index_version)(conversation, handler)
+    await sync_to_async(conversation_handlers.set)(conversation.id, handler)
+    await sync_to_async(send_welcome_message)(conversation, virtual_patient)
+    
+    data = await sync_to_async(lambda: ConversationSerializer(conversation).data)()
+    return json_response(data)
+
+async def prepare_turn(request, user, pk):
+    """異步發送消息的共同檢查，返回 (對話, 處理器, 消息內容, since, 錯誤響應)"""
+    conversation = await get_user_conversation(user, pk)
+    if conversation is None:
+        return None, None, None, None, json_response({"error": "對話不存在"}, status=404)
+    if conversation.completed_at:
+        return None, None, None, None, json_response({"error": "對話已結束"}, status=400)
+    
+    try:
+        content = json.loads(request.body or b'{}').get('content', '')
+        since = parse_since(request.GET)
+    except (ValueError, AttributeError):
+        return None, None, None, None, json_response({"error": "請求格式錯誤"}, status=400)
+    except ValidationError as error:
+        return None, None, None, None, json_response(error.detail, status=400)
+    if not content:
+        return None, None, None, None, json_response({"error": "消息內容不能為空"}, status=400)
+    
+    handler = await sync_to_async(get_or_rehydrate_handler)(conversation, conversation_handlers)
+    if not handler:
+        return None, None, None, None, json_response({"error": "對話會話已過期，請重新開始"}, status=400)
+    return conversation, handler, content, since, None
+
+@async_endpoint
+async def send_message_async(request, user, pk):
+    """發送消息到對話（異步）"""
+    conversation, handler, content, since, error = await prepare_turn(request, user, pk)
+    if error:
+        return error
+    
+    # 同步評分時檢索與評分作為兩個並行任務執行
+    score_engine = score_result = None
+    if request.GET.get('scoring', SCORING_MODE) == 'sync':
+        score_engine = await sync_to_async(sync_score_engine)(conversation)
+        patient_response, score_result, timings = await handler.arun_turn(content, score_engine)
+    else:
+        patient_response, timings = await handler.arespond(content)
+    
+    new_messages = await sync_to_async(save_turn)(conversation, content, patient_response, score_engine, score_result)
+    await sync_to_async(conversation_handlers.set)(conversation.id, handler)
+    
+    if since is not None:
+        new_messages = [message async for message in conversation.messages.filter(id__gt=since).order_by('id')]
+    return json_response(turn_payload(conversation, new_messages, timings))
+
+def close_stream(stream, pending=None):
+    """等待進行中的 next() 返回後關閉生成器，在線程池中執行"""
+    if pending is not None:
+        concurrent.futures.wait([pending])
+    stream.close()
+
+async def turn_events(conversation, handler, content, sync_scoring=False, since=None):
+    """執行一輪對話並逐個產生 (事件名, 數據)，供 SSE 與 WebSocket 共用
+
+    回覆片段一產生就產生 delta 事件；全部片段產生後保存消息，
+    最後以 done 事件返回已保存的消息、得分匯總和各階段耗時。同步評分與回覆並行進行。
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_turn_executor()
+    start = time.perf_counter()
+    timings = {}
+    
+    # 只有同步評分需要預先編碼；否則由混合檢索決定是否調用編碼器
+    score_engine = scoring = query_vector = None
+    keyword_matches = handler.match_keywords(content)
+    if sync_scoring:
+        query_vector = await loop.run_in_executor(executor, handler.embed_query, content)
+        timings['embed_ms'] = elapsed_ms(start)
+        score_engine = await sync_to_async(sync_score_engine)(conversation)
+        scoring = loop.run_in_executor(executor, timed, handler.score, content, score_engine, query_vector, keyword_matches)
+    
+    chunks = []
+    stream_start = time.perf_counter()
+    results = await loop.run_in_executor(executor, handler.retrieve, content, query_vector, keyword_matches)
+    stream = handler.dialog_generator.stream_response(content, handler.vector_store, results=results)
+    pending = None
+    try:
+        while True:
+            pending = executor.submit(next, stream, None)
+            chunk = await asyncio.wrap_future(pending)
+            if chunk is None:
+                break
+            if not chunks:
+                timings['first_chunk_ms'] = elapsed_ms(start)
+            chunks.append(chunk)
+            yield 'delta', {'text': chunk}
+    finally:
+        # 客戶端中途斷線時關閉回覆生成器，釋放生成服務的並發名額與連線
+        executor.submit(close_stream, stream, pending)
+    timings['retrieval_ms'] = elapsed_ms(stream_start)
+    
+    score_result = None
+    if scoring is not None:
+        score_result, timings['scoring_ms'] = await scoring
+    new_messages = await sync_to_async(save_turn)(conversation, content, ''.join(chunks), score_engine, score_result)
+    await sync_to_async(conversation_handlers.set)(conversation.id, handler)
+    timings['total_ms'] = elapsed_ms(start)
+    
+    if since is not None:
+        new_messages = [message async for message in conversation.messages.filter(id__gt=since).order_by('id')]
+    yield 'done', turn_payload(conversation, new_messages, timings)
+
+async def end_conversation_turns(conversation):
+    """等待評分任務後結束對話，返回 (響應數據, 狀態碼)"""
+    if conversation.completed_at is None:
+        # 等待評分任務時不佔用事件循環
+        done = await sync_to_async(scoring_queue.wait, thread_sensitive=False)(conversation.id, timeout=SCORING_WAIT_TIMEOUT)
+        if not done:
+            return {"error": "評分尚未完成，請稍後再試"}, 503
+        await sync_to_async(finalize_conversation)(conversation)
+        await sync_to_async(conversation_handlers.delete)(conversation.id)
+    
+    data = await sync_to_async(lambda: ConversationSerializer(conversation).data)()
+    return data, 200
+
+def sse_event(event, data):
+    """格式化一個 Server-Sent Events 事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, cls=DjangoJSONEncoder)}\n\n"
+
+@async_endpoint
+async def stream_message_async(request, user, pk):
+    """以 Server-Sent Events 串流虛擬病人的回覆
+
+    回覆片段一產生就以 delta 事件發送，首字時間不再取決於回覆長度；
+    最後以 done 事件返回已保存的消息ID、得分匯總和耗時。
+    """
+    conversation, handler, content, since, error = await prepare_turn(request, user, pk)
+    if error:
+        return error
+    sync_scoring = request.GET.get('scoring', SCORING_MODE) == 'sync'
+    
+    async def event_stream():
+        try:
+            async for name, data in turn_events(conversation, handler, content, sync_scoring, since):
+                yield sse_event(name, data)
+        except Exception as error:
+            yield sse_event('error', {'error': str(error)})
+            raise
+    
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # 關閉反向代理緩衝
+    return response
+
+@async_endpoint
+async def end_conversation_async(request, user, pk):
+    """結束對話（異步）"""
+    conversation = await get_user_conversation(user, pk)
+    if conversation is None:
+        return json_response({"error": "對話不存在"}, status=404)
+    
+    data, status_code = await end_conversation_turns(conversation)
+    return json_response(data, status=status_code)
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import re
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError
+
+from . import views
+from .handlers import get_or_rehydrate_handler
+from .models import Conversation, Message
+from .serializers import RunningScoreSerializer
+
+WEBSOCKET_PATH = re.compile(r'^/ws/conversations/(?P<pk>\d+)/$')
+AUTH_TIMEOUT = 10  # 連線後必須在此秒數內發送 auth 幀
+
+# 關閉碼
+CLOSE_NORMAL = 1000
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_NOT_FOUND = 4404
+
+
+def authenticate_token(raw_token):
+    """驗證 JWT access token，返回用戶或 None"""
+    authentication = JWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (AuthenticationFailed, TokenError):
+        return None
+
+
+class ConversationSocket:
+    """一個 WebSocket 連線上的對話
+
+    連線後只驗證一次（第一幀 {"type": "auth", "token": ...}），之後每輪對話只需解析一個幀：
+        {"type": "message", "content": ..., "scoring": "sync"}  發送一輪提問
+        {"type": "end"}                                          結束對話
+        {"type": "ping"}
+    服務端發送 delta（回覆片段）、reply（已保存的消息ID）、score（評分完成）、ended、error 幀。
+    """
+
+    def __init__(self, conversation_id, send):
+        self.conversation_id = conversation_id
+        self._send = send
+        self.conversation = None
+        self.handler = None
+        self.score_tasks = set()
+
+    async def send_json(self, data):
+        await self._send({'type': 'websocket.send', 'text': json.dumps(data, ensure_ascii=False, cls=DjangoJSONEncoder)})
+
+    async def send_error(self, error):
+        await self.send_json({'type': 'error', 'error': error})
+
+    async def authenticate(self, frame):
+        if frame.get('type') != 'auth':
+            await self.send_error('請先發送 auth 幀')
+            return False
+        user = await sync_to_async(authenticate_token)(frame.get('token', ''))
+        if user is None:
+            await self.send_error('身份驗證失敗')
+            return False
+        self.conversation = await views.get_user_conversation(user, self.conversation_id)
+        if self.conversation is None:
+            await self.send_error('對話不存在')
+            return False
+        self.handler = await sync_to_async(get_or_rehydrate_handler)(self.conversation, views.conversation_handlers)
+        if self.handler is None:
+            await self.send_error('對話會話已過期，請重新開始')
+            return False
+        await self.send_json({'type': 'ready', 'conversation_id': self.conversation.id})
+        return True
+
+    async def handle(self, frame):
+        """處理一個已驗證的幀，返回 False 表示應關閉連線"""
+        kind = frame.get('type')
+        if kind == 'message':
+            await self.turn(frame)
+        elif kind == 'end':
+            await self.end()
+            return False
+        elif kind == 'ping':
+            await self.send_json({'type': 'pong'})
+        else:
+            await self.send_error(f'未知的幀類型: {kind}')
+        return True
+
+    async def turn(self, frame):
+        content = (frame.get('content') or '').strip()
+        if not content:
+            await self.send_error('消息內容不能為空')
+            return
+        sync_scoring = frame.get('scoring', views.SCORING_MODE) == 'sync'
+
+        # 對話可能已經通過 HTTP 或其他連線結束，每輪都重新讀取
+        await self.conversation.arefresh_from_db()
+        if self.conversation.completed_at:
+            await self.send_error('對話已結束')
+            return
+        try:
+            async for name, data in views.turn_events(self.conversation, self.handler, content, sync_scoring):
+                if name == 'delta':
+                    await self.send_json({'type': 'delta', 'text': data['text']})
+                    continue
+                student, patient = data['messages']
+                await self.send_json({
+                    'type': 'reply',
+                    'message_ids': [student['id'], patient['id']],
+                    'text': patient['content'],
+                    'timings': data['timings'],
+                })
+                if sync_scoring:
+                    await self.send_json({'type': 'score', 'message_id': student['id'], 'score': student['score'], 'running': data['score']})
+                else:
+                    # 後台評分完成後再推送評分幀，不阻塞下一輪提問
+                    task = asyncio.create_task(self.report_score(student['id']))
+                    self.score_tasks.add(task)
+                    task.add_done_callback(self.score_tasks.discard)
+        except Exception as error:
+            await self.send_error(str(error))
+
+    async def report_score(self, message_id):
+        done = await sync_to_async(views.scoring_queue.wait, thread_sensitive=False)(self.conversation_id, timeout=views.SCORING_WAIT_TIMEOUT)
+        if not done:
+            return
+        message = await Message.objects.aget(pk=message_id)
+        conversation = await Conversation.objects.aget(pk=self.conversation_id)
+        await self.send_json({
+            'type': 'score',
+            'message_id': message_id,
+            'score': message.score,
+            'running': RunningScoreSerializer(conversation).data,
+        })
+
+    async def end(self):
+        # 先把尚未推送的評分幀發出
+        if self.score_tasks:
+            await asyncio.gather(*self.score_tasks, return_exceptions=True)
+        await self.conversation.arefresh_from_db()
+        data, status = await views.end_conversation_turns(self.conversation)
+        if status != 200:
+            await self.send_error(data['error'])
+            return
+        await self.send_json({'type': 'ended', 'conversation': data})
+
+
+async def conversation_websocket(scope, receive, send):
+    """/ws/conversations/<id>/ 的 ASGI 應用"""
+    await receive()  # websocket.connect
+    match = WEBSOCKET_PATH.match(scope['path'])
+    if not match:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    await send({'type': 'websocket.accept'})
+
+    socket = ConversationSocket(int(match['pk']), send)
+    authenticated = False
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(receive(), timeout=None if authenticated else AUTH_TIMEOUT)
+            except asyncio.TimeoutError:
+                await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+                break
+            if event['type'] == 'websocket.disconnect':
+                break
+            if event['type'] != 'websocket.receive':
+                continue
+
+            try:
+                frame = json.loads(event.get('text') or event.get('bytes') or b'')
+            except ValueError:
+                frame = None
+            if not isinstance(frame, dict):
+                await socket.send_error('幀必須是 JSON 對象')
+                continue
+
+            if not authenticated:
+                authenticated = await socket.authenticate(frame)
+                if not authenticated:
+                    await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+                    break
+                continue
+            if not await socket.handle(frame):
+                await send({'type': 'websocket.close', 'code': CLOSE_NORMAL})
+                break
+    finally:
+        for task in socket.score_tasks:
+            task.cancel()
+        await sync_to_async(close_old_connections)()
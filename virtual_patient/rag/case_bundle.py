@@ -0,0 +1,405 @@
+"""病例文件：把一個病例的對話腳本、評分標準、嵌入矩陣和關鍵詞自動機存成一個二進位文件
+
+文件結構（小端序，各段按 64 字節對齊）：
+    文件頭      magic、格式版本、段數、段表 CRC32
+    段表        每段 (名稱, 偏移, 長度, CRC32)
+    各段        字符串表、元數據、對話項目表、評分標準表、兩個 float32 嵌入矩陣、自動機表
+
+載入時只做一次 mmap，所有表以 np.frombuffer 直接映射，不解析 JSON、不重新編碼。
+各段的 CRC32 只在 verify 時完整校驗，載入時只校驗段表。
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from .dialog_items import dialog_items, dialog_phrases
+from .keyword_matcher import AhoCorasick, CaseKeywordMatcher
+from .patient_index import DIALOG_COLLECTION, PatientIndex
+from .rubric import CRITERIA_COLLECTION, CompiledRubric
+from .vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'VPCASE'
+FORMAT_VERSION = 2
+# magic, 格式版本, 段數, 段表 CRC32
+HEADER = struct.Struct('<6sHII')
+# 段名稱, 偏移, 長度, CRC32
+SECTION = struct.Struct('<8sQQI')
+ALIGNMENT = 64
+
+# 元數據段（int64）各欄位的位置；字符串欄位存字符串表中的編號
+META_FIELDS = ('patient_id', 'dim', 'model_id', 'dialog_version', 'rubric_version', 'name')
+
+# 各段的數據類型；嵌入矩陣的形狀由元數據中的維度決定
+SECTION_DTYPES = {
+    'str_off': np.int64, 'strings': np.uint8, 'meta': np.int64,
+    # 對話項目：每項一個，觸發語句與關鍵詞以 CSR（偏移 + 字符串編號）保存
+    'it_id': np.int32, 'it_ans': np.int32, 'it_role': np.int32, 'it_cat': np.int32,
+    'tr_off': np.int32, 'tr_sid': np.int32, 'kw_off': np.int32, 'kw_sid': np.int32,
+    'd_emb': np.float32,
+    # 評分標準
+    'cr_id': np.int32, 'cr_idt': np.uint8, 'cr_cat': np.int32, 'cr_name': np.int32, 'cr_hint': np.int32, 'cr_pts': np.int32,
+    'sub_off': np.int32, 'sub_sid': np.int32, 'ckw_off': np.int32, 'ckw_sid': np.int32,
+    'c_emb': np.float32,
+    # 案例關鍵詞自動機：轉移、失敗指針、輸出和負載
+    'ac_goff': np.int32, 'ac_gchr': np.int32, 'ac_gnxt': np.int32, 'ac_fail': np.int32,
+    'ac_ooff': np.int32, 'ac_osid': np.int32, 'ac_pkw': np.int32, 'ac_poff': np.int32, 'ac_pdat': np.int32,
+}
+
+# 自動機負載類型
+PAYLOAD_CRITERION = 0
+PAYLOAD_DIALOG = 1
+
+# 評分項目 id 的類型標記：id 以字符串保存，載入時按標記還原
+CRITERION_ID_STR = 0
+CRITERION_ID_INT = 1
+
+
+def criterion_id_tag(criterion_id):
+    if isinstance(criterion_id, str):
+        return CRITERION_ID_STR
+    if isinstance(criterion_id, int) and not isinstance(criterion_id, bool):
+        return CRITERION_ID_INT
+    raise ValueError(f'評分項目 id 只能是字符串或整數: {criterion_id!r}')
+
+
+def case_bundle_path(directory, patient_id, version):
+    return Path(directory) / f'case_{patient_id}-{version}.vpcase'
+
+
+class StringTable:
+    """寫入時去重的字符串表，None 以 -1 表示"""
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def id(self, text):
+        if text is None:
+            return -1
+        sid = self.ids.get(text)
+        if sid is None:
+            sid = self.ids[text] = len(self.strings)
+            self.strings.append(text)
+        return sid
+
+    def ids_of(self, texts):
+        return [self.id(text) for text in texts]
+
+    def tables(self):
+        encoded = [text.encode('utf-8') for text in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(data) for data in encoded])
+        return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def csr(groups):
+    """把列表的列表轉成 (偏移, 扁平數據)"""
+    offsets = np.zeros(len(groups) + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum([len(group) for group in groups])
+    return offsets, np.array([value for group in groups for value in group], dtype=np.int32)
+
+
+def automaton_tables(automaton, strings):
+    goto_offsets = np.zeros(len(automaton._goto) + 1, dtype=np.int32)
+    goto_offsets[1:] = np.cumsum([len(goto) for goto in automaton._goto])
+    goto_chars = [ord(char) for goto in automaton._goto for char in goto]
+    goto_next = [state for goto in automaton._goto for state in goto.values()]
+    output_offsets, output_ids = csr([strings.ids_of(output) for output in automaton._output])
+    keywords = list(automaton.payloads)
+    payloads = []
+    for keyword in keywords:
+        encoded = []
+        for kind, value in automaton.payloads[keyword]:
+            if kind == 'criterion':
+                encoded.append((PAYLOAD_CRITERION, value[0], value[1]))
+            else:
+                encoded.append((PAYLOAD_DIALOG, strings.id(value), 0))
+        payloads.append([number for payload in encoded for number in payload])
+    payload_offsets, payload_data = csr(payloads)
+    return {
+        'ac_goff': goto_offsets,
+        'ac_gchr': np.array(goto_chars, dtype=np.int32),
+        'ac_gnxt': np.array(goto_next, dtype=np.int32),
+        'ac_fail': np.array(automaton._fail, dtype=np.int32),
+        'ac_ooff': output_offsets,
+        'ac_osid': output_ids,
+        'ac_pkw': np.array(strings.ids_of(keywords), dtype=np.int32),
+        'ac_poff': payload_offsets,
+        'ac_pdat': payload_data,
+    }
+
+
+def write_case_bundle(path, patient_id, dialog_json, scoring_json, encoder=None, name=''):
+    """編碼並寫入一個病例文件（先寫臨時文件再原子替換），返回文件路徑"""
+    index = PatientIndex.build(patient_id, dialog_json, encoder)
+    rubric = CompiledRubric.build(scoring_json, index.vector_store.encoder)
+    matcher = CaseKeywordMatcher(rubric, dialog_json)
+    strings = StringTable()
+
+    items = dialog_items(dialog_json)
+    trigger_offsets, trigger_ids = csr([strings.ids_of(item['triggers']) for item in items])
+    keyword_offsets, keyword_ids = csr([strings.ids_of(item['keywords']) for item in items])
+    criteria = rubric.criteria
+    sub_offsets, sub_ids = csr([strings.ids_of(sub_items) for sub_items in rubric.sub_items])
+    criterion_keyword_offsets, criterion_keyword_ids = csr([strings.ids_of(item.get('關鍵詞', [])) for item in criteria])
+
+    sections = {
+        'meta': np.array([
+            patient_id, index.embeddings.shape[1], strings.id(index.vector_store.encoder.model_id),
+            strings.id(index.version), strings.id(rubric.version), strings.id(name),
+        ], dtype=np.int64),
+        'it_id': np.array(strings.ids_of(item['id'] for item in items), dtype=np.int32),
+        'it_ans': np.array(strings.ids_of(item['answer'] for item in items), dtype=np.int32),
+        'it_role': np.array(strings.ids_of(item['role'] for item in items), dtype=np.int32),
+        'it_cat': np.array(strings.ids_of(item['category'] for item in items), dtype=np.int32),
+        'tr_off': trigger_offsets, 'tr_sid': trigger_ids,
+        'kw_off': keyword_offsets, 'kw_sid': keyword_ids,
+        # 行順序與 dialog_phrases 一致，即按項目依次展開觸發語句
+        'd_emb': np.ascontiguousarray(index.embeddings[index.live_rows], dtype=np.float32),
+        # 評分項目 id 可以是數字或字符串，另存類型標記以還原原來的類型
+        'cr_id': np.array(strings.ids_of(str(criterion_id) for criterion_id in rubric.ids), dtype=np.int32),
+        'cr_idt': np.array([criterion_id_tag(criterion_id) for criterion_id in rubric.ids], dtype=np.uint8),
+        'cr_cat': np.array(strings.ids_of(item.get('分類', '') for item in criteria), dtype=np.int32),
+        'cr_name': np.array(strings.ids_of(item.get('項目') for item in criteria), dtype=np.int32),
+        'cr_hint': np.array(strings.ids_of(item['語義提示'] for item in criteria), dtype=np.int32),
+        'cr_pts': rubric.points.astype(np.int32),
+        'sub_off': sub_offsets, 'sub_sid': sub_ids,
+        'ckw_off': criterion_keyword_offsets, 'ckw_sid': criterion_keyword_ids,
+        'c_emb': np.ascontiguousarray(rubric.embeddings, dtype=np.float32),
+    }
+    sections.update(automaton_tables(matcher.automaton, strings))
+    # 字符串表最後生成，包含以上所有表引用的字符串
+    sections['str_off'], sections['strings'] = strings.tables()
+
+    names = list(SECTION_DTYPES)
+    table_size = SECTION.size * len(names)
+    offset = HEADER.size + table_size
+    layout = []
+    for section_name in names:
+        data = np.ascontiguousarray(sections[section_name], dtype=SECTION_DTYPES[section_name]).tobytes()
+        offset += -offset % ALIGNMENT
+        layout.append((section_name, offset, data))
+        offset += len(data)
+    table = b''.join(
+        SECTION.pack(section_name.encode('ascii'), section_offset, len(data), zlib.crc32(data))
+        for section_name, section_offset, data in layout
+    )
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(names), zlib.crc32(table)))
+            f.write(table)
+            for _, section_offset, data in layout:
+                f.write(b'\0' * (section_offset - f.tell()))
+                f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return path
+
+
+class CaseBundle:
+    """以 mmap 打開的唯讀病例文件"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, format_version, count, table_crc = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f'無效的病例文件: {self.path}')
+        table = self._mmap[HEADER.size:HEADER.size + SECTION.size * count]
+        if zlib.crc32(table) != table_crc:
+            raise ValueError(f'病例文件段表校驗失敗: {self.path}')
+
+        self.sections = {}
+        for i in range(count):
+            raw_name, offset, length, crc = SECTION.unpack_from(table, i * SECTION.size)
+            self.sections[raw_name.rstrip(b'\0').decode('ascii')] = (offset, length, crc)
+        missing = [name for name in SECTION_DTYPES if name not in self.sections]
+        if missing:
+            raise ValueError(f'病例文件缺少段 {", ".join(missing)}: {self.path}')
+
+        offsets = self.array('str_off')
+        blob = self._mmap[self.sections['strings'][0]:self.sections['strings'][0] + self.sections['strings'][1]]
+        self.strings = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+        meta = dict(zip(META_FIELDS, self.array('meta').tolist()))
+        self.patient_id = meta['patient_id']
+        self.dim = meta['dim']
+        self.model_id = self.strings[meta['model_id']]
+        self.dialog_version = self.strings[meta['dialog_version']]
+        self.rubric_version = self.strings[meta['rubric_version']]
+        self.name = self.strings[meta['name']]
+
+    def array(self, name):
+        offset, length, _ = self.sections[name]
+        dtype = np.dtype(SECTION_DTYPES[name])
+        data = np.frombuffer(self._mmap, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+        if name in ('d_emb', 'c_emb'):
+            data = data.reshape(-1, self.dim)
+        return data
+
+    def string(self, sid):
+        return None if sid < 0 else self.strings[sid]
+
+    def grouped(self, offsets_name, ids_name):
+        offsets = self.array(offsets_name).tolist()
+        ids = self.array(ids_name).tolist()
+        return [[self.strings[sid] for sid in ids[offsets[i]:offsets[i + 1]]] for i in range(len(offsets) - 1)]
+
+    def dialog_json(self):
+        """還原為觸發語句分組格式的對話腳本"""
+        triggers = self.grouped('tr_off', 'tr_sid')
+        keywords = self.grouped('kw_off', 'kw_sid')
+        dialog = []
+        columns = zip(self.array('it_id').tolist(), self.array('it_ans').tolist(), self.array('it_role').tolist(), self.array('it_cat').tolist())
+        for i, (item_id, answer, role, category) in enumerate(columns):
+            item = {'id': self.strings[item_id], '觸發語句': triggers[i], '標準回覆': self.strings[answer], '關鍵詞': keywords[i]}
+            if role >= 0:
+                item['角色'] = self.strings[role]
+            if category >= 0:
+                item['情境分類'] = self.strings[category]
+            dialog.append(item)
+        return dialog
+
+    def criteria(self):
+        """還原評分標準（細項直接以「細項」欄位保存）"""
+        sub_items = self.grouped('sub_off', 'sub_sid')
+        keywords = self.grouped('ckw_off', 'ckw_sid')
+        columns = zip(
+            self.array('cr_id').tolist(), self.array('cr_idt').tolist(), self.array('cr_cat').tolist(), self.array('cr_name').tolist(),
+            self.array('cr_hint').tolist(), self.array('cr_pts').tolist(),
+        )
+        criteria = []
+        for i, (criterion_id, tag, category, name, hint, points) in enumerate(columns):
+            criterion_id = self.strings[criterion_id]
+            item = {'id': int(criterion_id) if tag == CRITERION_ID_INT else criterion_id, '分類': self.strings[category], '語義提示': self.strings[hint],
+                    '關鍵詞': keywords[i], '配分': points}
+            if name >= 0:
+                item['項目'] = self.strings[name]
+            if sub_items[i]:
+                item['細項'] = sub_items[i]
+            criteria.append(item)
+        return criteria
+
+    def patient_index(self, encoder=None):
+        """以映射的嵌入矩陣建立病人索引，版本號與原始對話 JSON 的內容雜湊一致"""
+        dialog_json = self.dialog_json()
+        phrases, item_ids = dialog_phrases(dialog_json)
+        vector_store = VectorStore(encoder)
+        vector_store.add_collection(
+            DIALOG_COLLECTION, phrases, metadata=[{'item_id': item_id} for item_id in item_ids],
+            embeddings=self.array('d_emb'), normalized=True,
+        )
+        vector_store.freeze()
+        index = PatientIndex(self.patient_id, self.dialog_version, vector_store, dialog_json)
+        index.encoded = 0
+        return index
+
+    def compiled_rubric(self, encoder=None):
+        criteria = self.criteria()
+        vector_store = VectorStore(encoder)
+        vector_store.add_collection(
+            CRITERIA_COLLECTION, [item['語義提示'] for item in criteria], metadata=criteria,
+            embeddings=self.array('c_emb'), normalized=True,
+        )
+        vector_store.freeze()
+        return CompiledRubric(criteria, self.rubric_version, vector_store)
+
+    def keyword_matcher(self):
+        """還原已編譯的案例關鍵詞自動機，不重新計算失敗指針"""
+        automaton = AhoCorasick()
+        goto_offsets = self.array('ac_goff').tolist()
+        goto_chars = self.array('ac_gchr').tolist()
+        goto_next = self.array('ac_gnxt').tolist()
+        automaton._goto = [
+            {chr(char): state for char, state in zip(goto_chars[start:end], goto_next[start:end])}
+            for start, end in zip(goto_offsets, goto_offsets[1:])
+        ]
+        automaton._fail = self.array('ac_fail').tolist()
+        automaton._output = self.grouped('ac_ooff', 'ac_osid')
+        payload_offsets = self.array('ac_poff').tolist()
+        payload_data = self.array('ac_pdat').tolist()
+        for i, sid in enumerate(self.array('ac_pkw').tolist()):
+            data = payload_data[payload_offsets[i]:payload_offsets[i + 1]]
+            payloads = []
+            for kind, a, b in zip(data[0::3], data[1::3], data[2::3]):
+                payloads.append(('criterion', (a, b)) if kind == PAYLOAD_CRITERION else ('dialog', self.strings[a]))
+            automaton.payloads[self.strings[sid]] = payloads
+        automaton.built = True
+        return CaseKeywordMatcher.from_automaton(automaton)
+
+    def summary(self):
+        return {
+            'path': str(self.path),
+            'patient_id': self.patient_id,
+            'name': self.name,
+            'model_id': self.model_id,
+            'dim': self.dim,
+            'dialog_version': self.dialog_version,
+            'rubric_version': self.rubric_version,
+            'items': len(self.array('it_id')),
+            'phrases': len(self.array('d_emb')),
+            'criteria': len(self.array('cr_id')),
+            'strings': len(self.strings),
+            'automaton_states': len(self.array('ac_fail')),
+            'size': len(self._mmap),
+        }
+
+    def verify(self):
+        """完整校驗：各段 CRC32、表之間的長度一致性、嵌入已正規化，返回問題列表（空列表表示通過）"""
+        problems = []
+        for name, (offset, length, crc) in self.sections.items():
+            if offset + length > len(self._mmap):
+                problems.append(f'段 {name} 超出文件範圍')
+            elif zlib.crc32(self._mmap[offset:offset + length]) != crc:
+                problems.append(f'段 {name} 校驗失敗')
+        if problems:
+            return problems
+        items = len(self.array('it_id'))
+        criteria = len(self.array('cr_id'))
+        if len(self.array('tr_off')) != items + 1 or self.array('tr_off')[-1] != len(self.array('d_emb')):
+            problems.append('觸發語句與對話嵌入行數不一致')
+        if (len(self.array('c_emb')) != criteria or len(self.array('sub_off')) != criteria + 1
+                or len(self.array('cr_idt')) != criteria):
+            problems.append('評分標準與評分嵌入行數不一致')
+        for name in ('d_emb', 'c_emb'):
+            norms = np.linalg.norm(self.array(name), axis=1)
+            if len(norms) and not np.allclose(norms[norms > 0], 1.0, atol=1e-3):
+                problems.append(f'{name} 未正規化')
+        return problems
+
+
+def load_case_bundle(directory, patient_id, version, model_id=None):
+    """載入指定病人對話版本的病例文件，不存在、無效或模型不一致時返回 None
+
+    文件名只包含對話版本；評分標準是否仍與病例一致由調用方比對 rubric_version。
+    """
+    if not directory:
+        return None
+    path = case_bundle_path(directory, patient_id, version)
+    if not path.exists():
+        return None
+    try:
+        bundle = CaseBundle(path)
+    except ValueError as error:
+        logger.warning('忽略病例文件 %s: %s', path, error)
+        return None
+    if model_id is not None and bundle.model_id != model_id:
+        return None
+    return bundle
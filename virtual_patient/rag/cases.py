@@ -0,0 +1,102 @@
+import json
+from pathlib import Path
+
+from .dialog_items import dialog_item
+
+
+def validate_dialog(dialog_json):
+    """檢查對話腳本，返回錯誤訊息列表"""
+    if not isinstance(dialog_json, list):
+        return ['對話JSON必須是列表']
+    errors = []
+    seen = set()
+    for position, item in enumerate(dialog_json):
+        if not isinstance(item, dict):
+            errors.append(f'對話第 {position + 1} 項不是對象')
+            continue
+        normalized = dialog_item(item, position)
+        if not normalized['triggers']:
+            errors.append(f'對話項目 {normalized["id"]} 沒有觸發語句')
+        if not normalized['answer']:
+            errors.append(f'對話項目 {normalized["id"]} 沒有標準回覆')
+        if normalized['id'] in seen:
+            errors.append(f'對話項目 id 重複: {normalized["id"]}')
+        seen.add(normalized['id'])
+    return errors
+
+
+def validate_scoring(scoring_json):
+    """檢查評分標準，返回錯誤訊息列表"""
+    if not isinstance(scoring_json, list):
+        return ['評分JSON必須是列表']
+    errors = []
+    seen = set()
+    for position, item in enumerate(scoring_json):
+        if not isinstance(item, dict) or 'id' not in item:
+            errors.append(f'評分第 {position + 1} 項缺少 id')
+            continue
+        if not item.get('語義提示'):
+            errors.append(f'評分項目 {item["id"]} 沒有語義提示')
+        if not isinstance(item.get('配分', 0), int):
+            errors.append(f'評分項目 {item["id"]} 的配分不是整數')
+        if item['id'] in seen:
+            errors.append(f'評分項目 id 重複: {item["id"]}')
+        seen.add(item['id'])
+    return errors
+
+
+def read_case(entry):
+    """讀取並檢查一個病例 {'name', 'description', 'dialog', 'scoring'}（後兩者為文件路徑）
+
+    返回 {'name', 'description', 'dialog_json', 'scoring_json', 'errors'}。
+    只依賴文件內容，可在進程池中執行。
+    """
+    case = {
+        'name': entry['name'],
+        'description': entry.get('description', ''),
+        'dialog_json': None,
+        'scoring_json': None,
+        'errors': [],
+    }
+    for key, path, validate in (('dialog_json', entry['dialog'], validate_dialog), ('scoring_json', entry['scoring'], validate_scoring)):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                case[key] = json.load(f)
+        except (OSError, ValueError) as e:
+            case['errors'].append(f'無法讀取 {path}: {e}')
+            continue
+        case['errors'].extend(validate(case[key]))
+    return case
+
+
+def manifest_entries(manifest_path):
+    """讀取病例清單 [{"name", "description", "dialog", "scoring"}]，文件路徑相對於清單所在目錄"""
+    manifest_path = Path(manifest_path)
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    for entry in entries:
+        entry['dialog'] = str(manifest_path.parent / entry['dialog'])
+        entry['scoring'] = str(manifest_path.parent / entry['scoring'])
+    return entries
+
+
+def directory_entries(directory):
+    """病例目錄：每個含 dialog.json 和 scoring.json 的子目錄是一個病例
+
+    可選的 case.json 提供 name 與 description，未提供時以子目錄名為病人名稱。
+    """
+    entries = []
+    for case_dir in sorted(Path(directory).iterdir()):
+        if not (case_dir / 'dialog.json').is_file():
+            continue
+        info = {}
+        if (case_dir / 'case.json').is_file():
+            with open(case_dir / 'case.json', 'r', encoding='utf-8') as f:
+                info = json.load(f)
+        entries.append({
+            'name': info.get('name', case_dir.name),
+            'description': info.get('description', ''),
+            'dialog': str(case_dir / 'dialog.json'),
+            'scoring': str(case_dir / 'scoring.json'),
+        })
+    return entries
@@ -1,37 +1,110 @@
+from .dialog_items import dialog_items
+from .generative import GenerationError
+
+# 檢索不到且沒有生成服務（或生成失敗）時的固定回覆
+CANNED_REPLY = "我不太明白您的意思，請換個方式提問。"
+
+# 採用腳本回覆的最低檢索分數。混合檢索的 score 為 max(餘弦相似度, 詞項覆蓋率)（見 PatientIndex.retrieve），
+# 兩者都在 [0, 1]：餘弦相似度至少 0.6，或提問中至少 60% 的字符二元組出現在同一觸發語句中
+# （例如 5 個二元組的提問至少命中 3 個）即採用；覆蓋率只會讓分數升高，提高閾值才會更嚴格。
+# 可以 RAG_MATCH_THRESHOLD 覆蓋
+MATCH_THRESHOLD = 0.6
+
+
 class DialogGenerator:
     """虛擬病人對話生成器"""
     
-    def __init__(self, dialog_json):
+    def __init__(self, dialog_json, fallback=None, threshold=MATCH_THRESHOLD):
         self.dialog_data = dialog_json
-        self.question_map = {item['question']: item for item in dialog_json}
+        self.threshold = threshold
+        # 每個對話項目可有多個觸發語句，檢索結果通過所屬項目 id 取得標準回覆
+        self.items = dialog_items(dialog_json)
+        self.item_map = {item['id']: item for item in self.items}
         self.current_index = 0
+        # 檢索分數不足時的生成式回退（PatientReplyGenerator），None 表示只用固定回覆
+        self.fallback = fallback
     
-    def get_response(self, user_input, vector_store=None):
-        """根據用戶輸入獲取回應"""
+    def get_response(self, user_input, vector_store=None, query_vector=None, results=None):
+        """根據用戶輸入獲取回應
+
+        query_vector 為已計算的查詢嵌入；results 為已完成的檢索結果（例如混合檢索），傳入時不再檢索。
+        """
+        response = self.match_response(user_input, vector_store, query_vector=query_vector, results=results)
+        if response is None:
+            return self.fallback_response(user_input)
+        return response
+
+    def match_response(self, user_input, vector_store=None, query_vector=None, results=None):
+        """返回腳本中的回應；檢索分數不足、需要生成式回退時返回 None"""
         # 如果沒有向量存儲，則順序返回回應
         if not vector_store:
-            if self.current_index < len(self.dialog_data):
-                response = self.dialog_data[self.current_index]['answer']
+            if self.current_index < len(self.items):
+                response = self.items[self.current_index]['answer']
                 self.current_index += 1
                 return response
             else:
                 return "對話已結束。"
         
         # 使用向量檢索尋找最匹配的問題
-        results = vector_store.search("dialog_questions", user_input, top_k=1)
+        if results is not None:
+            pass
+        elif query_vector is not None:
+            results = vector_store.search_vector("dialog_questions", query_vector, top_k=1)
+        else:
+            results = vector_store.search("dialog_questions", user_input, top_k=1)
         
-        if not results or results[0]['score'] < 0.6:
-            return "我不太明白您的意思，請換個方式提問。"
+        if not results or results[0]['score'] < self.threshold:
+            return None
         
-        best_match = results[0]
-        matched_question = best_match['text']
-        
-        # 獲取匹配問題的回應
-        if matched_question in self.question_map:
-            return self.question_map[matched_question]['answer']
+        # 獲取匹配語句所屬項目的回應
+        item = self.item_map.get(results[0]['metadata'].get('item_id'))
+        if item is not None:
+            return item['answer']
             
         return "抱歉，我不知道如何回答這個問題。"
     
+    def fallback_response(self, user_input):
+        """檢索不到時按角色生成回覆，生成服務不可用時返回固定回覆"""
+        if self.fallback is not None:
+            try:
+                return self.fallback.reply(user_input)
+            except GenerationError:
+                pass
+        return CANNED_REPLY
+    
+    def stream_response(self, user_input, vector_store=None, query_vector=None, results=None):
+        """逐段產生回應，供串流端點使用
+
+        檢索到的標準回覆作為一整段立即返回；需要生成式回退時逐段產生模型輸出的文字。
+        生成服務在產生任何文字前失敗時返回固定回覆；中途失敗時保留已產生的部分。
+        調用方中途關閉本生成器時一併關閉生成服務的串流。
+        """
+        response = self.match_response(user_input, vector_store, query_vector=query_vector, results=results)
+        if response is not None:
+            yield response
+            return
+        if self.fallback is not None:
+            produced = False
+            stream = self.fallback.stream(user_input)
+            try:
+                for chunk in stream:
+                    produced = True
+                    yield chunk
+            except GenerationError:
+                pass
+            finally:
+                stream.close()
+            if produced:
+                return
+        yield CANNED_REPLY
+    
     def reset(self):
         """重置對話狀態"""
-        self.current_index = 0
\ No newline at end of file
+        self.current_index = 0
+
+    def get_state(self):
+        """返回可序列化的對話狀態"""
+        return {'current_index': self.current_index}
+
+    def set_state(self, state):
+        self.current_index = state.get('current_index', 0)
\ No newline at end of file
@@ -0,0 +1,75 @@
+def dialog_item(item, position):
+    """把一個對話項目轉成統一結構 {'id', 'triggers', 'answer', 'role', 'category', 'keywords'}
+
+    支持三種寫法：
+        {"觸發語句": [...], "標準回覆": ...}   一個項目多個觸發語句
+        {"嵌入內容": ..., "標準回覆": ...}     已展平的單句
+        {"question": ..., "answer": ...}       舊格式
+    沒有 id 的項目以其位置作為 id。
+    """
+    if '觸發語句' in item:
+        triggers = [phrase for phrase in item['觸發語句'] if phrase]
+    else:
+        phrase = item.get('嵌入內容') or item.get('question')
+        triggers = [phrase] if phrase else []
+    return {
+        'id': str(item.get('id', position)),
+        'triggers': triggers,
+        'answer': item.get('標準回覆', item.get('answer', '')),
+        'role': item.get('角色'),
+        'category': item.get('情境分類', item.get('分類')),
+        'keywords': list(item.get('關鍵詞', [])),
+    }
+
+
+def dialog_items(dialog_json):
+    return [dialog_item(item, position) for position, item in enumerate(dialog_json or [])]
+
+
+def dialog_phrases(dialog_json):
+    """展開所有觸發語句，返回 (語句列表, 每個語句所屬項目的 id 列表)"""
+    phrases = []
+    item_ids = []
+    for item in dialog_items(dialog_json):
+        for phrase in item['triggers']:
+            phrases.append(phrase)
+            item_ids.append(item['id'])
+    return phrases, item_ids
+
+
+def diff_dialog_items(old_json, new_json):
+    """按項目 id 比較兩個版本的對話，返回 {'added', 'changed', 'removed', 'unchanged'} 各自的 id 列表"""
+    old = {item['id']: item for item in dialog_items(old_json)}
+    new = {item['id']: item for item in dialog_items(new_json)}
+    diff = {'added': [], 'changed': [], 'removed': [], 'unchanged': []}
+    for item_id, item in new.items():
+        if item_id not in old:
+            diff['added'].append(item_id)
+        elif old[item_id] != item:
+            diff['changed'].append(item_id)
+        else:
+            diff['unchanged'].append(item_id)
+    diff['removed'] = [item_id for item_id in old if item_id not in new]
+    return diff
+
+
+def flatten_dialog(dialog_json):
+    """把分組格式的對話展開為每個觸發語句一條的嵌入記錄（dialog_rag_vector_search.json 的格式）
+
+    記錄 id 為 <項目 id>:<語句序號>，所屬項目 id 和語句內容地址分別保存在「項目id」和「語句id」。
+    """
+    from .phrase_table import phrase_id
+
+    records = []
+    for item in dialog_items(dialog_json):
+        for n, phrase in enumerate(item['triggers']):
+            records.append({
+                'id': f'{item["id"]}:{n}',
+                '分類': item['category'],
+                '嵌入內容': phrase,
+                '標準回覆': item['answer'],
+                '角色': item['role'],
+                '項目id': item['id'],
+                '語句id': phrase_id(phrase),
+            })
+    return records
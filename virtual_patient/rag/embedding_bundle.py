@@ -0,0 +1,108 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b'VPEMB'
+FORMAT_VERSION = 1
+# magic, 格式版本, 行數, 維度, 元數據長度, 矩陣偏移
+HEADER = struct.Struct('<5sHIIQQ')
+ALIGNMENT = 64
+
+
+def bundle_path(directory, patient_id, version):
+    return Path(directory) / f'patient_{patient_id}-{version}.vpemb'
+
+
+def make_vector_id(version, row):
+    """PatientData.vector_id 格式：<索引版本>:<行號>"""
+    return f'{version}:{row}'
+
+
+def parse_vector_id(vector_id):
+    version, row = vector_id.rsplit(':', 1)
+    return version, int(row)
+
+
+def write_bundle(path, embeddings, ids, texts, model_id, version, extra=None):
+    """寫入嵌入文件：頭部 + JSON 元數據 + 按 64 字節對齊的 float32 矩陣
+
+    先寫臨時文件再原子替換，正在讀取舊文件的 worker 不受影響。
+    """
+    path = Path(path)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    rows, dim = embeddings.shape
+    metadata = json.dumps({
+        'ids': list(ids),
+        'texts': list(texts),
+        'model_id': model_id,
+        'version': version,
+        'extra': extra or {},
+    }, ensure_ascii=False).encode('utf-8')
+
+    matrix_offset = HEADER.size + len(metadata)
+    matrix_offset += -matrix_offset % ALIGNMENT
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, rows, dim, len(metadata), matrix_offset)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(metadata)
+            f.write(b'\0' * (matrix_offset - HEADER.size - len(metadata)))
+            f.write(embeddings.tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return path
+
+
+class EmbeddingBundle:
+    """以 mmap 打開的唯讀嵌入文件，矩陣頁面由所有 worker 經 OS 頁緩存共享"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, format_version, rows, dim, metadata_length, matrix_offset = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f'無效的嵌入文件: {self.path}')
+
+        metadata = json.loads(self._mmap[HEADER.size:HEADER.size + metadata_length].decode('utf-8'))
+        self.ids = metadata['ids']
+        self.texts = metadata['texts']
+        self.model_id = metadata['model_id']
+        self.version = metadata['version']
+        self.extra = metadata['extra']
+        self.embeddings = np.frombuffer(self._mmap, dtype=np.float32, count=rows * dim, offset=matrix_offset).reshape(rows, dim)
+
+    def row(self, vector_id):
+        """根據 PatientData.vector_id 取得向量"""
+        version, row = parse_vector_id(vector_id)
+        if version != self.version:
+            raise KeyError(vector_id)
+        return self.embeddings[row]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def load_bundle(directory, patient_id, version, model_id=None):
+    """載入指定病人版本的嵌入文件，不存在或模型不一致時返回 None"""
+    if not directory:
+        return None
+    path = bundle_path(directory, patient_id, version)
+    if not path.exists():
+        return None
+    bundle = EmbeddingBundle(path)
+    if model_id is not None and bundle.model_id != model_id:
+        return None
+    return bundle
@@ -0,0 +1,125 @@
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .embeddings import normalize_text
+
+
+def embedding_key(model_id, text):
+    """緩存鍵：模型ID + 標準化文本的雜湊"""
+    payload = f'{model_id}\0{normalize_text(text)}'.encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()
+
+
+class CachedEncoder:
+    """兩級嵌入緩存：進程內 LRU，其次為持久化的 SQLite 文件
+
+    與被包裝的編碼器接口相同（encode / model_id / dim），可直接替換。
+    """
+
+    def __init__(self, encoder, path=None, max_entries=10000):
+        self.encoder = encoder
+        self.model_id = encoder.model_id
+        self.dim = encoder.dim
+        self.path = str(path) if path else None
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.path:
+            with self._connection() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def encode(self, texts):
+        texts = list(texts)
+        keys = [embedding_key(self.model_id, text) for text in texts]
+        vectors = [None] * len(texts)
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    vectors[i] = vector
+                    self.memory_hits += 1
+
+        pending = [i for i, vector in enumerate(vectors) if vector is None]
+        if pending and self.path:
+            found = self._load([keys[i] for i in pending])
+            with self._lock:
+                for i in pending:
+                    vector = found.get(keys[i])
+                    if vector is not None:
+                        vectors[i] = vector
+                        self._remember(keys[i], vector)
+                        self.disk_hits += 1
+            pending = [i for i in pending if vectors[i] is None]
+
+        if pending:
+            # 同一批中重複的文本只編碼一次；標準化文本只用作緩存鍵，編碼時使用每個鍵第一次出現的原文
+            text_by_key = {}
+            for i in pending:
+                text_by_key.setdefault(keys[i], texts[i])
+            unique = list(text_by_key)
+            encoded = np.asarray(self.encoder.encode([text_by_key[key] for key in unique]), dtype=np.float32)
+            computed = dict(zip(unique, encoded))
+            with self._lock:
+                for key, vector in computed.items():
+                    vector.setflags(write=False)
+                    self._remember(key, vector)
+                self.misses += len(pending)
+            if self.path:
+                self._store(computed)
+            for i in pending:
+                vectors[i] = computed[keys[i]]
+
+        if not vectors:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack(vectors)
+
+    def _load(self, keys, chunk_size=500):
+        conn = self._connection()
+        found = {}
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', chunk).fetchall()
+            found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+        return found
+
+    def _store(self, vectors):
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)',
+                [(key, vector.tobytes()) for key, vector in vectors.items()],
+            )
+
+    def stats(self):
+        """返回命中與未命中計數"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,85 @@
+import hashlib
+import threading
+import unicodedata
+
+import numpy as np
+from django.conf import settings
+
+
+def normalize_text(text):
+    """標準化文本：全形轉半形、轉小寫並合併空白"""
+    text = unicodedata.normalize('NFKC', text or '')
+    return ' '.join(text.lower().split())
+
+
+class HashingEncoder:
+    """基於字元 n-gram 雜湊的輕量編碼器，無需下載模型即可使用"""
+
+    def __init__(self, dim=512, ngram_range=(1, 2)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.model_id = f'hashing-char-{ngram_range[0]}-{ngram_range[1]}-{dim}'
+
+    def _ngrams(self, text):
+        # 去除標點與空白，中文問句的語義主要落在字元上
+        chars = [c for c in normalize_text(text) if not unicodedata.category(c).startswith(('P', 'Z'))]
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(chars) - n + 1):
+                yield ''.join(chars[i:i + n])
+
+    def encode(self, texts):
+        """將文本列表編碼為 float32 矩陣"""
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for gram in self._ngrams(text):
+                digest = hashlib.blake2b(gram.encode('utf-8'), digest_size=8).digest()
+                value = int.from_bytes(digest, 'little')
+                sign = -1.0 if value >> 63 else 1.0
+                matrix[row, value % self.dim] += sign
+        return matrix
+
+
+class SentenceTransformerEncoder:
+    """sentence-transformers 模型的包裝"""
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+        self.model_id = model_name
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts):
+        embeddings = self.model.encode(list(texts), normalize_embeddings=True)
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def get_encoder():
+    """取得進程內共享的文本編碼器
+
+    設定 RAG_EMBEDDING_MODEL 時使用 sentence-transformers 模型，
+    否則使用 HashingEncoder。編碼結果經 CachedEncoder 緩存，
+    設定 RAG_EMBEDDING_CACHE_PATH 時同時寫入持久化緩存。
+    """
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                from .embedding_cache import CachedEncoder
+
+                model_name = getattr(settings, 'RAG_EMBEDDING_MODEL', None)
+                if model_name:
+                    encoder = SentenceTransformerEncoder(model_name)
+                else:
+                    encoder = HashingEncoder()
+                _encoder = CachedEncoder(
+                    encoder,
+                    path=getattr(settings, 'RAG_EMBEDDING_CACHE_PATH', None),
+                    max_entries=getattr(settings, 'RAG_EMBEDDING_CACHE_SIZE', 10000),
+                )
+    return _encoder
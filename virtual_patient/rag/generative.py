@@ -0,0 +1,344 @@
+import http.client
+import json
+import queue
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from .dialog_items import dialog_items
+from .embeddings import normalize_text
+
+
+class GenerationError(Exception):
+    """生成服務調用失敗（連線、超時、繁忙或響應格式錯誤）"""
+
+
+class ConnectionPool:
+    """單一主機的 HTTP keep-alive 連線池"""
+
+    def __init__(self, url, max_connections=10, timeout=10):
+        parts = urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=max_connections)
+        self.connections_opened = 0
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        self.connections_opened += 1
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def open(self, method, body, headers):
+        """發送請求並返回 (連線, 響應)；響應內容由調用方讀完後以 release 歸還連線
+
+        重用的連線已被服務端關閉時換新連線重試一次。
+        """
+        try:
+            connection, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            connection, reused = self._connect(), False
+
+        while True:
+            try:
+                connection.request(method, self.path, body=body, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if not reused:
+                    raise
+                connection, reused = self._connect(), False
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                raise
+
+    def release(self, connection, response):
+        """響應已讀完時把連線放回池中"""
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self._idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+
+    def request(self, method, body, headers):
+        """發送請求，返回 (狀態碼, 響應內容)"""
+        connection, response = self.open(method, body, headers)
+        try:
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+        self.release(connection, response)
+        return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class _InflightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GenerativeClient:
+    """OpenAI 兼容 chat completions 接口的客戶端
+
+    - 連線池重用 keep-alive 連線，連線與讀取都有超時
+    - 相同緩存鍵的請求正在進行時，後來者等待同一結果（single-flight）
+    - stream 以 stream: true 逐段返回生成的文字（SSE），完成後同樣寫入緩存
+    - 成功的結果按緩存鍵存入 LRU
+    - 全局信號量限制同時進行的請求數，等待超時視為繁忙
+    """
+
+    def __init__(self, url, model='', api_key=None, timeout=10, max_connections=10, max_concurrency=8,
+                 acquire_timeout=None, cache_size=1000, max_tokens=200, temperature=0.3):
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+        self.acquire_timeout = timeout if acquire_timeout is None else acquire_timeout
+        self.cache_size = cache_size
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.pool = ConnectionPool(url, max_connections=max_connections, timeout=timeout)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def complete(self, messages, cache_key=None):
+        """返回模型回覆文字，失敗時拋出 GenerationError"""
+        if cache_key is None:
+            cache_key = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+
+        with self._lock:
+            if cache_key in self._cache:
+                self._cache.move_to_end(cache_key)
+                self.cache_hits += 1
+                return self._cache[cache_key]
+            call = self._inflight.get(cache_key)
+            leader = call is None
+            if leader:
+                call = self._inflight[cache_key] = _InflightCall()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._request(messages)
+        except BaseException as error:
+            # 其他異常（例如響應處理中的程序錯誤）同樣以 GenerationError 通知等待者，不讓它們拿到 None
+            call.error = error if isinstance(error, GenerationError) else GenerationError(f'生成服務調用異常: {error!r}')
+            with self._lock:
+                self.failures += 1
+            if call.error is not error and isinstance(error, Exception):
+                raise call.error from error
+            raise
+        else:
+            with self._lock:
+                self._cache[cache_key] = call.result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return call.result
+        finally:
+            with self._lock:
+                del self._inflight[cache_key]
+            call.event.set()
+
+    def _payload(self, messages, stream=False):
+        body = {
+            'model': self.model,
+            'messages': messages,
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+        }
+        if stream:
+            body['stream'] = True
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers['Authorization'] = f'Bearer {self.api_key}'
+        return json.dumps(body, ensure_ascii=False).encode('utf-8'), headers
+
+    def stream(self, messages, cache_key=None):
+        """逐段產生模型回覆文字，失敗時拋出 GenerationError（可能已產生部分文字）
+
+        已緩存或相同請求正在進行時整段返回同一結果；串流請求本身不與其他請求合併。
+        完整產生且非空的回覆寫入緩存。調用方中途關閉生成器時，底層請求隨即關閉，
+        釋放並發名額與連線。
+        """
+        if cache_key is None:
+            cache_key = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+        with self._lock:
+            cached = cache_key in self._cache or cache_key in self._inflight
+        if cached:
+            yield self.complete(messages, cache_key)
+            return
+
+        chunks = []
+        request = self._stream_request(messages)
+        try:
+            for chunk in request:
+                chunks.append(chunk)
+                yield chunk
+        except GenerationError:
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            request.close()
+        reply = ''.join(chunks).strip()
+        if not reply:
+            return
+        with self._lock:
+            self._cache[cache_key] = reply
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _stream_request(self, messages):
+        if not self._semaphore.acquire(timeout=self.acquire_timeout):
+            raise GenerationError('生成服務繁忙')
+        connection = None
+        finished = False
+        try:
+            with self._lock:
+                self.requests += 1
+            body, headers = self._payload(messages, stream=True)
+            try:
+                connection, response = self.pool.open('POST', body, headers)
+                if response.status != 200:
+                    response.read()
+                    raise GenerationError(f'生成服務返回 {response.status}')
+                while True:
+                    line = response.readline()
+                    if not line:
+                        break
+                    line = line.strip()
+                    if not line.startswith(b'data:'):
+                        continue
+                    data = line[5:].strip()
+                    if data == b'[DONE]':
+                        break
+                    try:
+                        delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+                    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as error:
+                        raise GenerationError('生成服務響應格式錯誤') from error
+                    if delta:
+                        yield delta
+                response.read()
+                finished = True
+                self.pool.release(connection, response)
+            except (OSError, http.client.HTTPException) as error:
+                raise GenerationError(f'生成服務連線失敗: {error}') from error
+        finally:
+            # 出錯或調用方中途放棄時，響應未讀完的連線不能放回池中
+            if connection is not None and not finished:
+                connection.close()
+            self._semaphore.release()
+
+    def _request(self, messages):
+        if not self._semaphore.acquire(timeout=self.acquire_timeout):
+            raise GenerationError('生成服務繁忙')
+        try:
+            with self._lock:
+                self.requests += 1
+            body, headers = self._payload(messages)
+            try:
+                status, data = self.pool.request('POST', body, headers)
+            except (OSError, http.client.HTTPException) as error:
+                raise GenerationError(f'生成服務連線失敗: {error}') from error
+        finally:
+            self._semaphore.release()
+
+        if status != 200:
+            raise GenerationError(f'生成服務返回 {status}')
+        try:
+            return json.loads(data)['choices'][0]['message']['content'].strip()
+        except (ValueError, KeyError, IndexError, TypeError) as error:
+            raise GenerationError('生成服務響應格式錯誤') from error
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'cache_hits': self.cache_hits,
+                'coalesced': self.coalesced,
+                'failures': self.failures,
+                'connections_opened': self.pool.connections_opened,
+            }
+
+
+def build_persona_prompt(dialog_json):
+    """根據對話腳本的角色與標準回覆組成系統提示"""
+    items = dialog_items(dialog_json)
+    role = next((item['role'] for item in items if item['role']), '病童家屬')
+    facts = [
+        f'問：{item["triggers"][0]}\n答：{item["answer"]}'
+        for item in items if item['triggers'] and item['answer']
+    ]
+    return (
+        f'你是護理學生問診練習中的虛擬病人，身份是{role}。'
+        '請以這個身份用繁體中文口語簡短回答護理學生的提問，只能根據以下病例資料回答；'
+        '資料中沒有的內容就說不清楚，不要編造病情。\n\n'
+        + '\n\n'.join(facts)
+    )
+
+
+class PatientReplyGenerator:
+    """檢索分數不足時以生成模型按角色回答，緩存鍵為 (病人索引版本, 標準化問題)"""
+
+    def __init__(self, client, dialog_json, version):
+        self.client = client
+        self.version = version
+        self.system_prompt = build_persona_prompt(dialog_json)
+
+    def messages(self, question):
+        return [
+            {'role': 'system', 'content': self.system_prompt},
+            {'role': 'user', 'content': question},
+        ]
+
+    def reply(self, question):
+        return self.client.complete(self.messages(question), cache_key=(self.version, normalize_text(question)))
+
+    def stream(self, question):
+        """逐段產生回覆，供串流端點使用"""
+        return self.client.stream(self.messages(question), cache_key=(self.version, normalize_text(question)))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_generative_client():
+    """根據 RAG_GENERATIVE_BACKEND 設定建立共享的生成客戶端，未設定時返回 None"""
+    global _client
+    config = getattr(settings, 'RAG_GENERATIVE_BACKEND', None)
+    if not config:
+        return None
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GenerativeClient(**config)
+    return _client
@@ -0,0 +1,157 @@
+import threading
+from collections import OrderedDict, deque
+
+from .dialog_items import dialog_items
+
+
+class AhoCorasick:
+    """Aho-Corasick 多模式匹配：一次線性掃描找出文本中所有關鍵詞（含重疊）"""
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self.payloads = {}
+        self.built = False
+
+    def add(self, keyword, payload):
+        """加入關鍵詞及其負載，同一關鍵詞可對應多個負載"""
+        if self.built:
+            raise RuntimeError('自動機已編譯，不能再加入關鍵詞')
+        if not keyword:
+            return
+        payloads = self.payloads.setdefault(keyword, [])
+        if payload in payloads:
+            return
+        payloads.append(payload)
+
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        if keyword not in self._output[state]:
+            self._output[state].append(keyword)
+
+    def build(self):
+        """以 BFS 計算失敗指針，並合併後綴狀態的輸出"""
+        queue = deque()
+        for next_state in self._goto[0].values():
+            self._fail[next_state] = 0
+            queue.append(next_state)
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                inherited = [keyword for keyword in self._output[self._fail[next_state]] if keyword not in self._output[next_state]]
+                self._output[next_state] = self._output[next_state] + inherited
+        self.built = True
+        return self
+
+    def iter_matches(self, text):
+        """逐個產生 (結束位置, 關鍵詞)"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for keyword in output[state]:
+                yield position + 1, keyword
+
+    def find_all(self, text):
+        """返回 [(起始位置, 關鍵詞, 負載列表)]"""
+        return [(end - len(keyword), keyword, self.payloads[keyword]) for end, keyword in self.iter_matches(text)]
+
+
+class KeywordMatches:
+    """一次掃描的匹配結果：評分項目命中與對話項目命中"""
+
+    def __init__(self, criteria, dialog_items):
+        # criteria: [(關鍵詞, [(評分項目索引, 細項索引)])]
+        self.criteria = criteria
+        self.dialog_items = dialog_items
+
+    @property
+    def criterion_indices(self):
+        return list(dict.fromkeys(i for _, targets in self.criteria for i, _ in targets))
+
+
+class CaseKeywordMatcher:
+    """同一案例（評分標準 + 對話腳本）所有關鍵詞編譯成的單一自動機
+
+    一次掃描同時得到評分項目與對話項目：評分項目命中傳給 ScoreEngine，
+    對話項目命中作為混合檢索的一個排名（見 PatientIndex.retrieve）。
+    評分項目部分與 CompiledRubric.match_keywords 的結果相同，
+    沒有病人索引的後台評分（score_message）直接使用後者。
+    """
+
+    def __init__(self, rubric=None, dialog_json=None):
+        self.automaton = AhoCorasick()
+        if rubric is not None:
+            for keyword, targets in rubric.keyword_targets.items():
+                for target in targets:
+                    self.automaton.add(keyword, ('criterion', target))
+        # 對話項目 id 與檢索結果一致（dialog_items 統一轉為字符串，沒有 id 時用位置）
+        for item in dialog_items(dialog_json):
+            for keyword in item['keywords']:
+                self.automaton.add(keyword, ('dialog', item['id']))
+        self.automaton.build()
+
+    @classmethod
+    def from_automaton(cls, automaton):
+        """以已編譯的自動機（例如從病例文件載入）建立匹配器"""
+        matcher = cls.__new__(cls)
+        matcher.automaton = automaton
+        return matcher
+
+    def match(self, text):
+        criteria = OrderedDict()
+        matched_items = []
+        for _, keyword, payloads in self.automaton.find_all(text):
+            for kind, value in payloads:
+                if kind == 'criterion':
+                    targets = criteria.setdefault(keyword, [])
+                    if value not in targets:
+                        targets.append(value)
+                elif value not in matched_items:
+                    matched_items.append(value)
+        return KeywordMatches(list(criteria.items()), matched_items)
+
+
+_case_matchers = OrderedDict()
+_case_matchers_lock = threading.Lock()
+
+
+def cache_case_matcher(rubric_version, index_version, matcher, max_entries=64):
+    """放入預先編譯的案例自動機，返回緩存中的匹配器"""
+    with _case_matchers_lock:
+        matcher = _case_matchers.setdefault((rubric_version, index_version), matcher)
+        while len(_case_matchers) > max_entries:
+            _case_matchers.popitem(last=False)
+    return matcher
+
+
+def get_case_matcher(rubric, patient_index, max_entries=64):
+    """按 (評分標準版本, 對話索引版本) 緩存案例關鍵詞自動機"""
+    key = (rubric.version, patient_index.version)
+    with _case_matchers_lock:
+        matcher = _case_matchers.get(key)
+        if matcher is not None:
+            _case_matchers.move_to_end(key)
+            return matcher
+    matcher = CaseKeywordMatcher(rubric, patient_index.dialog_json)
+    with _case_matchers_lock:
+        matcher = _case_matchers.setdefault(key, matcher)
+        while len(_case_matchers) > max_entries:
+            _case_matchers.popitem(last=False)
+    return matcher
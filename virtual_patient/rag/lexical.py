@@ -0,0 +1,86 @@
+import math
+import unicodedata
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from .embeddings import normalize_text
+
+
+def char_bigrams(text):
+    """中文字符二元組（去掉標點、空白和符號）；只有一個字時返回該字"""
+    chars = [char for char in normalize_text(text) if unicodedata.category(char)[0] not in 'PZS']
+    if len(chars) < 2:
+        return chars
+    return [chars[i] + chars[i + 1] for i in range(len(chars) - 1)]
+
+
+class BM25Index:
+    """字符二元組 BM25 索引
+
+    每個詞項的倒排列表保存文檔索引與預先計算好的 BM25 權重，
+    查詢時只需對命中的倒排列表做累加。
+    """
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        documents = [Counter(char_bigrams(text)) for text in texts]
+        self.size = len(documents)
+        lengths = np.array([sum(terms.values()) for terms in documents], dtype=np.float32)
+        average_length = float(lengths.mean()) if self.size and lengths.sum() else 1.0
+
+        postings = defaultdict(list)
+        for doc, terms in enumerate(documents):
+            for term, tf in terms.items():
+                postings[term].append((doc, tf))
+
+        self.postings = {}
+        for term, entries in postings.items():
+            df = len(entries)
+            idf = math.log(1 + (self.size - df + 0.5) / (df + 0.5))
+            docs = np.array([doc for doc, _ in entries], dtype=np.int32)
+            tf = np.array([tf for _, tf in entries], dtype=np.float32)
+            weights = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[docs] / average_length))
+            self.postings[term] = (docs, weights.astype(np.float32))
+
+    def scores(self, query):
+        """返回 (BM25 分數向量, 查詢詞項覆蓋率向量)
+
+        覆蓋率為文檔包含的查詢詞項比例，1.0 表示查詢中每個二元組都出現在該文檔。
+        """
+        terms = set(char_bigrams(query))
+        scores = np.zeros(self.size, dtype=np.float32)
+        matched = np.zeros(self.size, dtype=np.float32)
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            docs, weights = posting
+            scores[docs] += weights
+            matched[docs] += 1
+        coverage = matched / len(terms) if terms else matched
+        return scores, coverage
+
+
+def unambiguous_match(scores, coverage, margin=0.7):
+    """詞彙匹配明確時返回最佳文檔索引，否則返回 None
+
+    明確：最佳文檔包含查詢的全部詞項，且第二名的 BM25 分數低於最佳分數的 margin 倍。
+    """
+    if not len(scores):
+        return None
+    best = int(np.argmax(scores))
+    if scores[best] <= 0 or coverage[best] < 1.0:
+        return None
+    if len(scores) > 1:
+        second = np.partition(scores, -2)[-2]
+        if second >= margin * scores[best]:
+            return None
+    return best
+
+
+def reciprocal_rank_fusion(rankings, size, k=60):
+    """倒數排名融合：每個排名列表中第 r 名（從 1 起）得 1 / (k + r)"""
+    fused = np.zeros(size, dtype=np.float32)
+    for ranking in rankings:
+        fused[ranking] += 1.0 / (k + np.arange(1, len(ranking) + 1, dtype=np.float32))
+    return fused
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from conversations.models import VirtualPatient
+from rag.patient_index import sync_patient_data, write_patient_bundle
+
+class Command(BaseCommand):
+    help = '為虛擬病人生成 mmap 嵌入文件，供多個 worker 共享'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', type=str, help='只處理指定名稱的虛擬病人')
+        parser.add_argument('--output', type=str, help='輸出目錄（默認為 RAG_EMBEDDING_BUNDLE_DIR）')
+
+    def handle(self, *args, **kwargs):
+        output = kwargs['output'] or getattr(settings, 'RAG_EMBEDDING_BUNDLE_DIR', None)
+        if not output:
+            self.stdout.write(self.style.ERROR('錯誤: 請指定 --output 或設定 RAG_EMBEDDING_BUNDLE_DIR'))
+            return
+
+        patients = VirtualPatient.objects.all()
+        if kwargs['name']:
+            patients = patients.filter(name=kwargs['name'])
+
+        for patient in patients:
+            path, _ = write_patient_bundle(patient.id, patient.dialog_json, output)
+
+            # 每個觸發語句一行，PatientData.vector_id 指向嵌入文件中的行
+            rows = sync_patient_data(patient.id, output)
+            self.stdout.write(self.style.SUCCESS(f'已生成 "{patient.name}" 的嵌入文件 {path}（{rows} 條）'))
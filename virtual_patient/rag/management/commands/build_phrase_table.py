@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from conversations.models import VirtualPatient
+from rag.dialog_items import dialog_phrases
+from rag.phrase_table import PhraseTable
+
+class Command(BaseCommand):
+    help = '為所有虛擬病人的觸發語句生成跨病例共享的語句表文件'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', type=str, help='輸出文件（默認為 RAG_PHRASE_TABLE_PATH）')
+        parser.add_argument('--batch-size', type=int, default=256, help='每批編碼的病例數')
+
+    def handle(self, *args, **kwargs):
+        output = kwargs['output'] or getattr(settings, 'RAG_PHRASE_TABLE_PATH', None)
+        if not output:
+            raise CommandError('請指定 --output 或設定 RAG_PHRASE_TABLE_PATH')
+
+        table = PhraseTable()
+        patients = VirtualPatient.objects.only('dialog_json').iterator(chunk_size=kwargs['batch_size'])
+        batch = []
+        cases = 0
+        for patient in patients:
+            batch.extend(dialog_phrases(patient.dialog_json)[0])
+            cases += 1
+            if cases % kwargs['batch_size'] == 0:
+                table.rows(batch)
+                batch = []
+        table.rows(batch)
+
+        path = table.save(output)
+        stats = table.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f'已生成語句表 {path}：{cases} 個病例，{stats["requested"]} 條觸發語句，'
+            f'{stats["phrases"]} 個不同語句（去重 {stats["dedup_ratio"]:.0%}），{stats["bytes"] / 1024:.0f} KB'
+        ))
@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from conversations.models import VirtualPatient
+from rag.case_bundle import CaseBundle, case_bundle_path, write_case_bundle
+from rag.patient_index import dialog_content_hash
+
+class Command(BaseCommand):
+    help = '生成、查看和校驗二進位病例文件'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+
+        build = subparsers.add_parser('build', help='為虛擬病人生成病例文件')
+        build.add_argument('--name', type=str, help='只處理指定名稱的虛擬病人')
+        build.add_argument('--output', type=str, help='輸出目錄（默認為 RAG_CASE_BUNDLE_DIR）')
+
+        inspect = subparsers.add_parser('inspect', help='顯示病例文件的頭部與各段')
+        inspect.add_argument('paths', nargs='+')
+
+        verify = subparsers.add_parser('verify', help='完整校驗病例文件')
+        verify.add_argument('paths', nargs='+')
+
+    def handle(self, *args, **kwargs):
+        getattr(self, kwargs['action'])(kwargs)
+
+    def build(self, kwargs):
+        output = kwargs['output'] or getattr(settings, 'RAG_CASE_BUNDLE_DIR', None)
+        if not output:
+            raise CommandError('請指定 --output 或設定 RAG_CASE_BUNDLE_DIR')
+
+        patients = VirtualPatient.objects.all()
+        if kwargs['name']:
+            patients = patients.filter(name=kwargs['name'])
+
+        for patient in patients:
+            path = write_case_bundle(
+                case_bundle_path(output, patient.id, dialog_content_hash(patient.dialog_json)),
+                patient.id, patient.dialog_json, patient.scoring_json, name=patient.name,
+            )
+            self.stdout.write(self.style.SUCCESS(f'已生成 "{patient.name}" 的病例文件 {path}（{path.stat().st_size} 字節）'))
+
+    def inspect(self, kwargs):
+        for path in kwargs['paths']:
+            bundle = CaseBundle(path)
+            for key, value in bundle.summary().items():
+                self.stdout.write(f'{key}: {value}')
+            for name, (offset, length, crc) in bundle.sections.items():
+                self.stdout.write(f'  {name:<8} 偏移 {offset:>10} 長度 {length:>10} crc32 {crc:08x}')
+
+    def verify(self, kwargs):
+        failed = 0
+        for path in kwargs['paths']:
+            try:
+                problems = CaseBundle(path).verify()
+            except (OSError, ValueError) as e:
+                problems = [str(e)]
+            if problems:
+                failed += 1
+                self.stdout.write(self.style.ERROR(f'{path}: {"；".join(problems)}'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{path}: 校驗通過'))
+        if failed:
+            raise CommandError(f'{failed} 個病例文件校驗失敗')
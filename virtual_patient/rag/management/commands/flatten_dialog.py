@@ -0,0 +1,33 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from rag.cases import validate_dialog
+from rag.dialog_items import flatten_dialog
+
+class Command(BaseCommand):
+    help = '把分組格式的對話JSON展開為每個觸發語句一條的嵌入記錄'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dialog', type=str, help='分組格式的對話JSON文件路徑')
+        parser.add_argument('--output', type=str, help='輸出文件路徑（默認輸出到標準輸出）')
+
+    def handle(self, *args, **kwargs):
+        try:
+            with open(kwargs['dialog'], 'r', encoding='utf-8') as f:
+                dialog_json = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'無法讀取 {kwargs["dialog"]}: {e}')
+        errors = validate_dialog(dialog_json)
+        if errors:
+            raise CommandError('；'.join(errors))
+
+        records = flatten_dialog(dialog_json)
+        output = json.dumps(records, ensure_ascii=False, indent=2)
+        if not kwargs['output']:
+            self.stdout.write(output)
+            return
+        with open(kwargs['output'], 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+        unique = len({record['語句id'] for record in records})
+        self.stdout.write(self.style.SUCCESS(
+            f'已寫入 {kwargs["output"]}：{len(dialog_json)} 個對話項目，{len(records)} 條記錄（{unique} 個不同語句）'
+        ))
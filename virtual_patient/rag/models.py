@@ -1,18 +1,20 @@
 from django.db import models
 from accounts.models import User
-from conversations.models import Patient
+from conversations.models import Patient, VirtualPatient
 
 class PatientData(models.Model):
     """虛擬病人的知識庫數據"""
-    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='data')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='data', null=True, blank=True)
+    virtual_patient = models.ForeignKey(VirtualPatient, on_delete=models.CASCADE, related_name='data', null=True, blank=True)
     title = models.CharField(max_length=200)
     content = models.TextField()
-    vector_id = models.CharField(max_length=100, blank=True)  # 向量數據庫中的ID
+    vector_id = models.CharField(max_length=100, blank=True)  # 嵌入文件中的位置，格式為「索引版本:行號」
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
-        return f"{self.patient.name} - {self.title}"
+        patient = self.virtual_patient or self.patient
+        return f"{patient.name if patient else ''} - {self.title}"
 
 class LearningProgress(models.Model):
     """用戶的學習進度記錄"""
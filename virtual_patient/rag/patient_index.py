@@ -0,0 +1,575 @@
+import hashlib
+import json
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .dialog_items import dialog_items, dialog_phrases
+from .embedding_bundle import EmbeddingBundle, bundle_path, load_bundle, make_vector_id, write_bundle
+from .lexical import BM25Index, reciprocal_rank_fusion, unambiguous_match
+from .phrase_table import get_phrase_table
+from .vector_store import VectorStore, max_pool, top_k_indices
+
+DIALOG_COLLECTION = 'dialog_questions'
+
+logger = logging.getLogger(__name__)
+
+
+class IndexVersionUnavailable(LookupError):
+    """進行中對話的索引版本已無法取得或重建"""
+
+
+def dialog_content_hash(dialog_json):
+    """計算對話 JSON 的內容雜湊，作為索引版本號"""
+    payload = json.dumps(dialog_json, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def write_patient_bundle(patient_id, dialog_json, directory, encoder=None):
+    """編碼病人對話的全部觸發語句並寫入嵌入文件，返回 (文件路徑, 版本)
+
+    嵌入文件的 ids 為每行所屬的對話項目 id。
+    """
+    vector_store = VectorStore(encoder)
+    version = dialog_content_hash(dialog_json)
+    phrases, item_ids = dialog_phrases(dialog_json)
+    path = write_bundle(
+        bundle_path(directory, patient_id, version),
+        vector_store.embed(phrases),
+        ids=item_ids,
+        texts=phrases,
+        model_id=vector_store.encoder.model_id,
+        version=version,
+    )
+    return path, version
+
+
+def sync_patient_data(patient_id, directory=None):
+    """按病人當前對話重寫 PatientData，vector_id 指向嵌入文件中的實際行
+
+    鎖住病人行後按當前對話版本找嵌入文件，以文件的行序（增量更新後與對話順序不同）寫入；
+    沒有該版本的嵌入文件時 vector_id 留空。返回寫入的行數。
+    """
+    from conversations.models import VirtualPatient
+
+    from .models import PatientData
+
+    with transaction.atomic():
+        patient = VirtualPatient.objects.select_for_update().get(pk=patient_id)
+        version = dialog_content_hash(patient.dialog_json)
+        answers = {item['id']: item['answer'] for item in dialog_items(patient.dialog_json)}
+        path = bundle_path(directory, patient_id, version) if directory else None
+        if path is not None and path.exists():
+            bundle = EmbeddingBundle(path)
+            rows = [(item_id, phrase, make_vector_id(version, row)) for row, (item_id, phrase) in enumerate(zip(bundle.ids, bundle.texts))]
+        else:
+            rows = [(item_id, phrase, '') for phrase, item_id in zip(*dialog_phrases(patient.dialog_json))]
+        PatientData.objects.filter(virtual_patient=patient).delete()
+        PatientData.objects.bulk_create([
+            PatientData(virtual_patient=patient, title=phrase[:200], content=answers[item_id], vector_id=vector_id)
+            for item_id, phrase, vector_id in rows
+        ])
+    return len(rows)
+
+
+class PatientIndex:
+    """單一病人、單一版本的唯讀檢索索引，由所有對話共享
+
+    每個觸發語句是一行，指向所屬的對話項目；檢索按項目對其語句取最大分數，
+    返回 top_k 個不重複的項目。
+    使用共享語句表 phrase_table 時索引只保存各行在表中的行號，不持有自己的嵌入矩陣，
+    檢索時直接從共享表中取本病例的行計算分數。
+    """
+
+    def __init__(self, patient_id, version, vector_store, dialog_json=None, phrase_table=None):
+        self.patient_id = patient_id
+        self.version = version
+        self.vector_store = vector_store
+        self.dialog_json = dialog_json or []
+        self.items = dialog_items(self.dialog_json)
+        self.phrase_table = phrase_table
+        if phrase_table is None:
+            collection = vector_store.collections[DIALOG_COLLECTION]
+            self.texts = collection['texts']
+            self._embeddings = collection['embeddings']
+            self.metadata = collection['metadata']
+            self.phrase_rows = None
+        else:
+            self.texts, item_ids = dialog_phrases(self.dialog_json)
+            self.metadata = [{'item_id': item_id} for item_id in item_ids]
+            self.phrase_rows, encoded = phrase_table.rows(self.texts)
+        # 增量更新留下的墓碑行 item_id 為 None，不參與檢索
+        self.positions = {item['id']: position for position, item in enumerate(self.items)}
+        self.row_items = np.array(
+            [self.positions[metadata['item_id']] if metadata.get('item_id') is not None else -1 for metadata in self.metadata],
+            dtype=np.int64,
+        )
+        self.live_rows = np.flatnonzero(self.row_items >= 0)
+        self.tombstones = len(self.texts) - len(self.live_rows)
+        # 構建本版本時實際編碼的語句數
+        self.encoded = len(self.texts) if phrase_table is None else encoded
+        # 與向量索引同一組語句的字符二元組 BM25 索引
+        self.lexical = BM25Index([text if item >= 0 else '' for text, item in zip(self.texts, self.row_items)])
+        self.lookups = 0
+        self.lexical_only = 0
+        self._stats_lock = threading.Lock()
+
+    @property
+    def embeddings(self):
+        """觸發語句的嵌入矩陣；使用共享語句表時每次按行號從表中取出一份臨時副本（只用於寫文件等）"""
+        if self.phrase_table is not None:
+            return self.phrase_table.embeddings[self.phrase_rows]
+        return self._embeddings
+
+    def row_scores(self, query_vector):
+        """每行觸發語句與查詢的餘弦相似度
+
+        使用共享語句表時只取本病例的行參與計算，取出的行在本次計算後即釋放，
+        各病例不各自保留一份語句矩陣。
+        """
+        if self.phrase_table is not None:
+            return np.take(self.phrase_table.embeddings, self.phrase_rows, axis=0) @ query_vector
+        return self._embeddings @ query_vector
+
+    @classmethod
+    def build(cls, patient_id, dialog_json, encoder=None, bundle_dir=None, previous=None, phrase_table=None):
+        """為病人對話的觸發語句建立向量索引
+
+        傳入共享語句表時只編碼表中還沒有的語句，使用表的編碼器，不讀寫嵌入文件；
+        否則若 bundle_dir 中有同版本、同模型的嵌入文件，直接 mmap 載入，不重新編碼；
+        否則有同一病人的舊版本索引 previous 時增量更新，只編碼新增或改動的語句。
+        """
+        version = dialog_content_hash(dialog_json)
+        if phrase_table is not None:
+            return cls(patient_id, version, phrase_table.vector_store, dialog_json, phrase_table=phrase_table)
+        vector_store = VectorStore(encoder)
+        bundle = load_bundle(bundle_dir, patient_id, version, vector_store.encoder.model_id)
+        if bundle is None and previous is not None and previous.vector_store.encoder.model_id == vector_store.encoder.model_id:
+            return previous.update(dialog_json)
+        if bundle is not None:
+            metadata = [{'item_id': item_id} for item_id in bundle.ids]
+            vector_store.add_collection(
+                DIALOG_COLLECTION, bundle.texts, metadata=metadata, embeddings=bundle.embeddings, normalized=True
+            )
+        else:
+            phrases, item_ids = dialog_phrases(dialog_json)
+            vector_store.add_collection(DIALOG_COLLECTION, phrases, metadata=[{'item_id': item_id} for item_id in item_ids])
+        vector_store.freeze()
+        index = cls(patient_id, version, vector_store, dialog_json)
+        if bundle is not None:
+            index.encoded = 0
+        return index
+
+    def update(self, dialog_json, compact_ratio=0.25):
+        """按對話項目 id 增量生成新版本索引；本索引保持不變，仍在使用它的對話不受影響
+
+        (項目 id, 語句) 未變的行直接沿用嵌入，只編碼新增或改動的語句並追加到矩陣末尾；
+        刪除或改動前的舊語句所在行成為墓碑。墓碑超過存活行的 compact_ratio 時壓縮矩陣
+        （只複製存活行，不重新編碼）。
+        """
+        version = dialog_content_hash(dialog_json)
+        if version == self.version:
+            return self
+        if self.phrase_table is not None:
+            return PatientIndex(self.patient_id, version, self.vector_store, dialog_json, phrase_table=self.phrase_table)
+
+        live = {(self.metadata[row]['item_id'], self.texts[row]): row for row in self.live_rows.tolist()}
+        reused = {}
+        added_phrases = []
+        added_ids = []
+        for phrase, item_id in zip(*dialog_phrases(dialog_json)):
+            row = live.pop((item_id, phrase), None)
+            if row is None:
+                added_phrases.append(phrase)
+                added_ids.append(item_id)
+            else:
+                reused[row] = item_id
+        added = self.vector_store.embed(added_phrases) if added_phrases else np.zeros((0, self.embeddings.shape[1]), dtype=np.float32)
+
+        if len(self.texts) - len(reused) > compact_ratio * (len(reused) + len(added_phrases)):
+            rows = sorted(reused)
+            texts = [self.texts[row] for row in rows] + added_phrases
+            item_ids = [reused[row] for row in rows] + added_ids
+            embeddings = np.concatenate([self.embeddings[rows], added])
+        else:
+            texts = list(self.texts) + added_phrases
+            item_ids = [reused.get(row) for row in range(len(self.texts))] + added_ids
+            embeddings = np.concatenate([self.embeddings, added])
+
+        vector_store = VectorStore(self.vector_store.encoder)
+        vector_store.add_collection(
+            DIALOG_COLLECTION, texts, metadata=[{'item_id': item_id} for item_id in item_ids],
+            embeddings=embeddings, normalized=True,
+        )
+        vector_store.freeze()
+        index = PatientIndex(self.patient_id, version, vector_store, dialog_json)
+        index.encoded = len(added_phrases)
+        return index
+
+    def write_bundle(self, directory):
+        """把存活行寫入本版本的嵌入文件，返回文件路徑"""
+        rows = self.live_rows
+        return write_bundle(
+            bundle_path(directory, self.patient_id, self.version),
+            self.embeddings[rows],
+            ids=[self.metadata[row]['item_id'] for row in rows],
+            texts=[self.texts[row] for row in rows],
+            model_id=self.vector_store.encoder.model_id,
+            version=self.version,
+        )
+
+    def pool(self, row_scores):
+        """把每行分數按對話項目取最大值（跳過墓碑行），返回 (項目分數, 項目的最佳行)"""
+        if not self.tombstones:
+            return max_pool(row_scores, self.row_items, len(self.items))
+        pooled, best_rows = max_pool(row_scores[self.live_rows], self.row_items[self.live_rows], len(self.items))
+        found = best_rows >= 0
+        best_rows[found] = self.live_rows[best_rows[found]]
+        return pooled, best_rows
+
+    def search(self, query, top_k=1):
+        """純向量檢索，返回 top_k 個不重複的對話項目"""
+        if not self.texts:
+            return []
+        return self.search_vector(self.vector_store.embed([query])[0], top_k)
+
+    def search_vector(self, query_vector, top_k=1):
+        if not self.texts:
+            return []
+        vector_scores, best_rows = self.pool(self.row_scores(query_vector))
+        return [
+            self._result(item, best_rows[item], vector_scores[item], vector_scores[item], None)
+            for item in top_k_indices(vector_scores, top_k) if best_rows[item] >= 0
+        ]
+
+    def retrieve(self, query, query_vector=None, encode=None, top_k=1, keyword_items=None):
+        """詞彙 + 向量混合檢索，返回 top_k 個不重複的對話項目
+
+        兩種分數都先按項目對其觸發語句取最大值。
+        keyword_items 為案例關鍵詞自動機命中的對話項目 id（按出現順序）；
+        關鍵詞不在觸發語句的詞彙索引中，命中的項目作為第三個排名參與融合。
+        未提供查詢嵌入且詞彙匹配明確（有關鍵詞命中時最佳項目須在其中）時直接返回詞彙結果，不調用編碼器；
+        否則以倒數排名融合各項目排名。結果的 score 取餘弦相似度與詞項覆蓋率的較大者，
+        與純向量檢索的閾值可直接比較。
+        """
+        if not self.texts:
+            return []
+        row_lexical, row_coverage = self.lexical.scores(query)
+        lexical_scores, lexical_rows = self.pool(row_lexical)
+        coverage = np.where(lexical_rows >= 0, row_coverage[lexical_rows], 0)
+        keyword_hits = [self.positions[item_id] for item_id in keyword_items or () if item_id in self.positions]
+        if query_vector is None:
+            best = unambiguous_match(np.maximum(lexical_scores, 0), coverage)
+            if keyword_hits and best not in keyword_hits:
+                best = None
+            with self._stats_lock:
+                self.lookups += 1
+                if best is not None:
+                    self.lexical_only += 1
+            if best is not None:
+                return [self._result(best, lexical_rows[best], coverage[best], None, lexical_scores[best])]
+            query_vector = encode(query) if encode else self.vector_store.embed([query])[0]
+        else:
+            with self._stats_lock:
+                self.lookups += 1
+
+        vector_scores, vector_rows = self.pool(self.row_scores(query_vector))
+        retrievable = np.flatnonzero(vector_rows >= 0)
+        rankings = [retrievable[np.argsort(-vector_scores[retrievable])]]
+        lexical_hits = np.flatnonzero(lexical_scores > 0)
+        if len(lexical_hits):
+            rankings.append(lexical_hits[np.argsort(-lexical_scores[lexical_hits])])
+        keyword_hits = [item for item in keyword_hits if vector_rows[item] >= 0]
+        if keyword_hits:
+            rankings.append(np.array(keyword_hits, dtype=np.int64))
+        fused = reciprocal_rank_fusion(rankings, len(self.items))
+        return [
+            self._result(
+                item, vector_rows[item], max(float(vector_scores[item]), float(coverage[item])),
+                vector_scores[item], max(float(lexical_scores[item]), 0.0),
+            )
+            for item in top_k_indices(fused, min(top_k, len(retrievable)))
+        ]
+
+    def _result(self, item, row, score, vector_score, lexical_score):
+        return {
+            'index': int(item),
+            'text': self.texts[row],
+            'answer': self.items[item]['answer'],
+            'score': float(score),
+            'metadata': self.metadata[row],
+            'vector_score': None if vector_score is None else float(vector_score),
+            'lexical_score': None if lexical_score is None else float(lexical_score),
+        }
+
+    def retrieval_stats(self):
+        """檢索次數及跳過編碼器（僅詞彙匹配）的次數與比例"""
+        with self._stats_lock:
+            return {
+                'lookups': self.lookups,
+                'lexical_only': self.lexical_only,
+                'lexical_only_rate': self.lexical_only / self.lookups if self.lookups else 0.0,
+            }
+
+
+class PatientIndexRegistry:
+    """按 (病人ID, 內容雜湊) 緩存索引，每個病人只構建一次
+
+    每個病人的最新版本用於新對話；被取代的版本仍由進行中的對話使用，
+    按 (病人ID, 版本) 保留（仍被引用的全部保留，另外保留最近的 max_superseded 個），
+    重建的處理器以 get_version 取回對話開始時的版本。
+    background=True 時，已有索引的病人出現新版本會在後台構建（read-copy-update）：
+    構建期間請求繼續拿到當前版本，完成後以一次引用替換發佈，之後的新對話使用新版本。
+    """
+
+    def __init__(self, encoder=None, bundle_dir=None, background=False, phrase_table=None, max_superseded=32):
+        self.encoder = encoder
+        self.bundle_dir = bundle_dir
+        self.phrase_table = phrase_table
+        self.background = background
+        self.max_superseded = max_superseded
+        self._indexes = {}
+        self._superseded = OrderedDict()  # (病人ID, 版本) -> 被取代的索引
+        self._in_use = weakref.WeakValueDictionary()  # (病人ID, 版本) -> 仍被引用的索引
+        self._build_locks = {}
+        self._refreshing = {}  # 病人ID -> (版本, Future)
+        self._executor = None
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def get(self, patient_id, dialog_json, scoring_json=None):
+        """取得病人當前版本的索引，不存在時構建
+
+        傳入 scoring_json 時，從病例文件載入的評分標準與之一致才放入共享緩存。
+        """
+        version = dialog_content_hash(dialog_json)
+        index = self._indexes.get(patient_id)
+        if index is not None and index.version == version:
+            return index
+        if index is not None and self.background:
+            self.refresh(patient_id, dialog_json)
+            return index
+
+        with self._lock:
+            build_lock = self._build_locks.setdefault((patient_id, version), threading.Lock())
+
+        # 同一版本只讓一個請求構建，其他請求等待後直接取用結果
+        with build_lock:
+            index = self._indexes.get(patient_id)
+            if index is None or index.version != version:
+                # 從舊版本增量構建新版本，構建完成後才替換引用；舊版本仍由進行中的對話持有
+                index = self._replace(patient_id, self._build(patient_id, dialog_json, previous=index, scoring_json=scoring_json))
+
+        with self._lock:
+            self._build_locks.pop((patient_id, version), None)
+        return index
+
+    def _build(self, patient_id, dialog_json, previous=None, scoring_json=None):
+        index = self._load_case_bundle(patient_id, dialog_content_hash(dialog_json), scoring_json)
+        if index is not None:
+            return index
+        phrase_table = self.phrase_table
+        if phrase_table is None and getattr(settings, 'RAG_SHARED_PHRASE_TABLE', False):
+            phrase_table = get_phrase_table()
+        bundle_dir = self.bundle_dir or getattr(settings, 'RAG_EMBEDDING_BUNDLE_DIR', None)
+        return PatientIndex.build(patient_id, dialog_json, self.encoder, bundle_dir, previous=previous, phrase_table=phrase_table)
+
+    def _load_case_bundle(self, patient_id, version, scoring_json=None):
+        """RAG_CASE_BUNDLE_DIR 中有同版本、同模型的病例文件時直接載入
+
+        文件中的評分標準與 scoring_json 版本一致時，同時把它和案例自動機放入共享緩存，
+        開始對話時不再編譯；評分標準已更新或未傳入時只使用對話部分。
+        """
+        case_dir = getattr(settings, 'RAG_CASE_BUNDLE_DIR', None)
+        if not case_dir:
+            return None
+        from .case_bundle import load_case_bundle
+        from .keyword_matcher import cache_case_matcher
+        from .rubric import compiled_rubrics, rubric_content_hash
+
+        encoder = VectorStore(self.encoder).encoder
+        bundle = load_case_bundle(case_dir, patient_id, version, encoder.model_id)
+        if bundle is None:
+            return None
+        if scoring_json is not None and bundle.rubric_version == rubric_content_hash(scoring_json):
+            compiled_rubrics.put(bundle.compiled_rubric(encoder))
+            cache_case_matcher(bundle.rubric_version, bundle.dialog_version, bundle.keyword_matcher())
+        return bundle.patient_index(encoder)
+
+    def refresh(self, patient_id, dialog_json):
+        """在後台線程構建病人的新版本索引，完成後替換引用，返回 Future
+
+        同一版本已在構建時返回同一個 Future。
+        """
+        version = dialog_content_hash(dialog_json)
+        with self._lock:
+            pending = self._refreshing.get(patient_id)
+            if pending is not None and pending[0] == version:
+                return pending[1]
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='index-build')
+            future = self._executor.submit(self._publish, patient_id, dialog_json, version)
+            self._refreshing[patient_id] = (version, future)
+        return future
+
+    def _publish(self, patient_id, dialog_json, version):
+        try:
+            current = self._indexes.get(patient_id)
+            if current is not None and current.version == version:
+                return current
+            return self._replace(patient_id, self._build(patient_id, dialog_json, previous=current))
+        finally:
+            with self._lock:
+                if self._refreshing.get(patient_id, (None,))[0] == version:
+                    del self._refreshing[patient_id]
+
+    def _replace(self, patient_id, index):
+        """發佈病人的新版本索引，被取代的版本留給仍在使用它的對話"""
+        with self._lock:
+            previous = self._indexes.get(patient_id)
+            if previous is not None and previous.version != index.version:
+                self._superseded[(patient_id, previous.version)] = previous
+                while len(self._superseded) > self.max_superseded:
+                    self._superseded.popitem(last=False)
+            self._in_use[(patient_id, index.version)] = index
+            self._superseded.pop((patient_id, index.version), None)
+            # 單次引用賦值即發佈：讀取方要麼拿到舊版本，要麼拿到完整的新版本
+            self._indexes[patient_id] = index
+        return index
+
+    def get_version(self, patient_id, version, scoring_json=None, dialog_json=None):
+        """取得病人指定版本的索引（進行中的對話重建處理器時使用），找不到時返回 None
+
+        依次查找當前版本、仍被引用或保留的舊版本，以及 RAG_CASE_BUNDLE_DIR 中該版本的病例文件；
+        dialog_json 為該版本的對話快照，都沒有時以它重新構建（不替換病人的當前版本）。
+        """
+        index = self._cached_version(patient_id, version)
+        if index is not None:
+            return index
+        if dialog_json is not None and dialog_content_hash(dialog_json) != version:
+            dialog_json = None
+
+        key = (patient_id, version)
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            index = self._cached_version(patient_id, version)
+            if index is None:
+                if dialog_json is not None:
+                    index = self._build(patient_id, dialog_json, scoring_json=scoring_json)
+                else:
+                    index = self._load_case_bundle(patient_id, version, scoring_json)
+                if index is not None:
+                    with self._lock:
+                        self._superseded[key] = index
+                        while len(self._superseded) > self.max_superseded:
+                            self._superseded.popitem(last=False)
+        with self._lock:
+            self._build_locks.pop(key, None)
+        return index
+
+    def _cached_version(self, patient_id, version):
+        index = self._indexes.get(patient_id)
+        if index is not None and index.version == version:
+            return index
+        key = (patient_id, version)
+        with self._lock:
+            index = self._superseded.get(key)
+            if index is not None:
+                self._superseded.move_to_end(key)
+                return index
+            return self._in_use.get(key)
+
+    def watch(self, interval):
+        """啟動病例更新檢查線程（每個註冊表只啟動一次）"""
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = CaseWatcher(self, interval)
+                self._watcher.start()
+        return self._watcher
+
+    def cached_patients(self):
+        return list(self._indexes)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._superseded.clear()
+            self._in_use.clear()
+
+    def retrieval_stats(self):
+        """各病人當前索引的檢索統計"""
+        return {patient_id: index.retrieval_stats() for patient_id, index in list(self._indexes.items())}
+
+
+class CaseWatcher(threading.Thread):
+    """定期檢查已緩存病人的病例是否在數據庫中更新（VirtualPatient.updated_at），有更新時在後台構建新版本"""
+
+    def __init__(self, registry, interval):
+        super().__init__(name='case-watcher', daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self.since = timezone.now()
+        self._stopped = threading.Event()
+
+    def poll(self):
+        """檢查一次，返回已提交的後台構建 Future 列表"""
+        from conversations.models import VirtualPatient
+
+        patient_ids = self.registry.cached_patients()
+        if not patient_ids:
+            return []
+        changed = VirtualPatient.objects.filter(id__in=patient_ids, updated_at__gt=self.since)
+        futures = []
+        for patient_id, dialog_json, updated_at in changed.values_list('id', 'dialog_json', 'updated_at'):
+            self.since = max(self.since, updated_at)
+            futures.append(self.registry.refresh(patient_id, dialog_json))
+        return futures
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('檢查病例更新失敗')
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self._stopped.set()
+
+
+patient_indexes = PatientIndexRegistry(background=True)
+
+
+def get_patient_index(virtual_patient, version=None):
+    """取得虛擬病人的共享檢索索引
+
+    指定 version 時返回該版本（進行中的對話）：緩存和病例文件中都沒有時，
+    以對話開始時保存的對話快照（DialogVersion）重新構建；沒有快照時拋出 IndexVersionUnavailable，
+    不改用當前版本，以免對話中途換成另一份腳本。
+    設定了 RAG_CASE_RELOAD_INTERVAL 時同時啟動病例更新檢查線程。
+    """
+    interval = getattr(settings, 'RAG_CASE_RELOAD_INTERVAL', None)
+    if interval:
+        patient_indexes.watch(interval)
+    if not version:
+        return patient_indexes.get(virtual_patient.id, virtual_patient.dialog_json, virtual_patient.scoring_json)
+
+    index = patient_indexes.get_version(virtual_patient.id, version, virtual_patient.scoring_json)
+    if index is None:
+        from conversations.models import DialogVersion
+
+        snapshot = DialogVersion.objects.filter(virtual_patient_id=virtual_patient.id, version=version).values_list('dialog_json', flat=True).first()
+        if snapshot is not None:
+            index = patient_indexes.get_version(virtual_patient.id, version, virtual_patient.scoring_json, dialog_json=snapshot)
+    if index is None:
+        raise IndexVersionUnavailable(f'病人 {virtual_patient.id} 的索引版本 {version} 已不可用')
+    return index
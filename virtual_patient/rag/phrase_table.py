@@ -0,0 +1,135 @@
+import hashlib
+import threading
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+from .embedding_bundle import EmbeddingBundle, write_bundle
+from .embeddings import normalize_text
+from .vector_store import VectorStore
+
+
+def phrase_id(text):
+    """語句的內容地址：標準化文本的雜湊，與病例和模型無關"""
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()[:16]
+
+
+class PhraseTable:
+    """跨病例共享、按內容定址的觸發語句表
+
+    標準化後相同的語句只存一行、只編碼一次；病例索引只保存語句在表中的行號。
+    表只追加不修改，已發佈的行號和向量不會改變，讀取無需加鎖。
+    """
+
+    def __init__(self, encoder=None, capacity=1024):
+        self.vector_store = VectorStore(encoder)
+        self.encoder = self.vector_store.encoder
+        self.ids = []
+        self.texts = []
+        self._rows = {}
+        self._matrix = np.zeros((capacity, self.encoder.dim), dtype=np.float32)
+        self._embeddings = self._publish(0)
+        self.requested = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def embeddings(self):
+        """已發佈行的唯讀矩陣"""
+        return self._embeddings
+
+    def _publish(self, rows):
+        view = self._matrix[:rows]
+        view.setflags(write=False)
+        return view
+
+    def _append(self, keys, texts, vectors):
+        rows = len(self.ids)
+        if rows + len(keys) > len(self._matrix):
+            # 擴容時複製到新緩衝區；正在使用舊矩陣的讀取方仍持有舊緩衝區
+            matrix = np.zeros((max(2 * len(self._matrix), rows + len(keys)), self.encoder.dim), dtype=np.float32)
+            matrix[:rows] = self._matrix[:rows]
+            self._matrix = matrix
+        self._matrix[rows:rows + len(keys)] = vectors
+        for key, text in zip(keys, texts):
+            self._rows[key] = len(self.ids)
+            self.ids.append(key)
+            self.texts.append(text)
+        self._embeddings = self._publish(len(self.ids))
+
+    def rows(self, phrases):
+        """返回 (每個語句在表中的行號, 本次新編碼的語句數)；表中沒有的語句去重後一次編碼"""
+        phrases = list(phrases)
+        keys = [phrase_id(phrase) for phrase in phrases]
+        with self._lock:
+            self.requested += len(phrases)
+            # 標準化文本只用於定址，編碼和保存的是每個地址第一次出現的原文
+            missing = {}
+            for key, phrase in zip(keys, phrases):
+                if key not in self._rows:
+                    missing.setdefault(key, phrase)
+        encoded = 0
+        if missing:
+            vectors = self.vector_store.embed(list(missing.values()))
+            with self._lock:
+                # 其他線程可能已同時加入了部分語句
+                new = [i for i, key in enumerate(missing) if key not in self._rows]
+                if new:
+                    new_keys = list(missing)
+                    self._append([new_keys[i] for i in new], [missing[new_keys[i]] for i in new], vectors[new])
+                encoded = len(new)
+        rows = self._rows
+        return np.array([rows[key] for key in keys], dtype=np.int64), encoded
+
+    def save(self, path):
+        """把整個表寫入嵌入文件（ids 為語句內容地址，texts 為首次加入時的原文）"""
+        with self._lock:
+            rows = len(self.ids)
+            ids = list(self.ids)
+            texts = list(self.texts)
+        return write_bundle(
+            path, self._matrix[:rows], ids=ids, texts=texts, model_id=self.encoder.model_id,
+            version=hashlib.sha256(''.join(ids).encode('ascii')).hexdigest()[:16],
+        )
+
+    @classmethod
+    def load(cls, path, encoder=None):
+        """從嵌入文件載入語句表，模型不一致時返回空表"""
+        table = cls(encoder)
+        bundle = EmbeddingBundle(path)
+        if bundle.model_id == table.encoder.model_id and len(bundle):
+            table._append(bundle.ids, bundle.texts, bundle.embeddings)
+        return table
+
+    def stats(self):
+        """語句表大小與去重效果"""
+        with self._lock:
+            unique = len(self.ids)
+            requested = self.requested
+        return {
+            'phrases': unique,
+            'requested': requested,
+            'dedup_ratio': 1 - unique / requested if requested else 0.0,
+            'bytes': unique * self.encoder.dim * 4,
+        }
+
+
+_phrase_table = None
+_phrase_table_lock = threading.Lock()
+
+
+def get_phrase_table():
+    """取得進程內共享的語句表；設定了 RAG_PHRASE_TABLE_PATH 且文件存在時從文件載入"""
+    global _phrase_table
+    if _phrase_table is None:
+        with _phrase_table_lock:
+            if _phrase_table is None:
+                path = getattr(settings, 'RAG_PHRASE_TABLE_PATH', None)
+                if path and Path(path).exists():
+                    _phrase_table = PhraseTable.load(path)
+                else:
+                    _phrase_table = PhraseTable()
+    return _phrase_table
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .keyword_matcher import AhoCorasick
+from .vector_store import VectorStore
+
+CRITERIA_COLLECTION = 'criteria'
+
+
+def parse_sub_items(item):
+    """取得評分項目的細項：優先使用「細項」欄位，否則解析語義提示括號內的列表"""
+    if item.get('細項'):
+        return list(item['細項'])
+    match = re.search(r'[（(]([^）)]+)[）)]', item.get('語義提示', ''))
+    if not match:
+        return []
+    return [part.strip() for part in re.split(r'[、,，]', match.group(1)) if part.strip()]
+
+
+def rubric_content_hash(criteria):
+    """計算評分標準 JSON 的內容雜湊，作為評分表版本號"""
+    payload = json.dumps(criteria, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class CompiledRubric:
+    """編譯後的評分標準，同一版本由所有對話共享且不可修改
+
+    包含語義提示的嵌入矩陣、關鍵詞匹配器以及分類/配分表。
+    """
+
+    def __init__(self, criteria, version, vector_store):
+        self.criteria = list(criteria)
+        self.version = version
+        self.vector_store = vector_store
+        self.ids = [item['id'] for item in self.criteria]
+        self.index_of = {criterion_id: i for i, criterion_id in enumerate(self.ids)}
+
+        # 分類與配分表
+        self.categories = list(dict.fromkeys(item.get('分類', '') for item in self.criteria))
+        category_index = {name: i for i, name in enumerate(self.categories)}
+        self.category_of = np.array([category_index[item.get('分類', '')] for item in self.criteria], dtype=np.int32)
+        self.points = np.array([item.get('配分', 0) for item in self.criteria], dtype=np.int32)
+        self.max_score = int(self.points.sum())
+
+        # 關鍵詞 -> [(評分項目索引, 細項索引)]，細項索引 -1 表示項目本身的關鍵詞
+        self.sub_items = [parse_sub_items(item) for item in self.criteria]
+        self.keyword_targets = {}
+        for i, item in enumerate(self.criteria):
+            sub_items = self.sub_items[i]
+            keywords = [(keyword, -1) for keyword in item.get('關鍵詞', []) if keyword not in sub_items]
+            for j, name in enumerate(sub_items):
+                keywords.append((name, j))
+                # 「有無血絲」在提問中通常寫作「有沒有血絲」，也匹配「血絲」
+                if name.startswith('有無') and len(name) > 2:
+                    keywords.append((name[2:], j))
+            for keyword, j in keywords:
+                if not keyword:
+                    continue
+                targets = self.keyword_targets.setdefault(keyword, [])
+                if (i, j) not in targets:
+                    targets.append((i, j))
+        self.keyword_automaton = AhoCorasick()
+        for keyword, targets in self.keyword_targets.items():
+            for target in targets:
+                self.keyword_automaton.add(keyword, target)
+        self.keyword_automaton.build()
+
+    @classmethod
+    def build(cls, criteria, encoder=None):
+        """編碼所有語義提示並建立唯讀索引"""
+        vector_store = VectorStore(encoder)
+        vector_store.add_collection(CRITERIA_COLLECTION, [item['語義提示'] for item in criteria], metadata=criteria)
+        vector_store.freeze()
+        return cls(criteria, rubric_content_hash(criteria), vector_store)
+
+    def __len__(self):
+        return len(self.criteria)
+
+    @property
+    def embeddings(self):
+        return self.vector_store.collections[CRITERIA_COLLECTION]['embeddings']
+
+    def similarities(self, query_vector):
+        """一次矩陣向量乘積計算查詢與所有評分項目的相似度"""
+        return self.embeddings @ query_vector
+
+    def match_keywords(self, text):
+        """一次線性掃描返回文本中出現的所有關鍵詞及其 [(評分項目索引, 細項索引)]"""
+        return [(keyword, targets) for _, keyword, targets in self.keyword_automaton.find_all(text)]
+
+    def search_vector(self, query_vector, top_k=1):
+        return self.vector_store.search_vector(CRITERIA_COLLECTION, query_vector, top_k=top_k)
+
+    def search(self, text, top_k=1):
+        return self.vector_store.search(CRITERIA_COLLECTION, text, top_k=top_k)
+
+    def category_totals(self, scores):
+        """根據每個評分項目的得分向量計算各分類總分"""
+        totals = np.bincount(self.category_of, weights=scores, minlength=len(self.categories))
+        return {name: int(total) for name, total in zip(self.categories, totals)}
+
+    def breakdown(self, coverage):
+        """根據覆蓋情況 {評分項目ID: {score, sub_items}} 展開每個評分項目的得分明細"""
+        items = []
+        for i, item in enumerate(self.criteria):
+            covered = coverage.get(self.ids[i], {})
+            score = int(covered.get('score', 0))
+            items.append({
+                'category': item.get('分類', ''),
+                'criterion_id': self.ids[i],
+                'name': item.get('項目', self.ids[i]),
+                'score': score,
+                'max_score': int(self.points[i]),
+                'completed': score > 0,
+                'sub_items': self.sub_items[i],
+                'covered_sub_items': list(covered.get('sub_items', [])),
+            })
+        return items
+
+
+class RubricRegistry:
+    """按內容雜湊緩存編譯後的評分標準，同一版本只編譯一次"""
+
+    def __init__(self, encoder=None, max_entries=64):
+        self.encoder = encoder
+        self.max_entries = max_entries
+        self._rubrics = OrderedDict()
+        self._build_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, criteria):
+        version = rubric_content_hash(criteria)
+        with self._lock:
+            rubric = self._rubrics.get(version)
+            if rubric is not None:
+                self._rubrics.move_to_end(version)
+                return rubric
+            build_lock = self._build_locks.setdefault(version, threading.Lock())
+
+        with build_lock:
+            rubric = self._rubrics.get(version)
+            if rubric is None:
+                rubric = CompiledRubric.build(criteria, self.encoder)
+                with self._lock:
+                    self._rubrics[version] = rubric
+                    while len(self._rubrics) > self.max_entries:
+                        self._rubrics.popitem(last=False)
+
+        with self._lock:
+            self._build_locks.pop(version, None)
+        return rubric
+
+    def put(self, rubric):
+        """放入預先編譯的評分標準（例如從病例文件載入），同版本已存在時保留原有的"""
+        with self._lock:
+            rubric = self._rubrics.setdefault(rubric.version, rubric)
+            self._rubrics.move_to_end(rubric.version)
+            while len(self._rubrics) > self.max_entries:
+                self._rubrics.popitem(last=False)
+        return rubric
+
+    def clear(self):
+        with self._lock:
+            self._rubrics.clear()
+
+
+compiled_rubrics = RubricRegistry()
+
+
+def get_compiled_rubric(criteria):
+    """取得評分標準的共享編譯結果"""
+    return compiled_rubrics.get(criteria)
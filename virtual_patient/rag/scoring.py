@@ -0,0 +1,134 @@
+import numpy as np
+
+from .rubric import get_compiled_rubric
+
+
+class ScoreEngine:
+    """根據評分標準為學生的提問評分
+
+    評分標準編譯結果（嵌入、關鍵詞、配分表）由所有對話共享，
+    每個對話只保存按評分項目排列的得分向量和細項覆蓋位元遮罩。
+    """
+
+    def __init__(self, rubric=None, threshold=0.6, keyword_threshold=0.1):
+        self.threshold = threshold
+        # 只有關鍵詞命中時，評分項目的相似度至少要達到的值：
+        # 細項名稱可能只有一個字（如「量」），也會出現在「測量」這類無關提問中
+        self.keyword_threshold = keyword_threshold
+        self.rubric = None
+        self.scores = np.zeros(0, dtype=np.int32)
+        self.sub_item_masks = np.zeros(0, dtype=np.int64)
+        if rubric is not None:
+            self.set_rubric(rubric)
+
+    def set_rubric(self, rubric):
+        self.rubric = rubric
+        self.scores = np.zeros(len(rubric), dtype=np.int32)
+        self.sub_item_masks = np.zeros(len(rubric), dtype=np.int64)
+
+    def load_criteria(self, criteria):
+        """加載評分標準（相同內容的評分標準只編譯一次）"""
+        self.set_rubric(get_compiled_rubric(criteria))
+
+    @property
+    def covered(self):
+        return {self.rubric.ids[i] for i in np.flatnonzero(self.scores)}
+
+    @property
+    def total_score(self):
+        return int(self.scores.sum())
+
+    def covered_sub_items(self, i):
+        mask = int(self.sub_item_masks[i])
+        return [name for j, name in enumerate(self.rubric.sub_items[i]) if mask >> j & 1]
+
+    def category_scores(self):
+        return self.rubric.category_totals(self.scores)
+
+    def coverage(self):
+        """返回已得分或已問到細項的評分項目 {評分項目ID: {score, sub_items}}"""
+        return {
+            self.rubric.ids[i]: {'score': int(self.scores[i]), 'sub_items': self.covered_sub_items(i)}
+            for i in np.flatnonzero(self.scores | self.sub_item_masks)
+        }
+
+    def evaluate(self, text, query_vector=None, keyword_matches=None):
+        """一次向量相似度計算加一次關鍵詞掃描，找出提問命中的所有評分項目
+
+        keyword_matches 為案例自動機已算好的評分項目關鍵詞命中，傳入時不再掃描。
+        返回 (命中 {評分項目索引: 細項索引集合}, 相似度向量)。
+        同一關鍵詞對應多個評分項目時，只歸屬於相似度最高的那一項；
+        該項相似度低於 keyword_threshold 時不計。
+        """
+        if query_vector is None:
+            query_vector = self.rubric.vector_store.embed([text])[0]
+        similarities = self.rubric.similarities(query_vector)
+        if keyword_matches is None:
+            keyword_matches = self.rubric.match_keywords(text)
+
+        hits = {int(i): set() for i in np.flatnonzero(similarities >= self.threshold)}
+        for _, targets in keyword_matches:
+            i, j = max(targets, key=lambda target: similarities[target[0]])
+            if similarities[i] < self.keyword_threshold:
+                continue
+            hits.setdefault(i, set())
+            if j >= 0:
+                hits[i].add(j)
+        return hits, similarities
+
+    def score_response(self, text, query_vector=None, keyword_matches=None):
+        """為一句學生提問評分，一句話可同時得到多個評分項目的分數
+
+        同一評分項目只計分一次；query_vector 為已計算的查詢嵌入，與對話檢索共用。
+        """
+        hits, similarities = self.evaluate(text, query_vector, keyword_matches)
+
+        results = []
+        total = 0
+        for i in sorted(hits, key=lambda i: similarities[i], reverse=True):
+            score = 0
+            if not self.scores[i]:
+                score = int(self.rubric.points[i])
+                self.scores[i] = score
+                total += score
+            for j in hits[i]:
+                self.sub_item_masks[i] |= 1 << j
+            results.append({
+                'id': self.rubric.ids[i],
+                'score': score,
+                'similarity': float(similarities[i]),
+                'sub_items': [self.rubric.sub_items[i][j] for j in sorted(hits[i])],
+            })
+
+        return {
+            'score': total,
+            'similarity': float(similarities.max()) if len(similarities) else 0.0,
+            'matched_criteria': results[0]['id'] if results else None,
+            'hits': results,
+        }
+
+    def replay(self, hits):
+        """根據消息上保存的命中記錄恢復狀態，不重新計算相似度"""
+        for hit in hits or []:
+            i = self.rubric.index_of.get(hit['id'])
+            if i is None:
+                continue
+            self.scores[i] = self.rubric.points[i]
+            sub_items = self.rubric.sub_items[i]
+            for name in hit.get('sub_items', []):
+                if name in sub_items:
+                    self.sub_item_masks[i] |= 1 << sub_items.index(name)
+
+    def get_state(self):
+        """返回可序列化的評分狀態"""
+        return {
+            'rubric_version': self.rubric.version,
+            'scores': self.scores.tolist(),
+            'sub_items': self.sub_item_masks.tolist(),
+        }
+
+    def set_state(self, state):
+        scores = state.get('scores')
+        if scores is not None and state.get('rubric_version') == self.rubric.version:
+            self.scores = np.array(scores, dtype=np.int32)
+            self.sub_item_masks = np.array(state.get('sub_items', [0] * len(scores)), dtype=np.int64)
@@ -0,0 +1,435 @@
+import hashlib
+import heapq
+import math
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from .embeddings import get_encoder
+
+
+def normalize_rows(matrix):
+    """將矩陣每行做 L2 正規化，返回連續的 float32 矩陣"""
+    matrix = np.array(matrix, dtype=np.float32, order='C')
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def content_hash(vectors):
+    """向量矩陣內容的雜湊，用於判斷持久化的索引是否仍對應同一批向量"""
+    return hashlib.sha256(np.ascontiguousarray(vectors, dtype=np.float32).tobytes()).hexdigest()[:16]
+
+
+def top_k_indices(scores, top_k):
+    """返回分數最高的 top_k 個索引（由高到低），用 argpartition 避免全排序"""
+    count = scores.shape[-1]
+    if top_k >= count:
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def max_pool(scores, groups, group_count):
+    """按分組取最大分數，返回 (每組最高分, 每組最高分所在的行)
+
+    沒有任何行的分組分數為 -inf、行為 -1。
+    """
+    order = np.argsort(-scores, kind='stable')
+    present, first = np.unique(groups[order], return_index=True)
+    best_rows = np.full(group_count, -1, dtype=np.int64)
+    best_rows[present] = order[first]
+    pooled = np.full(group_count, -np.inf, dtype=np.float32)
+    pooled[present] = scores[best_rows[present]]
+    return pooled, best_rows
+
+
+class HNSWIndex:
+    """分層可導航小世界圖（HNSW）近似最近鄰索引，以內積為相似度（向量須已正規化）
+
+    M 為每個節點在上層的鄰居數（第 0 層為 2M），ef_construction 為建圖時的候選數，
+    ef 為查詢時的候選數：越大召回率越高、查詢越慢。
+    每層的鄰接表是一個 (節點數, 鄰居上限) 的 int32 矩陣（不足處填 -1），搜索時每步取出
+    一批待擴展節點的全部鄰居，以一次矩陣乘法計算相似度；add 按 batch_size 分批插入，
+    同批節點之間的相似度一次算出，反向連接在每批結束時統一寫入。
+    model_id 記錄向量來自哪個嵌入模型，隨索引一起保存；content_hash 為載入時文件記錄的向量內容雜湊。
+    可逐批 add 增量建圖，save/load 持久化到磁碟。建圖期間不可同時查詢。
+
+    numpy 實現的每步有數十微秒的固定開銷：384 維、30000 行的分簇數據上建圖約 400 行/秒，
+    ef=256 時 recall@10 約 0.91、p50 約 3.8ms，仍慢於精確搜索（p50 約 2.3ms）。
+    因此數萬行以內應使用精確搜索（search_vector 的默認路徑）；更大的集合先以
+    scripts/benchmark_ann.py 在目標數據上確認 HNSW 在可接受的召回率下更快，再調用 build_ann。
+    """
+
+    def __init__(self, dim, M=16, ef_construction=200, ef=64, seed=0, model_id='', batch_size=256):
+        self.dim = dim
+        self.model_id = model_id
+        self.content_hash = ''
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.seed = seed
+        self.batch_size = batch_size
+        self.level_mult = 1 / math.log(max(M, 2))
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.levels = np.zeros(0, dtype=np.int32)  # 每個節點所在的最高層
+        self.graphs = []  # graphs[層] -> (容量, 鄰居上限) 的鄰接矩陣
+        self.degrees = []  # degrees[層] -> 每個節點在該層的鄰居數
+        self.count = 0
+        self.entry_point = None
+        self.max_level = -1
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.count
+
+    def _width(self, layer):
+        return 2 * self.M if layer == 0 else self.M
+
+    def _reserve(self, rows):
+        capacity = len(self.vectors)
+        if self.count + rows <= capacity:
+            return
+        capacity = max(self.count + rows, capacity * 2, 1024)
+
+        def grow(array, fill):
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            return grown
+
+        self.vectors = grow(self.vectors, 0)
+        self.levels = grow(self.levels, 0)
+        self.graphs = [grow(graph, -1) for graph in self.graphs]
+        self.degrees = [grow(degree, 0) for degree in self.degrees]
+
+    def _add_layers(self, level):
+        capacity = len(self.vectors)
+        while len(self.graphs) <= level:
+            self.graphs.append(np.full((capacity, self._width(len(self.graphs))), -1, dtype=np.int32))
+            self.degrees.append(np.zeros(capacity, dtype=np.int32))
+
+    def add(self, vectors):
+        """分批插入向量，返回新節點編號（與插入順序一致，從當前大小起連續編號）"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        self._reserve(len(vectors))
+        start = self.count
+        for offset in range(0, len(vectors), self.batch_size):
+            self._insert_batch(vectors[offset:offset + self.batch_size])
+        return np.arange(start, self.count)
+
+    def _insert_batch(self, batch):
+        start = self.count
+        nodes = np.arange(start, start + len(batch))
+        levels = (-np.log(1.0 - self._rng.random(len(batch))) * self.level_mult).astype(np.int32)
+        self._add_layers(int(levels.max()))
+        self.vectors[nodes] = batch
+        self.levels[nodes] = levels
+        # 同批節點之間的相似度；前面的節點尚未有反向連接，從圖上搜不到，以此補充候選
+        batch_similarities = batch @ batch.T
+        reverse = [[] for _ in self.graphs]  # 每層 (鄰居, 新節點)
+
+        for i, (node, level) in enumerate(zip(nodes.tolist(), levels.tolist())):
+            self.count = node + 1
+            if self.entry_point is None:
+                self.entry_point, self.max_level = node, level
+                continue
+            query = batch[i]
+            entry = np.array([self.entry_point])
+            for layer in range(self.max_level, level, -1):
+                entry = self._search_layer(query, entry, 1, layer)[1][:1]
+            earlier = np.arange(i)
+            for layer in range(level, -1, -1):
+                if layer <= self.max_level:
+                    similarities, candidates = self._search_layer(query, entry, self.ef_construction, layer)
+                    entry = candidates
+                else:
+                    similarities, candidates = np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+                earlier = earlier[levels[earlier] >= layer]
+                if len(earlier):
+                    similarities = np.concatenate([similarities, batch_similarities[i, earlier]])
+                    candidates = np.concatenate([candidates, nodes[earlier]])
+                    order = np.argsort(-similarities, kind='stable')[:self.ef_construction]
+                    similarities, candidates = similarities[order], candidates[order]
+                neighbors = self._select(candidates, similarities, self.M)
+                self.graphs[layer][node, :len(neighbors)] = neighbors
+                self.degrees[layer][node] = len(neighbors)
+                reverse[layer].extend((neighbor, node) for neighbor in neighbors.tolist())
+            if level > self.max_level:
+                self.entry_point, self.max_level = node, level
+
+        for layer, pairs in enumerate(reverse):
+            if pairs:
+                self._link_back(layer, np.array(pairs, dtype=np.int64))
+
+    def _link_back(self, layer, pairs):
+        """把新節點加入鄰居的鄰接表；未超出上限的一次寫入，超出的以啟發式重新選鄰"""
+        graph, degree, width = self.graphs[layer], self.degrees[layer], self._width(layer)
+        pairs = pairs[np.argsort(pairs[:, 0], kind='stable')]
+        targets, starts, counts = np.unique(pairs[:, 0], return_index=True, return_counts=True)
+        fits = degree[targets] + counts <= width
+        rank = np.arange(len(pairs)) - np.repeat(starts, counts)
+        fitting = np.repeat(fits, counts)
+        rows = pairs[fitting, 0]
+        graph[rows, degree[rows] + rank[fitting]] = pairs[fitting, 1]
+        degree[targets[fits]] += counts[fits]
+
+        for target, begin, count in zip(targets[~fits].tolist(), starts[~fits].tolist(), counts[~fits].tolist()):
+            links = np.concatenate([graph[target, :degree[target]], pairs[begin:begin + count, 1]])
+            similarities = self.vectors[links] @ self.vectors[target]
+            order = np.argsort(-similarities, kind='stable')
+            selected = self._select(links[order], similarities[order], width)
+            graph[target] = -1
+            graph[target, :len(selected)] = selected
+            degree[target] = len(selected)
+
+    def _search_layer(self, query, entry_points, ef, layer, width=16):
+        """在單層上做束搜索，返回按相似度由高到低的 (相似度數組, 節點數組)
+
+        結果集保留最相似的 ef 個節點，每步擴展其中最多 width 個未擴展的節點，
+        直到結果集中的節點全部擴展過。
+        """
+        graph = self.graphs[layer]
+        visited = np.zeros(self.count, dtype=bool)
+        # 去重用的暫存：只讀取本步剛寫入的位置，無需初始化
+        slots = np.empty(self.count, dtype=np.int64)
+        nodes = np.asarray(entry_points, dtype=np.int64)
+        visited[nodes] = True
+        similarities = self.vectors[nodes] @ query
+        expanded = np.zeros(len(nodes), dtype=bool)
+        while True:
+            if len(nodes) > ef:
+                keep = np.argpartition(-similarities, ef - 1)[:ef]
+                nodes, similarities, expanded = nodes[keep], similarities[keep], expanded[keep]
+            frontier = np.flatnonzero(~expanded)
+            if not len(frontier):
+                break
+            if len(frontier) > width:
+                frontier = frontier[np.argpartition(-similarities[frontier], width - 1)[:width]]
+            expanded[frontier] = True
+            neighbors = graph[nodes[frontier]].ravel()
+            neighbors = neighbors[neighbors >= 0]
+            neighbors = neighbors[~visited[neighbors]]
+            positions = np.arange(len(neighbors))
+            slots[neighbors] = positions
+            neighbors = neighbors[slots[neighbors] == positions]
+            if not len(neighbors):
+                continue
+            visited[neighbors] = True
+            neighbor_similarities = self.vectors[neighbors] @ query
+            if len(nodes) >= ef:
+                better = neighbor_similarities > similarities.min()
+                neighbors, neighbor_similarities = neighbors[better], neighbor_similarities[better]
+            nodes = np.concatenate([nodes, neighbors])
+            similarities = np.concatenate([similarities, neighbor_similarities])
+            expanded = np.concatenate([expanded, np.zeros(len(neighbors), dtype=bool)])
+        order = np.argsort(-similarities, kind='stable')
+        return similarities[order], nodes[order]
+
+    def _select(self, candidates, similarities, count):
+        """啟發式選鄰：候選按相似度由高到低，與已選鄰居比與目標更相似的略過，不足 count 個時以被略過的最近候選補足"""
+        if len(candidates) <= count:
+            return candidates.astype(np.int32)
+        # 只考慮最相似的 3 * count 個候選，其間的相似度一次算出
+        candidates, similarities = candidates[:3 * count], similarities[:3 * count]
+        vectors = self.vectors[candidates]
+        closer = vectors @ vectors.T > similarities
+        alive = np.ones(len(candidates), dtype=bool)
+        selected = []
+        while len(selected) < count:
+            i = int(alive.argmax())
+            if not alive[i]:
+                break
+            selected.append(i)
+            alive &= ~closer[i]
+        if len(selected) < count:
+            skipped = np.ones(len(candidates), dtype=bool)
+            skipped[selected] = False
+            selected.extend(np.flatnonzero(skipped)[:count - len(selected)].tolist())
+            selected.sort()
+        return candidates[selected].astype(np.int32)
+
+    def search(self, query_vector, top_k=10, ef=None):
+        """返回 (相似度數組, 節點數組)，由高到低"""
+        if self.entry_point is None:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        entry = np.array([self.entry_point])
+        for layer in range(self.max_level, 0, -1):
+            entry = self._search_layer(query_vector, entry, 1, layer)[1][:1]
+        similarities, nodes = self._search_layer(query_vector, entry, max(ef or self.ef, top_k), 0)
+        return similarities[:top_k].astype(np.float32), nodes[:top_k]
+
+    def save(self, path):
+        """寫入 .npz 文件（先寫臨時文件再原子替換），同時記錄模型和向量內容雜湊"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(
+                    f,
+                    params=np.array([self.dim, self.M, self.ef_construction, self.ef, self.seed,
+                                     -1 if self.entry_point is None else self.entry_point, self.max_level], dtype=np.int64),
+                    vectors=self.vectors[:self.count],
+                    levels=self.levels[:self.count],
+                    model_id=np.array(self.model_id),
+                    content_hash=np.array(content_hash(self.vectors[:self.count])),
+                    **{f'graph{layer}': graph[:self.count] for layer, graph in enumerate(self.graphs)},
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """從 .npz 文件載入；文件不是本格式時拋出 ValueError"""
+        with np.load(path) as data:
+            if 'graph0' not in data and 'links' in data:
+                raise ValueError(f'舊格式的 HNSW 索引文件: {path}')
+            dim, M, ef_construction, ef, seed, entry_point, max_level = data['params'].tolist()
+            index = cls(dim, M=M, ef_construction=ef_construction, ef=ef, seed=seed, model_id=str(data['model_id']))
+            index.content_hash = str(data['content_hash'])
+            index.vectors = np.array(data['vectors'], dtype=np.float32)
+            index.levels = np.array(data['levels'], dtype=np.int32)
+            index.graphs = [np.array(data[f'graph{layer}'], dtype=np.int32) for layer in range(max_level + 1)]
+        index.count = len(index.levels)
+        index.degrees = [(graph >= 0).sum(axis=1).astype(np.int32) for graph in index.graphs]
+        index.entry_point = None if entry_point < 0 else entry_point
+        index.max_level = max_level
+        # 續建時不重複已用過的隨機層數序列
+        index._rng = np.random.default_rng([seed, index.count])
+        return index
+
+
+class VectorStore:
+    """內存向量存儲
+
+    每個集合保存為一個連續、已 L2 正規化的 float32 矩陣，
+    查詢時用一次矩陣向量乘積計算所有餘弦相似度。
+    """
+
+    def __init__(self, encoder=None):
+        self.encoder = encoder or get_encoder()
+        self.collections = {}
+        self.frozen = False
+
+    def embed(self, texts):
+        """編碼並正規化文本"""
+        return normalize_rows(self.encoder.encode(list(texts)))
+
+    def add_collection(self, name, texts, metadata=None, embeddings=None, normalized=False):
+        """為文本列表建立向量集合
+
+        可傳入預先計算的嵌入；normalized=True 時直接使用（例如 mmap 的唯讀矩陣），不做複製。
+        """
+        if self.frozen:
+            raise RuntimeError('向量存儲已凍結，不能再添加集合')
+        texts = list(texts)
+        if embeddings is None:
+            embeddings = self.embed(texts) if texts else np.zeros((0, self.encoder.dim), dtype=np.float32)
+        elif not normalized:
+            embeddings = normalize_rows(embeddings)
+        self.collections[name] = {
+            'texts': texts,
+            'embeddings': embeddings,
+            'metadata': list(metadata) if metadata is not None else [{} for _ in texts],
+        }
+
+    def freeze(self):
+        """凍結存儲，之後只允許讀取，可被多個對話安全共享"""
+        for collection in self.collections.values():
+            if collection['embeddings'].flags.writeable:
+                collection['embeddings'].setflags(write=False)
+        self.frozen = True
+
+    def _results(self, collection, scores, top_k):
+        return [
+            {
+                'index': int(i),
+                'text': collection['texts'][i],
+                'score': float(scores[i]),
+                'metadata': collection['metadata'][i],
+            }
+            for i in top_k_indices(scores, top_k)
+        ]
+
+    def build_ann(self, name, M=16, ef_construction=200, ef=64, path=None):
+        """為集合建立 HNSW 近似最近鄰索引，之後 search_vector 改用近似搜索
+
+        病例與評分的集合只有數百行，運行時不建索引；只在集合大到 HNSW 確實比精確搜索快時使用。
+
+        傳入 path 時，若文件中的索引由同一模型建立，且其向量與集合的前若干行內容一致，
+        就載入並只為之後追加的行續建；否則從頭建圖。建好或續建後寫回該文件。
+        """
+        if self.frozen:
+            raise RuntimeError('向量存儲已凍結，不能再建立索引')
+        collection = self.collections[name]
+        embeddings = collection['embeddings']
+        index = self._load_ann(path, embeddings) if path is not None and Path(path).exists() else None
+        if index is None:
+            index = HNSWIndex(embeddings.shape[1], M=M, ef_construction=ef_construction, ef=ef,
+                              model_id=self.encoder.model_id)
+            index.add(embeddings)
+            if path is not None:
+                index.save(path)
+        collection['ann'] = index
+        return index
+
+    def _load_ann(self, path, embeddings):
+        """載入持久化的索引並續建追加的行；格式、模型或內容不一致時返回 None"""
+        try:
+            index = HNSWIndex.load(path)
+        except ValueError:
+            return None
+        rows = len(index)
+        if (index.model_id != self.encoder.model_id or rows > len(embeddings)
+                or index.content_hash != content_hash(embeddings[:rows])):
+            return None
+        if rows < len(embeddings):
+            index.add(embeddings[rows:])
+            index.save(path)
+        return index
+
+    def search_vector(self, name, query_vector, top_k=5, ef=None):
+        """用已正規化的查詢向量搜索；集合有 HNSW 索引時做近似搜索"""
+        collection = self.collections.get(name)
+        if not collection or not collection['texts']:
+            return []
+        ann = collection.get('ann')
+        if ann is not None:
+            scores, rows = ann.search(query_vector, top_k, ef=ef)
+            return [
+                {
+                    'index': int(row),
+                    'text': collection['texts'][row],
+                    'score': float(score),
+                    'metadata': collection['metadata'][row],
+                }
+                for score, row in zip(scores, rows)
+            ]
+        scores = collection['embeddings'] @ query_vector
+        return self._results(collection, scores, top_k)
+
+    def search(self, name, query, top_k=5):
+        """搜索與查詢最相似的文本"""
+        collection = self.collections.get(name)
+        if not collection or not collection['texts']:
+            return []
+        return self.search_vector(name, self.embed([query])[0], top_k)
+
+    def search_many(self, name, queries, top_k=5):
+        """批量搜索：一次編碼所有查詢，並用一次矩陣乘法計算相似度"""
+        collection = self.collections.get(name)
+        queries = list(queries)
+        if not collection or not collection['texts']:
+            return [[] for _ in queries]
+        if not queries:
+            return []
+        scores = self.embed(queries) @ collection['embeddings'].T
+        return [self._results(collection, row, top_k) for row in scores]
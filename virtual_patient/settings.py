@@ -56,4 +56,67 @@ SIMPLE_JWT = {
 }
 
 # 跨域配置
-CORS_ALLOW_ALL_ORIGINS = True  # 開發環境使用，生產環境應限制來源
\ No newline at end of file
+CORS_ALLOW_ALL_ORIGINS = True  # 開發環境使用，生產環境應限制來源
+
+# 對話會話存儲（多 worker 部署時改用 SQLiteSessionStore 共享會話）
+# CONVERSATION_SESSION_STORE = {
+#     'BACKEND': 'conversations.session_store.SQLiteSessionStore',
+#     # cache_size: 每個 worker 緩存的已重建處理器數，狀態未被其他 worker 改寫時不重建
+#     'OPTIONS': {'path': '/var/run/virtual_patient/sessions.sqlite3', 'ttl': 7200, 'cache_size': 1000},
+# }
+CONVERSATION_SESSION_STORE = {
+    'BACKEND': 'conversations.session_store.LocalMemorySessionStore',
+    'OPTIONS': {'max_entries': 1000, 'ttl': 3600},
+}
+
+# 學生消息評分隊列：進程內線程池，或數據庫隊列（另行運行 python manage.py run_scoring_worker）
+# 進程內隊列只能等待本進程的評分任務，多個 worker 進程部署時須使用數據庫隊列
+# 數據庫隊列中處理超過 lease 秒的任務視為 worker 已退出，重新放回隊列
+# CONVERSATION_SCORING_QUEUE = {
+#     'BACKEND': 'conversations.scoring_queue.DatabaseScoringQueue',
+#     'OPTIONS': {'poll_interval': 0.2, 'lease': 300},
+# }
+CONVERSATION_SCORING_QUEUE = {
+    'BACKEND': 'conversations.scoring_queue.LocalScoringQueue',
+    'OPTIONS': {'max_workers': 2},
+}
+
+# 評分模式：'queue' 後台評分；'sync' 每輪立即評分（考試模式，也可用 ?scoring=sync 指定）
+# 同步評分時對話檢索與評分在有界線程池中並行執行
+CONVERSATION_SCORING_MODE = 'queue'
+CONVERSATION_TURN_WORKERS = 4
+
+# 預先生成的 mmap 嵌入文件目錄（python manage.py build_embedding_bundles）
+# 未設定時每個 worker 在首次使用時自行編碼
+RAG_EMBEDDING_BUNDLE_DIR = None  # 例如 '/var/lib/virtual_patient/embeddings'
+
+# 二進位病例文件目錄（python manage.py case_bundle build），包含對話、評分標準、嵌入和關鍵詞自動機
+# 有同版本的病例文件時直接 mmap 載入，不解析 JSON、不編碼
+RAG_CASE_BUNDLE_DIR = None  # 例如 '/var/lib/virtual_patient/cases'
+
+# 跨病例共享的觸發語句表：標準化後相同的語句只編碼、只存一次，病例索引只保存行號，檢索時直接從表中取行計算
+# RAG_PHRASE_TABLE_PATH 為預先生成的語句表文件（python manage.py build_phrase_table），存在時啟動後直接載入
+RAG_SHARED_PHRASE_TABLE = False
+RAG_PHRASE_TABLE_PATH = None  # 例如 '/var/lib/virtual_patient/phrases.vpemb'
+
+# 檢索分數不足時的生成式回退（OpenAI 兼容 chat completions 接口），None 表示只用固定回覆
+# RAG_GENERATIVE_BACKEND = {
+#     'url': 'http://127.0.0.1:8080/v1/chat/completions',
+#     'model': 'qwen2.5-7b-instruct',
+#     'timeout': 8,             # 連線與讀取超時（秒）
+#     'max_connections': 16,    # keep-alive 連線池大小
+#     'max_concurrency': 8,     # 全局同時請求上限
+#     'cache_size': 2000,       # (病人版本, 標準化問題) 回覆緩存條目數
+# }
+RAG_GENERATIVE_BACKEND = None
+
+# 每隔多少秒檢查一次已載入病例是否在數據庫中更新（None 表示只在開始對話時發現新版本）
+# 有新版本時在後台構建索引，完成後才切換，新對話使用新版本，進行中的對話不受影響
+RAG_CASE_RELOAD_INTERVAL = None  # 例如 30
+
+# 採用腳本回覆的最低檢索分數，分數為餘弦相似度與詞項覆蓋率的較大者（見 rag/dialog_generator.py 的 MATCH_THRESHOLD）
+RAG_MATCH_THRESHOLD = 0.6
+
+# 嵌入緩存：進程內 LRU 條目數，以及可選的持久化 SQLite 緩存文件
+RAG_EMBEDDING_CACHE_SIZE = 10000
+RAG_EMBEDDING_CACHE_PATH = None  # 例如 '/var/lib/virtual_patient/embedding_cache.sqlite3'
@@ -4,6 +4,17 @@ pytest 配置文件，包含共享的 fixtures
 import pytest
 from rest_framework.test import APIClient
 from accounts.models import User
+from conversations.models import Conversation, VirtualPatient
+
+DIALOG = [
+    {'question': '你幾歲？', 'answer': '2歲'},
+    {'question': '今天拉了幾次？', 'answer': '到今天中午總共拉五次'},
+]
+
+SCORING = [
+    {'id': '詢問病人姓名', '分類': '病人辨識', '項目': '詢問病人姓名', '語義提示': '請問小朋友叫什麼名字？', '關鍵詞': ['名字'], '配分': 2},
+    {'id': '大便情況', '分類': '病人情況', '項目': '大便情況', '語義提示': '請問大便的次數？', '關鍵詞': ['幾次'], '配分': 10},
+]
 
 @pytest.fixture
 def api_client():
@@ -28,4 +39,36 @@ def authenticated_client(api_client, test_user):
     refresh = RefreshToken.for_user(test_user)
     
     api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {refresh.access_token}")
-    return api_client 
\ No newline at end of file
+    return api_client
+
+@pytest.fixture
+def dialog_json():
+    """虛擬病人的對話資料，測試模塊可覆蓋"""
+    return DIALOG
+
+@pytest.fixture
+def scoring_json():
+    """虛擬病人的評分標準，測試模塊可覆蓋"""
+    return SCORING
+
+@pytest.fixture
+def virtual_patient(dialog_json, scoring_json):
+    """創建並返回一個測試用虛擬病人"""
+    return VirtualPatient.objects.create(
+        name='腸胃炎病童',
+        description='用於測試的虛擬病人',
+        dialog_json=dialog_json,
+        scoring_json=scoring_json,
+    )
+
+@pytest.fixture
+def conversation(test_user, virtual_patient):
+    """創建並返回測試用戶與虛擬病人的對話"""
+    return Conversation.objects.create(user=test_user, virtual_patient=virtual_patient)
+
+@pytest.fixture
+def immediate_scoring(monkeypatch):
+    """讓視圖在請求內立即評分，不經後台隊列"""
+    from conversations import views
+    from conversations.scoring_queue import ImmediateScoringQueue
+    monkeypatch.setattr(views, 'scoring_queue', ImmediateScoringQueue())
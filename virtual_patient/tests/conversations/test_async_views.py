@@ -0,0 +1,123 @@
+import json
+import threading
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.urls import reverse
+
+from conversations.models import Conversation, Message
+
+pytestmark = pytest.mark.usefixtures('immediate_scoring')
+
+
+@pytest.mark.django_db
+def test_async_conversation_flow(authenticated_client, virtual_patient):
+    """測試異步端點完成開始、發送、結束對話的流程"""
+    response = authenticated_client.post(reverse('async-start-conversation', args=[virtual_patient.id]))
+    assert response.status_code == 200
+    conversation_id = response.json()['id']
+
+    send_url = reverse('async-send-message', args=[conversation_id])
+    response = authenticated_client.post(send_url, {'content': '小朋友叫什麼名字？'}, format='json')
+    assert response.status_code == 200
+    assert [message['role'] for message in response.json()['messages']] == [Message.STUDENT, Message.PATIENT]
+
+    response = authenticated_client.post(f'{send_url}?scoring=sync', {'content': '今天大便幾次？'}, format='json')
+    data = response.json()
+    assert data['messages'][0]['score'] == 10
+    assert data['score']['score_total'] == 12
+    assert 'scoring_ms' in data['timings']
+
+    response = authenticated_client.post(reverse('async-end-conversation', args=[conversation_id]))
+    assert response.status_code == 200
+    assert response.json()['score'] == 6
+    assert Conversation.objects.get(pk=conversation_id).completed_at is not None
+
+
+@pytest.mark.django_db
+def test_async_endpoints_require_authentication(api_client, virtual_patient):
+    """測試異步端點需要 JWT 驗證，且只接受 POST"""
+    url = reverse('async-start-conversation', args=[virtual_patient.id])
+    assert api_client.post(url).status_code == 401
+    assert api_client.get(url).status_code == 405
+
+
+@pytest.mark.django_db
+def test_async_send_to_other_users_conversation_is_not_found(authenticated_client, virtual_patient, django_user_model):
+    """測試不能向其他用戶的對話發送消息"""
+    other = django_user_model.objects.create_user(username='other', email='other@example.com', password='securepassword123')
+    conversation = Conversation.objects.create(user=other, virtual_patient=virtual_patient)
+
+    response = authenticated_client.post(reverse('async-send-message', args=[conversation.id]), {'content': '你好'}, format='json')
+    assert response.status_code == 404
+
+
+def parse_events(response):
+    """把 SSE 響應解析為 [(事件名, 數據)]"""
+    async def read():
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    body = async_to_sync(read)().decode('utf-8')
+    events = []
+    for block in body.strip().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.split('\n'))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+@pytest.mark.django_db
+def test_stream_message_sends_reply_before_done(authenticated_client, test_user, virtual_patient):
+    """測試串流端點先發送回覆片段，最後發送已保存的消息ID"""
+    conversation = Conversation.objects.create(user=test_user, virtual_patient=virtual_patient)
+
+    response = authenticated_client.post(f"{reverse('async-stream-message', args=[conversation.id])}?scoring=sync", {'content': '今天大便幾次？'}, format='json')
+
+    assert response['Content-Type'] == 'text/event-stream'
+    events = parse_events(response)
+    assert [name for name, _ in events] == ['delta', 'done']
+    done = events[-1][1]
+    student, patient = (Message.objects.get(id=message['id']) for message in done['messages'])
+    assert patient.content == events[0][1]['text']
+    assert student.score == 10
+    assert done['score']['score_total'] == 10
+    assert 'first_chunk_ms' in done['timings']
+
+
+class EndlessFallback:
+    """逐字產生回覆、不會自行結束的生成式回退，記錄串流是否被關閉"""
+
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def stream(self, question):
+        try:
+            while True:
+                yield '嗯'
+        finally:
+            self.closed.set()
+
+
+@pytest.mark.django_db
+def test_turn_events_close_reply_stream_on_disconnect(test_user, virtual_patient):
+    """測試客戶端中途斷線時關閉回覆生成器，生成服務的串流隨之關閉"""
+    from conversations.handlers import ConversationHandler
+    from conversations.views import turn_events
+
+    conversation = Conversation.objects.create(user=test_user, virtual_patient=virtual_patient)
+    handler = ConversationHandler.create(conversation.id, virtual_patient)
+    fallback = EndlessFallback()
+    handler.dialog_generator.fallback = fallback
+    # 保留生成器的引用（如異常回溯），關閉不能依賴垃圾回收
+    streams = []
+    stream_response = handler.dialog_generator.stream_response
+    handler.dialog_generator.stream_response = lambda *args, **kwargs: streams.append(stream_response(*args, **kwargs)) or streams[-1]
+
+    async def disconnect_after_first_delta():
+        events = turn_events(conversation, handler, '肚子痛嗎？')
+        assert await events.__anext__() == ('delta', {'text': '嗯'})
+        await events.aclose()
+
+    async_to_sync(disconnect_after_first_delta)()
+
+    assert fallback.closed.wait(timeout=5)
+    assert not Message.objects.filter(conversation=conversation).exists()
@@ -0,0 +1,94 @@
+import pytest
+
+from conversations.handlers import ConversationHandler, get_or_rehydrate_handler
+from conversations.models import VirtualPatient
+from conversations.session_store import LocalMemorySessionStore
+from conversations.views import record_index_version
+from rag.embeddings import HashingEncoder
+from rag.patient_index import CaseWatcher, IndexVersionUnavailable, PatientIndexRegistry, patient_indexes
+
+DIALOG = [
+    {'id': 'name', '觸發語句': ['小朋友叫什麼名字？'], '標準回覆': '張小威2歲'},
+    {'id': 'stool', '觸發語句': ['今天拉了幾次？'], '標準回覆': '到今天中午總共拉五次'},
+]
+
+
+@pytest.fixture
+def dialog_json():
+    return DIALOG
+
+
+@pytest.mark.django_db
+def test_watcher_rebuilds_updated_case_in_background(virtual_patient):
+    """測試檢查線程發現病例更新後在後台構建並切換到新版本，未更新的病例不重建"""
+    patient = virtual_patient
+    other = VirtualPatient.objects.create(name='其他病童', description='測試', dialog_json=DIALOG, scoring_json=[])
+    registry = PatientIndexRegistry(HashingEncoder(), background=True)
+    old = registry.get(patient.id, patient.dialog_json)
+    registry.get(other.id, other.dialog_json)
+    watcher = CaseWatcher(registry, interval=60)
+    assert watcher.poll() == []
+
+    patient.dialog_json = DIALOG[:1] + [{'id': 'stool', '觸發語句': ['今天拉了幾次？'], '標準回覆': '拉了六次'}]
+    patient.save()
+    futures = watcher.poll()
+
+    assert len(futures) == 1
+    new = futures[0].result(timeout=5)
+    assert registry.get(patient.id, patient.dialog_json) is new
+    assert new.retrieve('今天拉了幾次')[0]['answer'] == '拉了六次'
+    assert old.retrieve('今天拉了幾次')[0]['answer'] == '到今天中午總共拉五次'
+    assert watcher.poll() == []
+
+
+@pytest.mark.django_db
+def test_rebuilt_handler_keeps_conversation_index_version(conversation):
+    """測試病例更新後，進行中的對話從會話狀態或消息記錄重建時仍使用開始時的版本"""
+    patient = conversation.virtual_patient
+    handler = ConversationHandler.create(conversation.id, patient)
+    conversation.index_version = handler.patient_index.version
+    conversation.save()
+    state = handler.to_state()
+    del handler
+
+    patient.dialog_json = DIALOG[:1] + [{'id': 'stool', '觸發語句': ['今天拉了幾次？'], '標準回覆': '拉了六次'}]
+    patient.save()
+    patient_indexes.refresh(patient.id, patient.dialog_json).result(timeout=5)
+
+    try:
+        assert ConversationHandler.create(None, patient).reply('今天拉了幾次') == '拉了六次'
+        for rebuilt in (ConversationHandler.from_state(conversation.id, state), ConversationHandler.rehydrate(conversation)):
+            assert rebuilt.patient_index.version == conversation.index_version
+            assert rebuilt.reply('今天拉了幾次') == '到今天中午總共拉五次'
+    finally:
+        patient_indexes.clear()
+
+
+@pytest.mark.django_db
+def test_restarted_worker_rebuilds_conversation_version_from_snapshot(conversation):
+    """測試病例更新且緩存清空（如重啟）後，以對話開始時保存的對話快照重建同一版本，不改用當前版本"""
+    patient = conversation.virtual_patient
+    record_index_version(conversation, ConversationHandler.create(conversation.id, patient))
+
+    patient.dialog_json = DIALOG[:1] + [{'id': 'stool', '觸發語句': ['今天拉了幾次？'], '標準回覆': '拉了六次'}]
+    patient.save()
+    patient_indexes.clear()
+
+    try:
+        rebuilt = get_or_rehydrate_handler(conversation, LocalMemorySessionStore())
+        assert rebuilt.patient_index.version == conversation.index_version
+        assert rebuilt.reply('今天拉了幾次') == '到今天中午總共拉五次'
+        assert ConversationHandler.create(None, patient).reply('今天拉了幾次') == '拉了六次'
+    finally:
+        patient_indexes.clear()
+
+
+@pytest.mark.django_db
+def test_missing_conversation_version_is_reported(conversation):
+    """測試對話開始時的版本既無緩存也無快照時明確報錯，處理器視為已過期"""
+    conversation.index_version = 'unknownversion0'
+    conversation.save()
+
+    with pytest.raises(IndexVersionUnavailable):
+        ConversationHandler.rehydrate(conversation)
+    assert get_or_rehydrate_handler(conversation, LocalMemorySessionStore()) is None
@@ -26,4 +26,31 @@ def test_create_conversation(authenticated_client, test_user):
     assert response.data['title'] == '測試對話'
     
     # 檢查對話是否在數據庫中創建
-    assert Conversation.objects.filter(title='測試對話').exists() 
\ No newline at end of file
+    assert Conversation.objects.filter(title='測試對話').exists() 
+
+@pytest.mark.django_db
+def test_stats_reports_retrieval_for_admins_only(authenticated_client, test_user, virtual_patient):
+    """測試檢索與嵌入緩存統計只對管理員開放"""
+    authenticated_client.post(reverse('virtual-patient-start-conversation', args=[virtual_patient.id]))
+    url = reverse('virtual-patient-stats')
+
+    assert authenticated_client.get(url).status_code == 403
+
+    test_user.is_staff = True
+    test_user.save()
+    response = authenticated_client.get(url)
+    assert response.status_code == 200
+    assert set(response.data['retrieval'][virtual_patient.id]) == {'lookups', 'lexical_only', 'lexical_only_rate'}
+    assert 'hit_rate' in response.data['embedding_cache']
+
+
+@pytest.mark.django_db
+def test_match_threshold_setting_reaches_dialog_generator(virtual_patient, settings):
+    """測試 RAG_MATCH_THRESHOLD 設定採用腳本回覆的最低檢索分數"""
+    from conversations.handlers import ConversationHandler
+
+    settings.RAG_MATCH_THRESHOLD = 1.01
+    handler = ConversationHandler.create(1, virtual_patient)
+
+    assert handler.dialog_generator.threshold == 1.01
+    assert handler.reply('你幾歲？') != '2歲'
@@ -0,0 +1,122 @@
+import json
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+
+from conversations.models import VirtualPatient
+from rag.dialog_items import dialog_phrases
+from rag.embedding_bundle import load_bundle, parse_vector_id
+from rag.models import PatientData
+from rag.patient_index import dialog_content_hash
+
+DIALOG = [
+    {'id': 'name', '觸發語句': ['小朋友叫什麼名字？', '你幾歲？'], '標準回覆': '張小威2歲'},
+    {'id': 'stool', '觸發語句': ['今天拉了幾次？'], '標準回覆': '到今天中午總共拉五次'},
+]
+
+
+def load(tmp_path, dialog):
+    dialog_path = tmp_path / 'dialog.json'
+    scoring_path = tmp_path / 'scoring.json'
+    dialog_path.write_text(json.dumps(dialog, ensure_ascii=False), encoding='utf-8')
+    scoring_path.write_text('[]', encoding='utf-8')
+    out = StringIO()
+    call_command('load_patient_data', name='腸胃炎病童', description='測試', dialog=str(dialog_path), scoring=str(scoring_path), stdout=out)
+    return out.getvalue()
+
+
+@pytest.mark.django_db
+def test_update_reports_diff_and_reencodes_only_changed_phrases(tmp_path, settings):
+    """測試更新病例時按項目 id 比較，只為改動的觸發語句編碼並寫入新版本嵌入文件"""
+    settings.RAG_EMBEDDING_BUNDLE_DIR = str(tmp_path / 'bundles')
+    output = load(tmp_path, DIALOG)
+    assert '編碼 3 條語句' in output
+
+    edited = [DIALOG[0], {'id': 'stool', '觸發語句': ['今天拉肚子幾次？'], '標準回覆': '到今天中午總共拉五次'}]
+    output = load(tmp_path, edited)
+
+    assert '新增 0，修改 1，刪除 0，未變 1' in output
+    assert '編碼 1 條語句，沿用 2 條' in output
+    assert VirtualPatient.objects.get().dialog_json == edited
+    patient_id = VirtualPatient.objects.get().id
+    # 新舊兩個版本的嵌入文件都保留，新文件不含墓碑行
+    assert load_bundle(settings.RAG_EMBEDDING_BUNDLE_DIR, patient_id, dialog_content_hash(DIALOG)) is not None
+    bundle = load_bundle(settings.RAG_EMBEDDING_BUNDLE_DIR, patient_id, dialog_content_hash(edited))
+    assert bundle.texts == ['小朋友叫什麼名字？', '你幾歲？', '今天拉肚子幾次？']
+
+
+@pytest.mark.django_db
+def test_update_rewrites_patient_data_to_bundle_rows(tmp_path, settings):
+    """測試更新病例後 PatientData.vector_id 指向新版本嵌入文件中同一語句的行（增量更新後行序與對話不同）"""
+    settings.RAG_EMBEDDING_BUNDLE_DIR = str(tmp_path / 'bundles')
+    load(tmp_path, DIALOG)
+    edited = [{'id': 'name', '觸發語句': ['請問叫什麼名字？', '你幾歲？'], '標準回覆': '張小威2歲'}, DIALOG[1]]
+    load(tmp_path, edited)
+
+    patient = VirtualPatient.objects.get()
+    version = dialog_content_hash(edited)
+    bundle = load_bundle(settings.RAG_EMBEDDING_BUNDLE_DIR, patient.id, version)
+    assert bundle.texts != dialog_phrases(edited)[0]
+    data = PatientData.objects.filter(virtual_patient=patient)
+    assert sorted(row.title for row in data) == sorted(dialog_phrases(edited)[0])
+    for row in data:
+        row_version, number = parse_vector_id(row.vector_id)
+        assert row_version == version
+        assert bundle.texts[number] == row.title
+
+
+@pytest.mark.django_db
+def test_update_without_bundle_dir_clears_vector_ids(tmp_path, settings):
+    """測試沒有嵌入文件時 PatientData 按當前對話重寫，vector_id 留空"""
+    settings.RAG_EMBEDDING_BUNDLE_DIR = None
+    load(tmp_path, DIALOG)
+
+    data = PatientData.objects.filter(virtual_patient=VirtualPatient.objects.get())
+    assert sorted((row.title, row.vector_id) for row in data) == sorted((phrase, '') for phrase in dialog_phrases(DIALOG)[0])
+
+
+SCORING = [{'id': '詢問病人姓名', '分類': '病人辨識', '語義提示': '請問小朋友叫什麼名字？', '配分': 2}]
+
+
+def write_case(directory, name, dialog, scoring=SCORING):
+    case_dir = directory / name
+    case_dir.mkdir(parents=True)
+    (case_dir / 'dialog.json').write_text(json.dumps(dialog, ensure_ascii=False), encoding='utf-8')
+    (case_dir / 'scoring.json').write_text(json.dumps(scoring, ensure_ascii=False), encoding='utf-8')
+    (case_dir / 'case.json').write_text(json.dumps({'name': name, 'description': f'{name}的病例'}, ensure_ascii=False), encoding='utf-8')
+
+
+@pytest.mark.django_db
+def test_bulk_import_directory(tmp_path, settings):
+    """測試目錄模式並行檢查後一次寫入所有病例，跨病例共用的語句只編碼一次"""
+    settings.RAG_EMBEDDING_BUNDLE_DIR = str(tmp_path / 'bundles')
+    VirtualPatient.objects.create(name='病例1', description='舊描述', dialog_json=[], scoring_json=[])
+    for number in range(1, 4):
+        write_case(tmp_path / 'cases', f'病例{number}', DIALOG + [{'id': f'extra{number}', '觸發語句': [f'第{number}個問題'], '標準回覆': '好'}])
+
+    out = StringIO()
+    call_command('load_patient_data', dir=str(tmp_path / 'cases'), workers=2, batch_size=2, stdout=out)
+
+    output = out.getvalue()
+    assert '匯入 3 個病例（新建 2，更新 1）' in output
+    assert '12 條觸發語句（編碼 6 條）' in output
+    assert '病例/s' in output and '語句/s' in output
+    patients = VirtualPatient.objects.order_by('name')
+    assert [patient.description for patient in patients] == ['病例1的病例', '病例2的病例', '病例3的病例']
+    for patient in patients:
+        bundle = load_bundle(settings.RAG_EMBEDDING_BUNDLE_DIR, patient.id, dialog_content_hash(patient.dialog_json))
+        assert len(bundle) == 4
+
+
+@pytest.mark.django_db
+def test_bulk_import_is_all_or_nothing(tmp_path):
+    """測試任一病例檢查失敗時不匯入任何病例"""
+    write_case(tmp_path / 'cases', '病例1', DIALOG)
+    write_case(tmp_path / 'cases', '病例2', [{'id': 'x', '觸發語句': [], '標準回覆': '好'}])
+
+    out = StringIO()
+    call_command('load_patient_data', dir=str(tmp_path / 'cases'), workers=1, stdout=out)
+
+    assert '對話項目 x 沒有觸發語句' in out.getvalue()
+    assert not VirtualPatient.objects.exists()
@@ -0,0 +1,55 @@
+import pytest
+from django.urls import reverse
+
+from conversations import views
+from conversations.handlers import ConversationHandler, get_or_rehydrate_handler
+from conversations.session_store import LocalMemorySessionStore
+
+pytestmark = pytest.mark.usefixtures('immediate_scoring')
+
+
+@pytest.mark.django_db
+def test_rehydrated_conversation_keeps_running_score(authenticated_client, conversation):
+    """測試處理器從會話存儲丟失後重建，評分仍從對話保存的覆蓋情況累計，已得分的項目不重複計分"""
+    url = reverse('conversation-send-message', args=[conversation.id])
+    authenticated_client.post(url, {'content': '小朋友叫什麼名字？'}, format='json')
+    views.conversation_handlers.delete(conversation.id)
+
+    response = authenticated_client.post(f'{url}?scoring=sync', {'content': '他叫什麼名字'}, format='json')
+
+    assert response.data['messages'][0]['score'] == 0
+    assert response.data['score']['score_total'] == 2
+    conversation.refresh_from_db()
+    assert set(conversation.criteria_coverage) == {'詢問病人姓名'}
+    assert conversation.turn_count == 2
+
+
+@pytest.mark.django_db
+def test_handler_state_has_no_scoring(conversation):
+    """測試會話存儲中的處理器狀態只包含索引版本與對話狀態，不保存評分"""
+    handler = ConversationHandler.rehydrate(conversation)
+
+    assert 'scoring' not in handler.to_state()
+    assert handler.patient_index.version == handler.to_state()['index_version']
+
+
+@pytest.mark.django_db
+def test_missing_handler_is_rehydrated_into_store(conversation):
+    """測試會話存儲缺失處理器時自動重建"""
+    store = LocalMemorySessionStore()
+
+    handler = get_or_rehydrate_handler(conversation, store)
+
+    assert handler is not None
+    assert store.get(conversation.id) is handler
+
+
+@pytest.mark.django_db
+def test_completed_conversation_is_not_rehydrated(conversation):
+    """測試已結束的對話不會被重建"""
+    from django.utils import timezone
+
+    conversation.completed_at = timezone.now()
+    conversation.save()
+
+    assert get_or_rehydrate_handler(conversation, LocalMemorySessionStore()) is None
@@ -0,0 +1,55 @@
+import pytest
+
+from conversations.scoring_queue import build_score_engine
+from conversations.models import ScoreItem
+
+
+@pytest.fixture
+def scoring_json(scoring_json):
+    """大便情況的語義提示帶有子項目"""
+    return [
+        dict(item, 語義提示='請問大便的次數（次數、有無血絲）？') if item['id'] == '大便情況' else item
+        for item in scoring_json
+    ]
+
+
+def ask(conversation, text):
+    score_engine = build_score_engine(conversation)
+    result = score_engine.score_response(text)
+    conversation.record_turn(result['score'], score_engine.category_scores(), score_engine.coverage())
+    return result
+
+
+@pytest.mark.django_db
+def test_record_turn_keeps_running_aggregates(conversation):
+    """測試每輪評分後增量更新輪數、總分、分類得分與覆蓋情況"""
+
+    ask(conversation, '小朋友叫什麼名字？')
+    ask(conversation, '今天大便幾次、有沒有血絲？')
+    ask(conversation, '你好')
+
+    conversation.refresh_from_db()
+    assert conversation.turn_count == 3
+    assert conversation.score_total == 12
+    assert conversation.average_score == 4
+    assert conversation.category_scores == {'病人辨識': 2, '病人情況': 10}
+    assert conversation.criteria_coverage['大便情況'] == {'score': 10, 'sub_items': ['有無血絲']}
+
+
+@pytest.mark.django_db
+def test_finalize_writes_breakdown(conversation):
+    """測試結束對話時寫入平均分及每個評分項目的明細"""
+    ask(conversation, '小朋友叫什麼名字？')
+    ask(conversation, '你好')
+
+    conversation.finalize(build_score_engine(conversation).rubric.breakdown(conversation.criteria_coverage))
+
+    conversation.refresh_from_db()
+    assert conversation.score == 1
+    assert conversation.completed_at is not None
+    items = {item.criterion_id: item for item in ScoreItem.objects.filter(conversation=conversation)}
+    assert set(items) == {'詢問病人姓名', '大便情況'}
+    assert items['詢問病人姓名'].completed and items['詢問病人姓名'].score == 2
+    assert not items['大便情況'].completed
+    assert items['大便情況'].max_score == 10
+    assert items['大便情況'].sub_items == ['次數', '有無血絲']
@@ -0,0 +1,107 @@
+import threading
+import time
+from datetime import timedelta
+
+import pytest
+from django.urls import reverse
+from django.utils import timezone
+
+from conversations import views
+from conversations.models import Message, ScoringJob
+from conversations.scoring_queue import DatabaseScoringQueue, ImmediateScoringQueue, LocalScoringQueue
+
+
+def test_local_queue_runs_jobs_of_one_conversation_in_order():
+    """測試同一對話的評分任務依提交順序執行，wait 等待全部完成"""
+    finished = []
+    lock = threading.Lock()
+
+    def job(message_id):
+        time.sleep(0.02 if message_id == 1 else 0)
+        with lock:
+            finished.append(message_id)
+
+    queue = LocalScoringQueue(max_workers=4, job=job)
+    for message_id in range(1, 6):
+        queue.submit(7, message_id)
+
+    assert queue.wait(7, timeout=5)
+    assert finished == [1, 2, 3, 4, 5]
+    assert queue.wait(8)
+
+
+@pytest.mark.django_db
+def test_database_queue_scores_pending_messages(conversation):
+    """測試數據庫隊列逐個處理評分任務，已評分的消息不重複計分"""
+    queue = DatabaseScoringQueue(poll_interval=0.01)
+    first = Message.objects.create(conversation=conversation, role=Message.STUDENT, content='小朋友叫什麼名字？')
+    second = Message.objects.create(conversation=conversation, role=Message.STUDENT, content='他叫什麼名字')
+    queue.enqueue(conversation.id, first.id)
+    queue.enqueue(conversation.id, second.id)
+
+    assert not queue.wait(conversation.id, timeout=0)
+    while queue.process_one() is not None:
+        pass
+
+    assert queue.wait(conversation.id, timeout=0)
+    assert set(ScoringJob.objects.values_list('status', flat=True)) == {ScoringJob.DONE}
+    first.refresh_from_db()
+    second.refresh_from_db()
+    assert (first.score, second.score) == (2, 0)
+    conversation.refresh_from_db()
+    assert conversation.turn_count == 2
+    assert conversation.score_total == 2
+
+
+@pytest.mark.django_db
+def test_expired_claim_is_processed_again(conversation):
+    """測試領取任務的 worker 退出後，租約過期的任務重新被處理，重試次數用完後標記為失敗"""
+    queue = DatabaseScoringQueue(poll_interval=0.01, max_attempts=2, lease=60)
+    message = Message.objects.create(conversation=conversation, role=Message.STUDENT, content='小朋友叫什麼名字？')
+    queue.enqueue(conversation.id, message.id)
+
+    # worker 領取後退出，任務停留在處理中
+    job = queue.claim()
+    assert queue.claim() is None
+    ScoringJob.objects.filter(pk=job.pk).update(claimed_at=timezone.now() - timedelta(seconds=120))
+
+    job = queue.process_one()
+    assert job.status == ScoringJob.DONE and job.attempts == 2
+    assert queue.wait(conversation.id, timeout=0)
+    message.refresh_from_db()
+    assert message.score == 2
+
+    other = Message.objects.create(conversation=conversation, role=Message.STUDENT, content='你好')
+    queue.enqueue(conversation.id, other.id)
+    stuck = queue.claim()
+    ScoringJob.objects.filter(pk=stuck.pk).update(attempts=2, claimed_at=timezone.now() - timedelta(seconds=120))
+    assert queue.process_one() is None
+    assert ScoringJob.objects.get(pk=stuck.pk).status == ScoringJob.FAILED
+    assert queue.wait(conversation.id, timeout=0)
+
+
+@pytest.mark.django_db
+def test_end_conversation_waits_for_scoring(authenticated_client, conversation, monkeypatch):
+    """測試結束對話時評分未完成則返回 503，完成後寫入結果"""
+    queue = DatabaseScoringQueue(poll_interval=0.01)
+    monkeypatch.setattr(views, 'scoring_queue', queue)
+    monkeypatch.setattr(views, 'SCORING_WAIT_TIMEOUT', 0)
+    authenticated_client.post(reverse('conversation-send-message', args=[conversation.id]), {'content': '今天大便幾次？'}, format='json')
+
+    end_url = reverse('conversation-end-conversation', args=[conversation.id])
+    assert authenticated_client.post(end_url).status_code == 503
+
+    queue.process_one()
+    response = authenticated_client.post(end_url)
+    assert response.status_code == 200
+    assert response.data['score'] == 10
+    assert len(response.data['score_items']) == 2
+
+
+@pytest.mark.django_db
+def test_immediate_queue_scores_inline(conversation):
+    """測試同步隊列立即評分"""
+    message = Message.objects.create(conversation=conversation, role=Message.STUDENT, content='今天大便幾次？')
+    ImmediateScoringQueue().enqueue(conversation.id, message.id)
+    message.refresh_from_db()
+    assert message.score == 10
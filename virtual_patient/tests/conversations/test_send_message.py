@@ -0,0 +1,79 @@
+import pytest
+from django.urls import reverse
+
+from conversations import views
+from conversations.models import Conversation, Message
+
+pytestmark = pytest.mark.usefixtures('immediate_scoring')
+
+
+@pytest.mark.django_db
+def test_send_message_returns_only_new_messages(authenticated_client, conversation):
+    """測試發送消息只返回本輪新增的兩條消息和得分匯總"""
+    url = reverse('conversation-send-message', args=[conversation.id])
+
+    authenticated_client.post(url, {'content': '小朋友叫什麼名字？'}, format='json')
+    response = authenticated_client.post(url, {'content': '今天大便幾次？'}, format='json')
+
+    assert response.status_code == 200
+    assert [message['role'] for message in response.data['messages']] == [Message.STUDENT, Message.PATIENT]
+    assert response.data['score']['id'] == conversation.id
+    # 評分結果寫回學生消息並累加到對話匯總
+    student = Message.objects.get(id=response.data['messages'][0]['id'])
+    assert student.score == 10
+    assert student.matched_criteria == [{'id': '大便情況', 'sub_items': []}]
+    conversation.refresh_from_db()
+    assert conversation.turn_count == 2
+    assert conversation.score_total == 12
+
+@pytest.mark.django_db
+def test_since_returns_messages_after_id(authenticated_client, conversation):
+    """測試重新連線的客戶端可用 since 取得漏掉的消息"""
+    send_url = reverse('conversation-send-message', args=[conversation.id])
+    first = authenticated_client.post(send_url, {'content': '小朋友叫什麼名字？'}, format='json')
+    last_seen = first.data['messages'][-1]['id']
+
+    response = authenticated_client.post(f'{send_url}?since={last_seen - 2}', {'content': '你好'}, format='json')
+    assert len(response.data['messages']) == 4
+
+    response = authenticated_client.get(reverse('conversation-messages', args=[conversation.id]), {'since': last_seen})
+    assert [message['content'] for message in response.data['messages']][0] == '你好'
+    assert len(response.data['messages']) == 2
+
+    response = authenticated_client.get(reverse('conversation-messages', args=[conversation.id]), {'since': 'abc'})
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_sync_scoring_returns_score_and_timings(authenticated_client, conversation):
+    """測試考試模式立即返回評分，並報告各階段耗時"""
+    url = reverse('conversation-send-message', args=[conversation.id])
+
+    response = authenticated_client.post(f'{url}?scoring=sync', {'content': '今天大便幾次？'}, format='json')
+
+    assert response.status_code == 200
+    assert response.data['messages'][0]['score'] == 10
+    assert response.data['score']['turn_count'] == 1
+    assert response.data['score']['category_scores'] == {'病人辨識': 0, '病人情況': 10}
+    assert set(response.data['timings']) == {'embed_ms', 'retrieval_ms', 'scoring_ms', 'total_ms'}
+    assert response.data['messages'][1]['role'] == Message.PATIENT
+
+
+@pytest.mark.django_db
+def test_sync_scoring_rescores_when_coverage_changed(conversation):
+    """測試同步評分開始後其他輪已記錄同一評分項目時，按最新狀態重新評分，不重複計分"""
+    stale = Conversation.objects.select_related('virtual_patient').get(pk=conversation.pk)
+    score_engine = views.build_score_engine(stale)
+    score_result = score_engine.score_response('今天大便幾次？')
+    assert score_result['score'] == 10
+
+    # 評分期間另一輪已得到「大便情況」的分數
+    views.save_turn(conversation, '今天大便幾次？', '到今天中午總共拉五次')
+
+    new_messages = views.save_turn(stale, '今天大便幾次？', '到今天中午總共拉五次', score_engine, score_result)
+
+    assert new_messages[0].score == 0
+    conversation.refresh_from_db()
+    assert conversation.turn_count == 2
+    assert conversation.score_total == 10
+    assert stale.score_total == 10
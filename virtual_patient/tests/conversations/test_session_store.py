@@ -0,0 +1,104 @@
+from conversations.session_store import LocalMemorySessionStore, SQLiteSessionStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class StateHandler:
+    """只保存狀態的測試處理器"""
+
+    def __init__(self, state):
+        self.state = state
+
+    def to_state(self):
+        return self.state
+
+    @classmethod
+    def from_state(cls, conversation_id, state):
+        return cls(state)
+
+
+def test_local_store_evicts_least_recently_used():
+    """測試超過條目上限時淘汰最久未使用的對話"""
+    store = LocalMemorySessionStore(max_entries=2)
+    store.set(1, 'a')
+    store.set(2, 'b')
+    store.get(1)
+    store.set(3, 'c')
+
+    assert store.get(2) is None
+    assert store.get(1) == 'a'
+    assert store.get(3) == 'c'
+    assert len(store) == 2
+
+
+def test_local_store_expires_idle_sessions():
+    """測試閒置超過 TTL 的對話被清除"""
+    clock = FakeClock()
+    store = LocalMemorySessionStore(ttl=10, clock=clock)
+    store.set(1, 'a')
+
+    clock.now = 5
+    assert store.get(1) == 'a'
+    clock.now = 14
+    assert store.get(1) == 'a'
+    clock.now = 30
+    assert store.get(1) is None
+
+
+def test_sqlite_store_shared_between_instances(tmp_path):
+    """測試兩個 worker 透過同一個 SQLite 文件共享對話狀態"""
+    path = tmp_path / 'sessions.sqlite3'
+    worker_a = SQLiteSessionStore(path, handler_class=StateHandler)
+    worker_b = SQLiteSessionStore(path, handler_class=StateHandler)
+
+    worker_a.set(42, StateHandler({'dialog': {'current_index': 3}}))
+    assert worker_b.get(42).state == {'dialog': {'current_index': 3}}
+
+    worker_b.delete(42)
+    assert worker_a.get(42) is None
+
+
+def test_sqlite_store_expires_sessions(tmp_path):
+    """測試共享存儲中過期的對話不再返回"""
+    clock = FakeClock()
+    store = SQLiteSessionStore(tmp_path / 'sessions.sqlite3', ttl=10, handler_class=StateHandler, clock=clock)
+    store.set(1, StateHandler({}))
+
+    clock.now = 11
+    assert store.get(1) is None
+
+
+class CountingHandler(StateHandler):
+    rebuilt = 0
+
+    @classmethod
+    def from_state(cls, conversation_id, state):
+        cls.rebuilt += 1
+        return cls(state)
+
+
+def test_sqlite_store_rebuilds_handler_only_when_revision_changes(tmp_path):
+    """測試同一 worker 在狀態未被其他 worker 改寫時重用已重建的處理器"""
+    path = tmp_path / 'sessions.sqlite3'
+    worker_a = SQLiteSessionStore(path, handler_class=CountingHandler)
+    worker_b = SQLiteSessionStore(path, handler_class=CountingHandler)
+
+    handler = CountingHandler({'dialog': {'current_index': 1}})
+    worker_a.set(7, handler)
+    assert worker_a.get(7) is handler
+    assert worker_a.get(7) is handler
+    assert CountingHandler.rebuilt == 0
+
+    first = worker_b.get(7)
+    assert worker_b.get(7) is first
+    assert CountingHandler.rebuilt == 1
+
+    worker_b.set(7, CountingHandler({'dialog': {'current_index': 2}}))
+    assert worker_a.get(7).state == {'dialog': {'current_index': 2}}
+    assert CountingHandler.rebuilt == 2
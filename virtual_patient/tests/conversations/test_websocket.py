@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import pytest
+from asgiref.sync import async_to_sync, sync_to_async
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from conversations import views
+from conversations.models import Conversation, Message, ScoreItem
+from conversations.websocket import ConversationSocket, conversation_websocket
+
+pytestmark = pytest.mark.usefixtures('immediate_scoring')
+
+
+def run_socket(path, frames):
+    """依次發送幀直到連線關閉，返回服務端發送的所有事件"""
+    async def session():
+        incoming = asyncio.Queue()
+        sent = []
+        await incoming.put({'type': 'websocket.connect'})
+        for frame in frames:
+            await incoming.put({'type': 'websocket.receive', 'text': json.dumps(frame, ensure_ascii=False)})
+        await incoming.put({'type': 'websocket.disconnect'})
+
+        async def send(event):
+            sent.append(event)
+
+        await conversation_websocket({'type': 'websocket', 'path': path}, incoming.get, send)
+        return sent
+
+    return async_to_sync(session)()
+
+
+def frames_of(events):
+    return [json.loads(event['text']) for event in events if event['type'] == 'websocket.send']
+
+
+@pytest.mark.django_db
+def test_socket_turns_and_end(conversation, test_user):
+    """測試驗證一次後可連續發送多輪提問，收到回覆、評分與結束幀"""
+    token = str(RefreshToken.for_user(test_user).access_token)
+    events = run_socket(f'/ws/conversations/{conversation.id}/', [
+        {'type': 'auth', 'token': token},
+        {'type': 'message', 'content': '小朋友叫什麼名字？'},
+        {'type': 'message', 'content': '今天大便幾次？', 'scoring': 'sync'},
+        {'type': 'end'},
+    ])
+
+    assert events[0]['type'] == 'websocket.accept'
+    assert events[-1] == {'type': 'websocket.close', 'code': 1000}
+    frames = frames_of(events)
+    kinds = [frame['type'] for frame in frames]
+    assert kinds[0] == 'ready'
+    assert kinds.count('reply') == 2
+    assert kinds[-1] == 'ended'
+    scores = {frame['message_id']: frame['score'] for frame in frames if frame['type'] == 'score'}
+    assert sorted(scores.values()) == [2, 10]
+    assert frames[-1]['conversation']['score'] == 6
+    assert Message.objects.filter(conversation=conversation).count() == 4
+
+
+@pytest.mark.django_db
+def test_socket_rejects_invalid_token(conversation):
+    """測試驗證失敗時以 4401 關閉連線"""
+    events = run_socket(f'/ws/conversations/{conversation.id}/', [{'type': 'auth', 'token': 'invalid'}])
+
+    assert events[-1] == {'type': 'websocket.close', 'code': 4401}
+    assert frames_of(events)[0]['type'] == 'error'
+
+
+def test_socket_unknown_path_is_closed():
+    """測試未知路徑在接受連線前關閉"""
+    events = run_socket('/ws/unknown/', [])
+    assert events == [{'type': 'websocket.close', 'code': 4404}]
+
+
+@pytest.mark.django_db
+def test_socket_rejects_turns_after_conversation_ended_elsewhere(conversation, test_user):
+    """測試對話經 HTTP 結束後，已連線的 WebSocket 不能再發送提問"""
+    token = str(RefreshToken.for_user(test_user).access_token)
+
+    async def session():
+        frames = []
+
+        async def send(event):
+            frames.append(json.loads(event['text']))
+
+        socket = ConversationSocket(conversation.id, send)
+        assert await socket.authenticate({'type': 'auth', 'token': token})
+        await sync_to_async(views.finalize_conversation)(await Conversation.objects.aget(pk=conversation.id))
+        await socket.turn({'type': 'message', 'content': '小朋友叫什麼名字？'})
+        await socket.end()
+        return frames
+
+    frames = async_to_sync(session)()
+
+    assert frames[1] == {'type': 'error', 'error': '對話已結束'}
+    assert frames[2]['type'] == 'ended'
+    assert Message.objects.filter(conversation=conversation).count() == 0
+
+
+@pytest.mark.django_db
+def test_finalize_conversation_only_once(conversation):
+    """測試重複結束對話時只有第一次寫入平均分與評分明細"""
+    first = Conversation.objects.get(pk=conversation.id)
+    second = Conversation.objects.get(pk=conversation.id)
+
+    assert views.finalize_conversation(first)
+    items = list(ScoreItem.objects.filter(conversation=conversation).values_list('id', flat=True))
+    assert not views.finalize_conversation(second)
+    assert second.completed_at == first.completed_at
+    assert list(ScoreItem.objects.filter(conversation=conversation).values_list('id', flat=True)) == items
@@ -0,0 +1 @@
+# 空文件，確保測試包被識別 
\ No newline at end of file
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+from rag.case_bundle import CaseBundle, case_bundle_path, load_case_bundle, write_case_bundle
+from rag.dialog_items import dialog_items
+from rag.embeddings import HashingEncoder
+from rag.keyword_matcher import CaseKeywordMatcher
+from rag.patient_index import PatientIndex, PatientIndexRegistry
+from rag.rubric import CompiledRubric, compiled_rubrics
+
+DIALOG = [
+    {'id': 'name', '觸發語句': ['小朋友叫什麼名字？', '他的名字是？'], '標準回覆': '他叫王小明', '角色': '家屬', '情境分類': '基本資料', '關鍵詞': ['名字']},
+    {'id': 'stool', '觸發語句': ['今天拉了幾次？'], '標準回覆': '到今天中午總共拉五次', '關鍵詞': ['拉', '幾次']},
+    {'id': 'fever', 'question': '有沒有發燒？', 'answer': '昨天晚上燒到38度'},
+]
+
+SCORING = [
+    {'id': 1, '分類': '病史', '項目': '確認病人姓名', '語義提示': '詢問病人的名字', '關鍵詞': ['名字'], '配分': 1},
+    {'id': 2, '分類': '病史', '項目': '排便情形', '語義提示': '詢問排便次數、性狀', '關鍵詞': ['幾次', '血絲'], '配分': 2},
+]
+
+
+class FailingEncoder(HashingEncoder):
+    """確保載入病例文件時不再編碼對話與評分標準"""
+
+    def encode(self, texts):
+        if len(texts) > 1:
+            raise AssertionError('不應重新編碼')
+        return super().encode(texts)
+
+
+@pytest.fixture
+def bundle(tmp_path):
+    path = write_case_bundle(tmp_path / 'case.vpcase', 7, DIALOG, SCORING, HashingEncoder(), name='王小明')
+    return CaseBundle(path)
+
+
+def test_round_trip_restores_dialog_and_criteria(bundle):
+    """測試病例文件還原出相同的對話項目與評分標準"""
+    assert dialog_items(bundle.dialog_json()) == dialog_items(DIALOG)
+    assert [criterion['id'] for criterion in bundle.criteria()] == [1, 2]
+    assert bundle.summary()['name'] == '王小明'
+    assert bundle.verify() == []
+
+
+def test_patient_index_matches_fresh_build(bundle):
+    """測試從病例文件載入的索引與從 JSON 構建的結果一致，且不重新編碼"""
+    fresh = PatientIndex.build(7, DIALOG, HashingEncoder())
+    loaded = bundle.patient_index(FailingEncoder())
+
+    assert loaded.version == fresh.version
+    assert np.array_equal(loaded.embeddings, fresh.embeddings)
+    for query in ('他叫什麼名字', '拉了幾次', '有發燒嗎'):
+        assert loaded.search(query)[0]['answer'] == fresh.search(query)[0]['answer']
+
+
+def test_rubric_and_keyword_matcher_match_fresh_build(bundle):
+    """測試評分標準與關鍵詞自動機的匹配結果與重新編譯的一致"""
+    rubric = CompiledRubric.build(SCORING, HashingEncoder())
+    loaded = bundle.compiled_rubric(FailingEncoder())
+    assert loaded.version == rubric.version
+    assert loaded.sub_items == rubric.sub_items
+    assert np.array_equal(loaded.points, rubric.points)
+
+    fresh = CaseKeywordMatcher(rubric, DIALOG)
+    matcher = bundle.keyword_matcher()
+    for text in ('小朋友的名字', '今天拉了幾次，有沒有血絲'):
+        expected = fresh.match(text)
+        actual = matcher.match(text)
+        assert actual.criteria == expected.criteria
+        assert actual.dialog_items == expected.dialog_items
+
+
+def test_verify_detects_corruption(bundle):
+    """測試任何一段被改動時 verify 報告 CRC 不符"""
+    offset, length, _ = bundle.sections['d_emb']
+    with open(bundle.path, 'r+b') as f:
+        f.seek(offset + length // 2)
+        byte = f.read(1)[0]
+        f.seek(offset + length // 2)
+        f.write(bytes([byte ^ 0xFF]))
+
+    problems = CaseBundle(bundle.path).verify()
+    assert any('d_emb' in problem for problem in problems)
+
+
+def test_load_rejects_other_model(tmp_path):
+    """測試模型不同時不使用病例文件"""
+    index = PatientIndex.build(7, DIALOG, HashingEncoder())
+    write_case_bundle(case_bundle_path(tmp_path, 7, index.version), 7, DIALOG, SCORING, HashingEncoder())
+
+    assert load_case_bundle(tmp_path, 7, index.version, 'other-model') is None
+    assert load_case_bundle(tmp_path, 7, index.version, HashingEncoder().model_id) is not None
+
+
+def test_registry_loads_case_bundle(tmp_path, settings):
+    """測試設定 RAG_CASE_BUNDLE_DIR 後索引表從病例文件載入，並預先緩存評分標準"""
+    index = PatientIndex.build(7, DIALOG, HashingEncoder())
+    write_case_bundle(case_bundle_path(tmp_path, 7, index.version), 7, DIALOG, SCORING, HashingEncoder())
+    settings.RAG_CASE_BUNDLE_DIR = str(tmp_path)
+
+    loaded = PatientIndexRegistry(encoder=FailingEncoder()).get(7, DIALOG, SCORING)
+
+    assert loaded.search('今天拉了幾次')[0]['answer'] == '到今天中午總共拉五次'
+    assert CompiledRubric.build(SCORING, HashingEncoder()).version in compiled_rubrics._rubrics
+
+
+def test_registry_skips_outdated_rubric_in_case_bundle(tmp_path, settings):
+    """測試評分標準在寫入病例文件後更新時，只使用文件中的對話部分，不緩存舊評分標準"""
+    scoring = [dict(SCORING[0], 配分=3)]
+    index = PatientIndex.build(8, DIALOG, HashingEncoder())
+    write_case_bundle(case_bundle_path(tmp_path, 8, index.version), 8, DIALOG, scoring, HashingEncoder())
+    settings.RAG_CASE_BUNDLE_DIR = str(tmp_path)
+    old_version = CompiledRubric.build(scoring, HashingEncoder()).version
+    compiled_rubrics._rubrics.pop(old_version, None)
+
+    loaded = PatientIndexRegistry(encoder=FailingEncoder()).get(8, DIALOG, SCORING)
+
+    assert loaded.search('今天拉了幾次')[0]['answer'] == '到今天中午總共拉五次'
+    assert old_version not in compiled_rubrics._rubrics
+
+
+def test_criterion_id_types_round_trip(tmp_path):
+    """測試字符串與整數的評分項目 id 各自還原為原來的類型"""
+    scoring = [dict(SCORING[0], id='1'), dict(SCORING[1], id=1)]
+    bundle = CaseBundle(write_case_bundle(tmp_path / 'case.vpcase', 7, DIALOG, scoring, HashingEncoder()))
+
+    assert [criterion['id'] for criterion in bundle.criteria()] == ['1', 1]
+    with pytest.raises(ValueError):
+        write_case_bundle(tmp_path / 'bad.vpcase', 7, DIALOG, [dict(SCORING[0], id=1.5)], HashingEncoder())
@@ -0,0 +1,64 @@
+import numpy as np
+
+from rag.embedding_bundle import EmbeddingBundle, make_vector_id
+from rag.embeddings import HashingEncoder
+from rag.patient_index import PatientIndex, write_patient_bundle
+
+DIALOG = [
+    {'id': 'a', 'question': '你幾歲？', 'answer': '2歲'},
+    {'id': 'b', 'question': '今天拉了幾次？', 'answer': '到今天中午總共拉五次'},
+]
+
+
+class FailingEncoder(HashingEncoder):
+    """確保載入嵌入文件時不再編碼對話問題"""
+
+    def encode(self, texts):
+        if len(texts) > 1:
+            raise AssertionError('不應重新編碼對話問題')
+        return super().encode(texts)
+
+
+def test_bundle_round_trip_is_memory_mapped(tmp_path):
+    """測試嵌入文件寫入後以唯讀 mmap 載入"""
+    path, version = write_patient_bundle(1, DIALOG, tmp_path, HashingEncoder())
+    bundle = EmbeddingBundle(path)
+
+    assert bundle.ids == ['a', 'b']
+    assert bundle.version == version
+    assert not bundle.embeddings.flags.writeable
+    assert np.allclose(np.linalg.norm(bundle.embeddings, axis=1), 1.0, atol=1e-5)
+    assert np.array_equal(bundle.row(make_vector_id(version, 1)), bundle.embeddings[1])
+
+
+def test_patient_index_loads_bundle_without_encoding(tmp_path):
+    """測試有嵌入文件時索引直接使用，不重新編碼"""
+    write_patient_bundle(1, DIALOG, tmp_path, HashingEncoder())
+
+    index = PatientIndex.build(1, DIALOG, FailingEncoder(), bundle_dir=tmp_path)
+
+    assert index.search('今天拉幾次')[0]['text'] == '今天拉了幾次？'
+
+
+def test_stale_bundle_is_ignored(tmp_path):
+    """測試對話內容變更後不使用舊版本的嵌入文件"""
+    write_patient_bundle(1, DIALOG, tmp_path, HashingEncoder())
+    changed = DIALOG + [{'id': 'c', 'question': '有吐嗎？', 'answer': '有'}]
+
+    index = PatientIndex.build(1, changed, HashingEncoder(), bundle_dir=tmp_path)
+
+    assert len(index.vector_store.collections['dialog_questions']['texts']) == 3
+
+
+def test_grouped_dialog_bundle_keeps_item_ids(tmp_path):
+    """測試多觸發語句的對話寫入嵌入文件後，每行仍指向所屬項目"""
+    dialog = [
+        {'id': 'a', '觸發語句': ['你幾歲？', '小朋友幾歲？'], '標準回覆': '2歲'},
+        {'id': 'b', '觸發語句': ['今天拉了幾次？'], '標準回覆': '到今天中午總共拉五次'},
+    ]
+    path, _ = write_patient_bundle(1, dialog, tmp_path, HashingEncoder())
+    assert EmbeddingBundle(path).ids == ['a', 'a', 'b']
+
+    index = PatientIndex.build(1, dialog, FailingEncoder(), bundle_dir=tmp_path)
+
+    assert index.search('小朋友幾歲')[0]['answer'] == '2歲'
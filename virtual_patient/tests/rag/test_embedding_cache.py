@@ -0,0 +1,66 @@
+import numpy as np
+
+from rag.embedding_cache import CachedEncoder
+from rag.embeddings import HashingEncoder
+
+
+class CountingEncoder(HashingEncoder):
+    def __init__(self):
+        super().__init__()
+        self.encoded = []
+
+    def encode(self, texts):
+        self.encoded.extend(texts)
+        return super().encode(texts)
+
+
+def test_memory_cache_hits_normalized_text():
+    """測試標準化後相同的文本只編碼一次"""
+    base = CountingEncoder()
+    encoder = CachedEncoder(base)
+
+    first = encoder.encode(['你幾歲？'])
+    second = encoder.encode([' 你幾歲？ '])
+
+    assert np.array_equal(first, second)
+    assert len(base.encoded) == 1
+    assert encoder.stats()['memory_hits'] == 1
+    assert encoder.stats()['misses'] == 1
+
+
+def test_original_text_is_encoded():
+    """測試標準化文本只作為緩存鍵，交給編碼器的是原文"""
+    base = CountingEncoder()
+    CachedEncoder(base).encode(['ＡＢＣ 有吐嗎？', 'abc 有吐嗎？'])
+
+    assert base.encoded == ['ＡＢＣ 有吐嗎？']
+
+
+def test_duplicates_in_one_batch_encoded_once():
+    """測試同一批中重複的文本只編碼一次"""
+    base = CountingEncoder()
+    matrix = CachedEncoder(base).encode(['有吐嗎？', '有吐嗎？', '你幾歲？'])
+
+    assert matrix.shape == (3, base.dim)
+    assert len(base.encoded) == 2
+
+
+def test_disk_cache_survives_new_process(tmp_path):
+    """測試持久化緩存可在新的編碼器實例（模擬重啟）中命中"""
+    path = tmp_path / 'embeddings.sqlite3'
+    CachedEncoder(CountingEncoder(), path=path).encode(['小朋友叫什麼名字？'])
+
+    base = CountingEncoder()
+    encoder = CachedEncoder(base, path=path)
+    encoder.encode(['小朋友叫什麼名字？'])
+
+    assert base.encoded == []
+    assert encoder.stats()['disk_hits'] == 1
+
+
+def test_memory_cache_is_bounded():
+    """測試進程內緩存不超過條目上限"""
+    encoder = CachedEncoder(HashingEncoder(), max_entries=2)
+    encoder.encode(['一', '二', '三'])
+
+    assert len(encoder._memory) == 2
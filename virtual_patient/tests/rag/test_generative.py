@@ -0,0 +1,236 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from rag.dialog_generator import DialogGenerator
+from rag.embeddings import HashingEncoder
+from rag.generative import GenerationError, GenerativeClient, PatientReplyGenerator
+from rag.patient_index import PatientIndex
+
+DIALOG = [
+    {'question': '你幾歲？', 'answer': '2歲', '角色': '病童母親'},
+]
+
+
+class StubServer:
+    """本地模擬的 chat completions 服務，記錄請求數、連線數與最大並發數"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.requests = []
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with stub.lock:
+                    stub.connections += 1
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stub.lock:
+                    stub.requests.append(payload)
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                time.sleep(stub.delay)
+                with stub.lock:
+                    stub.active -= 1
+                question = payload['messages'][-1]['content']
+                if payload.get('stream'):
+                    # 每個字一個 SSE 事件
+                    events = [json.dumps({'choices': [{'delta': {'content': char}}]}, ensure_ascii=False) for char in f'回答：{question}']
+                    body = ''.join(f'data: {event}\n\n' for event in events + ['[DONE]']).encode('utf-8')
+                    content_type = 'text/event-stream'
+                else:
+                    body = json.dumps({'choices': [{'message': {'content': f'回答：{question}'}}]}, ensure_ascii=False).encode('utf-8')
+                    content_type = 'application/json'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/v1/chat/completions'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+def ask_concurrently(func, questions):
+    results = [None] * len(questions)
+
+    def run(i):
+        results[i] = func(questions[i])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(questions))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_replies_are_cached_and_connections_reused(stub):
+    """測試相同問題（標準化後）只請求一次，不同問題重用同一連線"""
+    generator = PatientReplyGenerator(GenerativeClient(stub.url), DIALOG, version='v1')
+
+    assert generator.reply('他有發燒嗎？') == '回答：他有發燒嗎？'
+    assert generator.reply('他有發燒嗎?') == '回答：他有發燒嗎？'
+    generator.reply('他有咳嗽嗎？')
+
+    assert len(stub.requests) == 2
+    assert stub.connections == 1
+    assert '病童母親' in stub.requests[0]['messages'][0]['content']
+    assert '2歲' in stub.requests[0]['messages'][0]['content']
+
+
+def test_identical_inflight_prompts_are_coalesced(stub):
+    """測試同時進行的相同問題只發出一個請求"""
+    stub.delay = 0.2
+    client = GenerativeClient(stub.url)
+    generator = PatientReplyGenerator(client, DIALOG, version='v1')
+
+    results = ask_concurrently(generator.reply, ['肚子痛嗎？'] * 5)
+
+    assert results == ['回答：肚子痛嗎？'] * 5
+    assert len(stub.requests) == 1
+    assert client.stats()['coalesced'] == 4
+
+
+def test_concurrency_is_bounded(stub):
+    """測試全局並發上限"""
+    stub.delay = 0.1
+    generator = PatientReplyGenerator(GenerativeClient(stub.url, max_concurrency=2), DIALOG, version='v1')
+
+    ask_concurrently(generator.reply, [f'問題{i}' for i in range(6)])
+
+    assert len(stub.requests) == 6
+    assert stub.max_active <= 2
+
+
+def test_timeout_falls_back_to_canned_reply(stub):
+    """測試生成服務超時時拋出 GenerationError，對話生成器退回固定回覆"""
+    stub.delay = 0.5
+    client = GenerativeClient(stub.url, timeout=0.1)
+    generator = PatientReplyGenerator(client, DIALOG, version='v1')
+
+    with pytest.raises(GenerationError):
+        generator.reply('有沒有嘔吐？')
+
+    dialog_generator = DialogGenerator(DIALOG, fallback=generator)
+    assert dialog_generator.fallback_response('有沒有拉肚子？') == '我不太明白您的意思，請換個方式提問。'
+    # 失敗的結果不緩存
+    stub.delay = 0
+    client.timeout = client.pool.timeout = 5
+    assert generator.reply('有沒有嘔吐？') == '回答：有沒有嘔吐？'
+
+
+def test_unexpected_leader_error_reaches_coalesced_callers(stub):
+    """測試 single-flight 的發起者遇到非 GenerationError 異常時，等待者也得到 GenerationError 而不是 None"""
+    client = GenerativeClient(stub.url)
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing_request(messages):
+        started.set()
+        release.wait(5)
+        raise RuntimeError('響應處理錯誤')
+
+    client._request = failing_request
+    errors = []
+
+    def ask():
+        try:
+            client.complete([{'role': 'user', 'content': '肚子痛嗎？'}])
+        except Exception as error:
+            errors.append(error)
+
+    leader = threading.Thread(target=ask)
+    leader.start()
+    started.wait(5)
+    waiters = [threading.Thread(target=ask) for _ in range(3)]
+    for thread in waiters:
+        thread.start()
+    while client.stats()['coalesced'] < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + waiters:
+        thread.join()
+
+    assert len(errors) == 4
+    assert all(isinstance(error, GenerationError) for error in errors)
+
+
+def test_fallback_reply_is_streamed_chunk_by_chunk(stub):
+    """測試檢索不到時生成式回退以 stream: true 逐段產生，完成後寫入緩存並重用連線"""
+    client = GenerativeClient(stub.url)
+    generator = PatientReplyGenerator(client, DIALOG, version='v1')
+    dialog_generator = DialogGenerator(DIALOG, fallback=generator)
+    vector_store = PatientIndex.build(1, DIALOG, HashingEncoder()).vector_store
+
+    chunks = list(dialog_generator.stream_response('肚子痛嗎？', vector_store, results=[]))
+
+    assert len(chunks) > 1
+    assert ''.join(chunks) == '回答：肚子痛嗎？'
+    assert stub.requests[0]['stream'] is True
+    # 已緩存的回覆整段返回，不再請求
+    assert list(dialog_generator.stream_response('肚子痛嗎？', vector_store, results=[])) == ['回答：肚子痛嗎？']
+    assert generator.reply('有沒有發燒？') == '回答：有沒有發燒？'
+    assert len(stub.requests) == 2
+    assert stub.connections == 1
+
+
+def test_stream_falls_back_when_backend_is_down():
+    """測試生成服務無法連線時串流返回固定回覆"""
+    generator = PatientReplyGenerator(GenerativeClient('http://127.0.0.1:9/v1/chat/completions', timeout=0.5), DIALOG, version='v1')
+    dialog_generator = DialogGenerator(DIALOG, fallback=generator)
+    vector_store = PatientIndex.build(1, DIALOG, HashingEncoder()).vector_store
+
+    assert list(dialog_generator.stream_response('肚子痛嗎？', vector_store, results=[])) == ['我不太明白您的意思，請換個方式提問。']
+
+
+def test_abandoned_stream_releases_slot_and_is_not_cached(stub):
+    """測試中途關閉串流時立即釋放並發名額與連線，未完成的回覆不寫入緩存"""
+    client = GenerativeClient(stub.url, max_concurrency=1)
+    dialog_generator = DialogGenerator(DIALOG, fallback=PatientReplyGenerator(client, DIALOG, version='v1'))
+    vector_store = PatientIndex.build(1, DIALOG, HashingEncoder()).vector_store
+
+    stream = dialog_generator.stream_response('肚子痛嗎？', vector_store, results=[])
+    assert next(stream) == '回'
+    stream.close()
+
+    assert client._semaphore.acquire(blocking=False)
+    client._semaphore.release()
+    assert ''.join(dialog_generator.stream_response('肚子痛嗎？', vector_store, results=[])) == '回答：肚子痛嗎？'
+    assert len(stub.requests) == 2
+
+
+def test_empty_streamed_reply_is_not_cached(stub):
+    """測試串流產生空白回覆時不寫入緩存，下次提問重新請求"""
+    client = GenerativeClient(stub.url)
+    client._stream_request = lambda messages: (chunk for chunk in [' '])
+
+    assert list(client.stream([{'role': 'user', 'content': '肚子痛嗎？'}], cache_key='k')) == [' ']
+    assert 'k' not in client._cache
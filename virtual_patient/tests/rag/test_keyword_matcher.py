@@ -0,0 +1,65 @@
+import json
+from pathlib import Path
+
+from rag.embeddings import HashingEncoder
+from rag.keyword_matcher import AhoCorasick, CaseKeywordMatcher
+from rag.rubric import RubricRegistry
+
+DATA_DIR = Path(__file__).resolve().parents[3]
+
+
+def brute_force(keywords, text):
+    return sorted(
+        (start, keyword)
+        for keyword in keywords
+        for start in range(len(text) - len(keyword) + 1)
+        if text.startswith(keyword, start)
+    )
+
+
+def test_finds_all_overlapping_occurrences():
+    """測試一次掃描找出所有（包括重疊的）關鍵詞"""
+    keywords = ['血絲', '有無血絲', '便', '大便', '幾次', '次']
+    automaton = AhoCorasick()
+    for keyword in keywords:
+        automaton.add(keyword, keyword)
+    automaton.build()
+    text = '大便幾次？有無血絲？便便呢'
+
+    found = sorted((start, keyword) for start, keyword, _ in automaton.find_all(text))
+
+    assert found == brute_force(keywords, text)
+
+
+def test_payloads_grouped_by_keyword():
+    """測試同一關鍵詞可對應多個負載"""
+    automaton = AhoCorasick()
+    automaton.add('量', 'a')
+    automaton.add('量', 'b')
+    automaton.build()
+
+    assert automaton.find_all('食量') == [(1, '量', ['a', 'b'])]
+
+
+def test_case_matcher_returns_criteria_and_dialog_items():
+    """測試案例自動機同時返回評分項目與對話項目"""
+    dialog = json.loads((DATA_DIR / 'dialog_rag_sample.json').read_text(encoding='utf-8'))
+    criteria = json.loads((DATA_DIR / 'scoring_criteria_rag.json').read_text(encoding='utf-8'))
+    rubric = RubricRegistry(HashingEncoder()).get(criteria)
+
+    matches = CaseKeywordMatcher(rubric, dialog).match('今天腹瀉幾次？有嘔吐嗎？')
+
+    assert 'cde24a1e-82d2-499c-9dad-7aa842ff4b97' in matches.dialog_items
+    assert 'e1c2d0b4-dd99-4c3a-b4d4-df751ac70a54' in matches.dialog_items
+    assert rubric.index_of['嘔吐'] in matches.criterion_indices
+
+
+def test_case_matcher_dialog_ids_match_dialog_items():
+    """測試數字 id 或沒有 id 的對話項目，匹配結果與 dialog_items 的 id 一致（字符串）"""
+    dialog = [
+        {'id': 3, '觸發語句': ['你幾歲？'], '標準回覆': '2歲', '關鍵詞': ['幾歲']},
+        {'觸發語句': ['有發燒嗎？'], '標準回覆': '有', '關鍵詞': ['發燒']},
+    ]
+    matcher = CaseKeywordMatcher(dialog_json=dialog)
+
+    assert matcher.match('你幾歲？有發燒嗎？').dialog_items == ['3', '1']
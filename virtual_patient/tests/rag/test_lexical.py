@@ -0,0 +1,99 @@
+import numpy as np
+
+from rag.embeddings import HashingEncoder
+from rag.lexical import BM25Index, char_bigrams, reciprocal_rank_fusion, unambiguous_match
+from rag.patient_index import PatientIndex
+
+DIALOG = [
+    {'id': 'a', 'question': '小朋友叫什麼名字？', 'answer': '王小明'},
+    {'id': 'b', 'question': '今天大便幾次？', 'answer': '到今天中午總共拉五次'},
+    {'id': 'c', 'question': '大便是什麼顏色？', 'answer': '黃色水水的'},
+    {'id': 'd', 'question': '有沒有發燒？', 'answer': '昨天晚上38.5度'},
+]
+
+
+class CountingEncoder(HashingEncoder):
+    """記錄查詢編碼次數（建索引時的批量編碼不計）"""
+
+    def __init__(self):
+        super().__init__()
+        self.queries = 0
+
+    def encode(self, texts):
+        if len(texts) == 1:
+            self.queries += 1
+        return super().encode(texts)
+
+
+def test_char_bigrams_ignore_punctuation_and_spaces():
+    """測試字符二元組去掉標點與空白"""
+    assert char_bigrams('有沒有 發燒？') == ['有沒', '沒有', '有發', '發燒']
+    assert char_bigrams('燒') == ['燒']
+
+
+def test_bm25_ranks_documents_by_shared_bigrams():
+    """測試 BM25 按共享的二元組排名，並返回查詢詞項覆蓋率"""
+    index = BM25Index([item['question'] for item in DIALOG])
+
+    scores, coverage = index.scores('大便是什麼顏色')
+
+    assert int(np.argmax(scores)) == 2
+    assert coverage[2] == 1.0
+    assert scores[3] == 0
+
+
+def test_unambiguous_match_requires_full_coverage_and_margin():
+    """測試只有完整覆蓋且明顯領先時才視為明確匹配"""
+    index = BM25Index([item['question'] for item in DIALOG])
+
+    assert unambiguous_match(*index.scores('有沒有發燒')) == 3
+    # 「大便」同時出現在兩個問題中，無法明確區分
+    assert unambiguous_match(*index.scores('大便')) is None
+    assert unambiguous_match(*index.scores('肚子痛不痛')) is None
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    """測試兩個排名都靠前的文檔融合後排第一"""
+    fused = reciprocal_rank_fusion([np.array([0, 1, 2]), np.array([1, 2])], 3)
+
+    assert int(np.argmax(fused)) == 1
+
+
+def test_lexical_match_skips_encoder():
+    """測試詞彙匹配明確時不調用編碼器，並記錄在統計中"""
+    encoder = CountingEncoder()
+    index = PatientIndex.build(1, DIALOG, encoder)
+
+    results = index.retrieve('有沒有發燒？')
+
+    assert results[0]['text'] == '有沒有發燒？'
+    assert results[0]['score'] == 1.0
+    assert results[0]['vector_score'] is None
+    assert encoder.queries == 0
+    assert index.retrieval_stats() == {'lookups': 1, 'lexical_only': 1, 'lexical_only_rate': 1.0}
+
+
+def test_ambiguous_query_fuses_vector_and_lexical_ranks():
+    """測試詞彙匹配不明確時編碼查詢並融合兩種排名"""
+    encoder = CountingEncoder()
+    index = PatientIndex.build(1, DIALOG, encoder)
+
+    results = index.retrieve('他大便幾次了', top_k=2)
+
+    assert results[0]['text'] == '今天大便幾次？'
+    assert results[0]['vector_score'] is not None
+    assert encoder.queries == 1
+    assert index.retrieval_stats()['lexical_only'] == 0
+
+
+def test_precomputed_query_vector_is_used():
+    """測試傳入已計算的查詢嵌入時直接融合，不再編碼"""
+    encoder = CountingEncoder()
+    index = PatientIndex.build(1, DIALOG, encoder)
+    query_vector = index.vector_store.embed(['小朋友叫什麼'])[0]
+    encoder.queries = 0
+
+    results = index.retrieve('小朋友叫什麼', query_vector=query_vector)
+
+    assert results[0]['text'] == '小朋友叫什麼名字？'
+    assert encoder.queries == 0
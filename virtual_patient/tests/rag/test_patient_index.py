@@ -0,0 +1,236 @@
+import threading
+
+import pytest
+
+from rag.dialog_generator import DialogGenerator
+from rag.embeddings import HashingEncoder
+from rag.keyword_matcher import CaseKeywordMatcher
+from rag.patient_index import PatientIndex, PatientIndexRegistry, dialog_content_hash
+
+DIALOG = [
+    {'question': '你幾歲？', 'answer': '2歲'},
+    {'question': '今天拉了幾次？', 'answer': '到今天中午總共拉五次'},
+]
+
+
+class CountingEncoder(HashingEncoder):
+    """記錄編碼次數的編碼器"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def encode(self, texts):
+        self.calls += 1
+        return super().encode(texts)
+
+
+def test_index_built_once_per_version():
+    """測試同一版本的病人索引只構建一次"""
+    encoder = CountingEncoder()
+    registry = PatientIndexRegistry(encoder)
+
+    first = registry.get(1, DIALOG)
+    second = registry.get(1, list(DIALOG))
+
+    assert first is second
+    assert encoder.calls == 1
+    assert first.version == dialog_content_hash(DIALOG)
+
+
+def test_index_rebuilt_when_dialog_changes():
+    """測試對話內容變更後產生新版本，舊索引保持可用"""
+    registry = PatientIndexRegistry(CountingEncoder())
+    old = registry.get(1, DIALOG)
+    new = registry.get(1, DIALOG + [{'question': '有吐嗎？', 'answer': '有'}])
+
+    assert old is not new
+    assert old.version != new.version
+    assert old.search('你幾歲？')[0]['text'] == '你幾歲？'
+
+
+def test_index_is_read_only():
+    """測試共享索引不可再被修改"""
+    index = PatientIndexRegistry(CountingEncoder()).get(1, DIALOG)
+    with pytest.raises(RuntimeError):
+        index.vector_store.add_collection('extra', ['你好'])
+
+
+def test_concurrent_requests_share_one_build():
+    """測試多個學生同時開始對話時只構建一次"""
+    encoder = CountingEncoder()
+    registry = PatientIndexRegistry(encoder)
+    results = []
+
+    threads = [threading.Thread(target=lambda: results.append(registry.get(7, DIALOG))) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert encoder.calls == 1
+    assert len({id(index) for index in results}) == 1
+
+
+GROUPED_DIALOG = [
+    {'id': 'name', '觸發語句': ['請問你叫什麼名字，幾歲？', '小朋友叫什麼名字？', '你幾歲？'], '標準回覆': '張小威2歲', '角色': '媽媽'},
+    {'id': 'stool', '觸發語句': ['總共腹瀉幾次？', '今天拉了幾次？', '今天大便幾次？'], '標準回覆': '到今天中午總共拉五次', '角色': '媽媽'},
+    {'id': 'fever', '觸發語句': ['有沒有發燒？', '體溫多少？'], '標準回覆': '昨天晚上38.5度', '角色': '媽媽'},
+]
+
+
+def test_every_trigger_phrase_is_a_row_pointing_to_its_item():
+    """測試每個觸發語句各佔一行並指向所屬項目"""
+    index = PatientIndexRegistry(CountingEncoder()).get(1, GROUPED_DIALOG)
+
+    assert len(index.texts) == 8
+    assert [index.items[item]['id'] for item in index.row_items] == ['name'] * 3 + ['stool'] * 3 + ['fever'] * 2
+
+
+def test_search_returns_distinct_items_by_max_pooling():
+    """測試檢索按項目取最大分數，同一項目的多個語句不重複返回"""
+    index = PatientIndexRegistry(CountingEncoder()).get(1, GROUPED_DIALOG)
+
+    results = index.search('今天拉了幾次', top_k=3)
+
+    assert [result['metadata']['item_id'] for result in results][0] == 'stool'
+    assert len({result['index'] for result in results}) == 3
+    assert results[0]['text'] == '今天拉了幾次？'
+    assert results[0]['answer'] == '到今天中午總共拉五次'
+
+
+def test_retrieve_matches_any_paraphrase():
+    """測試任一觸發語句命中都返回同一標準回覆"""
+    index = PatientIndexRegistry(CountingEncoder()).get(1, GROUPED_DIALOG)
+
+    for phrase in GROUPED_DIALOG[0]['觸發語句']:
+        assert index.retrieve(phrase, top_k=2)[0]['answer'] == '張小威2歲'
+
+
+def test_dialog_generator_answers_grouped_items():
+    """測試對話生成器按項目 id 取標準回覆，也支持順序回覆"""
+    index = PatientIndexRegistry(CountingEncoder()).get(1, GROUPED_DIALOG)
+    generator = DialogGenerator(GROUPED_DIALOG)
+
+    results = index.retrieve('體溫多少')
+    assert generator.get_response('體溫多少', index.vector_store, results=results) == '昨天晚上38.5度'
+    assert generator.get_response('你好') == '張小威2歲'
+
+
+def test_retrieve_ranks_dialog_keyword_hits():
+    """測試案例自動機命中的對話項目參與檢索排名，並否決不在命中之列的詞彙直返"""
+    dialog = [dict(item) for item in GROUPED_DIALOG]
+    dialog[2]['關鍵詞'] = ['熱']
+    encoder = CountingEncoder()
+    index = PatientIndexRegistry(encoder).get(1, dialog)
+    matcher = CaseKeywordMatcher(dialog_json=dialog)
+
+    query = '現在熱不熱？'
+    assert matcher.match(query).dialog_items == ['fever']
+    assert index.retrieve(query, keyword_items=matcher.match(query).dialog_items)[0]['answer'] == '昨天晚上38.5度'
+
+    calls = encoder.calls
+    assert index.retrieve('今天大便幾次？')[0]['answer'] == '到今天中午總共拉五次'
+    assert encoder.calls == calls
+    index.retrieve('今天大便幾次？', keyword_items=['fever'])
+    assert encoder.calls == calls + 1
+
+
+class PhraseCountingEncoder(HashingEncoder):
+    """記錄被編碼的語句"""
+
+    def __init__(self):
+        super().__init__()
+        self.phrases = []
+
+    def encode(self, texts):
+        self.phrases.extend(texts)
+        return super().encode(texts)
+
+
+def edited_dialog():
+    """修改一個觸發語句、刪除一個項目、新增一個項目"""
+    dialog = [dict(item) for item in GROUPED_DIALOG[:2]]
+    dialog[1]['觸發語句'] = ['總共腹瀉幾次？', '今天拉肚子幾次？', '今天大便幾次？']
+    dialog.append({'id': 'vomit', '觸發語句': ['有沒有吐？'], '標準回覆': '沒有吐', '角色': '媽媽'})
+    return dialog
+
+
+def test_update_only_encodes_changed_phrases():
+    """測試增量更新只編碼新增或改動的語句，舊版本索引保持不變"""
+    encoder = PhraseCountingEncoder()
+    old = PatientIndex.build(1, GROUPED_DIALOG, encoder)
+    encoder.phrases.clear()
+
+    new = old.update(edited_dialog(), compact_ratio=1.0)
+
+    assert encoder.phrases == ['今天拉肚子幾次？', '有沒有吐？']
+    assert new.encoded == 2
+    assert new.version != old.version
+    # 改動前的語句和刪除項目的語句成為墓碑，不再被檢索到
+    assert new.tombstones == 3
+    assert new.retrieve('體溫多少', top_k=3)[0]['answer'] != '昨天晚上38.5度'
+    assert new.retrieve('有沒有吐')[0]['answer'] == '沒有吐'
+    assert old.retrieve('體溫多少')[0]['answer'] == '昨天晚上38.5度'
+    assert old.tombstones == 0
+
+
+def test_update_compacts_when_tombstones_accumulate():
+    """測試墓碑比例超過閾值時壓縮矩陣，不重新編碼沿用的語句"""
+    encoder = PhraseCountingEncoder()
+    old = PatientIndex.build(1, GROUPED_DIALOG, encoder)
+    encoder.phrases.clear()
+
+    new = old.update(edited_dialog(), compact_ratio=0.1)
+
+    assert new.tombstones == 0
+    assert len(new.texts) == 7
+    assert encoder.phrases == ['今天拉肚子幾次？', '有沒有吐？']
+    assert new.search('今天拉肚子幾次')[0]['answer'] == '到今天中午總共拉五次'
+
+
+def test_registry_publishes_incremental_version():
+    """測試病人對話更新後，註冊表從舊版本增量構建並替換引用"""
+    encoder = PhraseCountingEncoder()
+    registry = PatientIndexRegistry(encoder)
+    old = registry.get(1, GROUPED_DIALOG)
+    encoder.phrases.clear()
+
+    new = registry.get(1, edited_dialog())
+
+    assert new is not old
+    assert registry.get(1, edited_dialog()) is new
+    assert len(encoder.phrases) == 2
+
+
+class GatedEncoder(HashingEncoder):
+    """打開閘門前阻塞查詢以外的編碼，模擬耗時的後台構建"""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def encode(self, texts):
+        if len(texts) > 1 or texts == ['有沒有吐？']:
+            assert self.gate.wait(5)
+        return super().encode(texts)
+
+
+def test_background_rebuild_swaps_without_blocking():
+    """測試病例更新後請求不等待重建：構建期間拿到舊版本，完成後新請求拿到新版本"""
+    encoder = GatedEncoder()
+    registry = PatientIndexRegistry(encoder, background=True)
+    old = registry.get(1, GROUPED_DIALOG)
+
+    encoder.gate.clear()
+    assert registry.get(1, edited_dialog()) is old
+    future = registry.refresh(1, edited_dialog())
+    assert not future.done()
+    encoder.gate.set()
+
+    new = future.result(timeout=5)
+    assert new.version == dialog_content_hash(edited_dialog())
+    assert registry.get(1, edited_dialog()) is new
+    # 持有舊版本的對話仍可檢索
+    assert old.retrieve('體溫多少')[0]['answer'] == '昨天晚上38.5度'
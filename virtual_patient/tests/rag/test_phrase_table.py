@@ -0,0 +1,111 @@
+import numpy as np
+
+from rag.dialog_items import dialog_items, flatten_dialog
+from rag.embeddings import HashingEncoder
+from rag.patient_index import PatientIndex, PatientIndexRegistry
+from rag.phrase_table import PhraseTable, phrase_id
+
+CASE_A = [
+    {'id': 'age', '觸發語句': ['你幾歲？', '小朋友幾歲？'], '標準回覆': '2歲', '角色': '媽媽', '情境分類': '病人辨識'},
+    {'id': 'onset', '觸發語句': ['什麼時候開始不舒服？'], '標準回覆': '昨天晚上開始腹瀉發燒'},
+]
+
+CASE_B = [
+    {'id': 'age', '觸發語句': ['你幾歲？ ', '請問幾歲？'], '標準回覆': '65歲'},
+    {'id': 'onset', '觸發語句': ['什麼時候開始不舒服？'], '標準回覆': '上週開始胸悶'},
+]
+
+
+class CountingEncoder(HashingEncoder):
+    def __init__(self):
+        super().__init__()
+        self.encoded = []
+
+    def encode(self, texts):
+        self.encoded.extend(texts)
+        return super().encode(texts)
+
+
+def test_flatten_dialog_derives_records_from_grouped_format():
+    """測試分組格式展開為每個觸發語句一條記錄，且展開後的項目與原來的語句一一對應"""
+    records = flatten_dialog(CASE_A)
+
+    assert [record['嵌入內容'] for record in records] == ['你幾歲？', '小朋友幾歲？', '什麼時候開始不舒服？']
+    assert records[0] == {
+        'id': 'age:0', '分類': '病人辨識', '嵌入內容': '你幾歲？', '標準回覆': '2歲', '角色': '媽媽',
+        '項目id': 'age', '語句id': phrase_id('你幾歲？'),
+    }
+    assert [item['triggers'] for item in dialog_items(records)] == [[phrase] for phrase in ('你幾歲？', '小朋友幾歲？', '什麼時候開始不舒服？')]
+
+
+def test_phrase_table_encodes_each_normalized_phrase_once():
+    """測試跨病例重複（標準化後相同）的語句只編碼、只存一次"""
+    encoder = CountingEncoder()
+    table = PhraseTable(encoder, capacity=2)
+
+    rows_a, encoded_a = table.rows(['你幾歲？', '小朋友幾歲？', '什麼時候開始不舒服？'])
+    rows_b, encoded_b = table.rows(['你幾歲？ ', '請問幾歲？', '什麼時候開始不舒服？'])
+
+    assert (encoded_a, encoded_b) == (3, 1)
+    assert len(encoder.encoded) == 4
+    assert rows_b[0] == rows_a[0] and rows_b[2] == rows_a[2]
+    assert len(table) == 4
+    assert not table.embeddings.flags.writeable
+    assert table.stats()['dedup_ratio'] == 1 - 4 / 6
+
+
+def test_indexes_share_phrase_table(tmp_path):
+    """測試共享語句表的病例索引檢索結果與獨立索引一致，且表可寫入文件後重新載入"""
+    table = PhraseTable(HashingEncoder())
+    shared_a = PatientIndex.build(1, CASE_A, phrase_table=table)
+    shared_b = PatientIndex.build(2, CASE_B, phrase_table=table)
+    own_b = PatientIndex.build(2, CASE_B, HashingEncoder())
+
+    assert shared_b.encoded == 1
+    assert np.allclose(shared_b.embeddings, own_b.embeddings, atol=1e-6)
+    query = own_b.vector_store.embed(['你今年幾歲'])[0]
+    assert np.allclose(shared_b.row_scores(query), own_b.row_scores(query), atol=1e-6)
+    assert shared_a.search('你今年幾歲')[0]['answer'] == '2歲'
+    assert shared_b.search('你今年幾歲')[0]['answer'] == '65歲'
+    assert shared_b.retrieve('什麼時候開始不舒服')[0]['answer'] == own_b.retrieve('什麼時候開始不舒服')[0]['answer']
+
+    encoder = CountingEncoder()
+    loaded = PhraseTable.load(table.save(tmp_path / 'phrases.vpemb'), encoder)
+    index = PatientIndex.build(1, CASE_A, phrase_table=loaded)
+    assert index.encoded == 0 and encoder.encoded == []
+    assert index.search('你今年幾歲')[0]['answer'] == '2歲'
+
+
+def held_matrix_bytes(index):
+    """索引自身持有的矩陣字節數（與共享語句表同一塊內存的不計）"""
+    table = index.phrase_table.embeddings
+    return sum(
+        value.nbytes for value in vars(index).values()
+        if isinstance(value, np.ndarray) and value.ndim == 2 and not np.shares_memory(value, table)
+    )
+
+
+def test_searched_cases_do_not_hold_phrase_matrices():
+    """測試共享語句的病例被檢索後不各自保留一份語句矩陣"""
+    table = PhraseTable(HashingEncoder())
+    indexes = [PatientIndex.build(1, CASE_A, phrase_table=table), PatientIndex.build(2, CASE_B, phrase_table=table)]
+
+    for index in indexes:
+        index.retrieve('什麼時候開始不舒服', query_vector=table.vector_store.embed(['什麼時候開始不舒服'])[0])
+        index.search('你今年幾歲')
+
+    assert [held_matrix_bytes(index) for index in indexes] == [0, 0]
+
+
+def test_registry_updates_index_through_phrase_table():
+    """測試病例更新時只編碼語句表中沒有的新語句"""
+    encoder = CountingEncoder()
+    registry = PatientIndexRegistry(phrase_table=PhraseTable(encoder))
+    registry.get(1, CASE_A)
+    encoder.encoded.clear()
+
+    updated = CASE_A + [{'id': 'stool', '觸發語句': ['你幾歲？', '今天拉了幾次？'], '標準回覆': '五次'}]
+    index = registry.get(1, updated)
+
+    assert encoder.encoded == ['今天拉了幾次？']
+    assert index.search('今天拉幾次')[0]['answer'] == '五次'
@@ -0,0 +1,104 @@
+import numpy as np
+
+from rag.embeddings import HashingEncoder
+from rag.rubric import RubricRegistry
+from rag.scoring import ScoreEngine
+
+CRITERIA = [
+    {'id': '詢問病人姓名', '分類': '病人辨識', '項目': '詢問病人姓名', '語義提示': '請問小朋友叫什麼名字？', '關鍵詞': ['名字'], '配分': 2},
+    {'id': '大便情況', '分類': '病人情況', '項目': '大便情況', '語義提示': '請問大便的次數、性狀？', '關鍵詞': ['大便', '次數'], '配分': 10},
+    {'id': '嘔吐情況', '分類': '病人情況', '項目': '嘔吐情況', '語義提示': '請問嘔吐的情況？', '關鍵詞': ['嘔吐'], '配分': 10},
+]
+
+
+class CountingEncoder(HashingEncoder):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def encode(self, texts):
+        self.calls += 1
+        return super().encode(texts)
+
+
+def test_rubric_compiled_once_per_version():
+    """測試相同內容的評分標準只編譯一次並被共享"""
+    encoder = CountingEncoder()
+    registry = RubricRegistry(encoder)
+
+    first = registry.get(CRITERIA)
+    second = registry.get([dict(item) for item in CRITERIA])
+
+    assert first is second
+    assert encoder.calls == 1
+    assert first.max_score == 22
+    assert first.categories == ['病人辨識', '病人情況']
+
+
+def test_conversation_state_is_score_vector():
+    """測試每個對話只保存得分向量，且同一項目不重複計分"""
+    rubric = RubricRegistry(HashingEncoder()).get(CRITERIA)
+    engine = ScoreEngine(rubric)
+
+    assert engine.score_response('小朋友叫什麼名字？')['score'] == 2
+    assert engine.score_response('他的名字是？')['score'] == 0
+    assert engine.score_response('有沒有嘔吐？')['matched_criteria'] == '嘔吐情況'
+    assert engine.scores.tolist() == [2, 0, 10]
+    assert rubric.category_totals(engine.scores) == {'病人辨識': 2, '病人情況': 10}
+
+
+def test_state_round_trip_between_engines():
+    """測試兩個共享評分標準的對話狀態互不干擾，且可序列化恢復"""
+    rubric = RubricRegistry(HashingEncoder()).get(CRITERIA)
+    first = ScoreEngine(rubric)
+    second = ScoreEngine(rubric)
+    first.score_response('大便幾次？')
+
+    restored = ScoreEngine(rubric)
+    restored.set_state(first.get_state())
+
+    assert second.total_score == 0
+    assert restored.covered == {'大便情況'}
+    assert np.array_equal(restored.scores, first.scores)
+
+
+def test_one_utterance_credits_several_criteria():
+    """測試一句話同時命中多個評分項目及其細項"""
+    criteria = CRITERIA + [
+        {'id': '食慾', '分類': '病人情況', '項目': '食慾', '語義提示': '請問與「食慾（減少、吃什麼、量）」有關的情況？', '關鍵詞': ['食慾'], '配分': 6},
+    ]
+    engine = ScoreEngine(RubricRegistry(HashingEncoder()).get(criteria))
+
+    result = engine.score_response('請問名字？最近食慾減少嗎，都吃什麼？')
+
+    assert {hit['id'] for hit in result['hits']} == {'詢問病人姓名', '食慾'}
+    assert result['score'] == 8
+    appetite = next(hit for hit in result['hits'] if hit['id'] == '食慾')
+    assert appetite['sub_items'] == ['減少', '吃什麼']
+    assert engine.covered_sub_items(3) == ['減少', '吃什麼']
+
+
+def test_replay_restores_hits_and_sub_items():
+    """測試根據保存的命中記錄恢復得分與細項"""
+    rubric = RubricRegistry(HashingEncoder()).get(CRITERIA)
+    engine = ScoreEngine(rubric)
+    result = engine.score_response('請問嘔吐和名字')
+
+    restored = ScoreEngine(rubric)
+    restored.replay([{'id': hit['id'], 'sub_items': hit['sub_items']} for hit in result['hits']])
+
+    assert restored.scores.tolist() == engine.scores.tolist()
+
+
+def test_keyword_inside_unrelated_word_is_not_credited():
+    """測試單字細項（「量」）出現在無關提問（「測量」）中、相似度又很低時不計分"""
+    criteria = CRITERIA + [
+        {'id': '食慾', '分類': '病人情況', '項目': '食慾', '語義提示': '請問與「食慾（減少、吃什麼、量）」有關的情況？', '關鍵詞': ['食慾'], '配分': 6},
+    ]
+    engine = ScoreEngine(RubricRegistry(HashingEncoder()).get(criteria))
+
+    result = engine.score_response('測量一下體溫')
+
+    assert result['score'] == 0
+    assert result['hits'] == []
+    assert engine.score_response('吃飯的量有變少嗎')['hits'][0]['sub_items'] == ['量']
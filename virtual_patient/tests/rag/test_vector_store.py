@@ -0,0 +1,150 @@
+import numpy as np
+
+from rag.embeddings import HashingEncoder
+from rag.vector_store import HNSWIndex, VectorStore, normalize_rows, top_k_indices
+
+QUESTIONS = ['請問你叫什麼名字，幾歲？', '小朋友叫什麼名字？', '總共腹瀉幾次？', '今天拉了幾次？', '請問有嘔吐嗎？']
+
+
+def make_store():
+    store = VectorStore(HashingEncoder())
+    store.add_collection('dialog_questions', QUESTIONS)
+    return store
+
+
+def test_collection_is_contiguous_normalized_matrix():
+    """測試集合保存為連續且已正規化的 float32 矩陣"""
+    matrix = make_store().collections['dialog_questions']['embeddings']
+
+    assert matrix.dtype == np.float32
+    assert matrix.flags['C_CONTIGUOUS']
+    assert np.allclose(np.linalg.norm(matrix, axis=1), 1.0, atol=1e-5)
+
+
+def test_search_returns_best_match_first():
+    """測試搜索結果按相似度由高到低排列"""
+    results = make_store().search('dialog_questions', '今天拉了幾次', top_k=3)
+
+    assert results[0]['text'] == '今天拉了幾次？'
+    assert [r['score'] for r in results] == sorted((r['score'] for r in results), reverse=True)
+
+
+def test_search_many_matches_single_search():
+    """測試批量搜索與逐條搜索結果一致"""
+    store = make_store()
+    queries = ['你幾歲', '有吐嗎']
+
+    batched = store.search_many('dialog_questions', queries, top_k=2)
+
+    assert [[r['index'] for r in results] for results in batched] == [
+        [r['index'] for r in store.search('dialog_questions', query, top_k=2)] for query in queries
+    ]
+
+
+def test_top_k_larger_than_collection_and_unknown_collection():
+    """測試 top_k 超過集合大小及集合不存在的情況"""
+    store = make_store()
+
+    assert len(store.search('dialog_questions', '名字', top_k=50)) == len(QUESTIONS)
+    assert store.search('missing', '名字') == []
+    assert store.search_many('missing', ['名字']) == [[]]
+
+
+def test_top_k_indices_matches_full_sort():
+    """測試 argpartition 選取結果與完整排序一致"""
+    scores = np.random.default_rng(0).random(1000).astype(np.float32)
+
+    assert list(top_k_indices(scores, 10)) == list(np.argsort(-scores)[:10])
+
+
+def random_unit_vectors(rows, dim, seed):
+    return normalize_rows(np.random.default_rng(seed).standard_normal((rows, dim)))
+
+
+def recall_at_k(index, data, queries, top_k, ef):
+    hits = 0
+    for query in queries:
+        exact = set(top_k_indices(data @ query, top_k).tolist())
+        hits += len(exact & set(index.search(query, top_k, ef=ef)[1].tolist()))
+    return hits / (len(queries) * top_k)
+
+
+def test_hnsw_recall_against_exact_search():
+    """測試 HNSW 近似搜索的 recall@10 接近精確搜索"""
+    data = random_unit_vectors(1000, 32, seed=1)
+    queries = random_unit_vectors(50, 32, seed=2)
+    index = HNSWIndex(32, M=12, ef_construction=64)
+    index.add(data)
+
+    assert recall_at_k(index, data, queries, 10, ef=100) >= 0.9
+
+
+def test_hnsw_builds_incrementally_and_round_trips(tmp_path):
+    """測試 HNSW 索引可分批建圖、持久化後載入並繼續加入"""
+    data = random_unit_vectors(600, 16, seed=3)
+    index = HNSWIndex(16, M=8, ef_construction=64)
+    index.add(data[:300])
+    assert list(index.add(data[300:500])) == list(range(300, 500))
+
+    path = index.save(tmp_path / 'ann.npz')
+    loaded = HNSWIndex.load(path)
+    query = data[42]
+    assert np.array_equal(loaded.search(query, 5)[1], index.search(query, 5)[1])
+
+    loaded.add(data[500:])
+    assert len(loaded) == 600
+    assert loaded.search(data[550], 1)[1][0] == 550
+
+
+def test_vector_store_uses_ann_index(tmp_path):
+    """測試集合建立 HNSW 索引後 search_vector 走近似搜索，並可從文件載入"""
+    store = make_store()
+    store.build_ann('dialog_questions', M=4, path=tmp_path / 'dialog.npz')
+    results = store.search('dialog_questions', '今天拉了幾次', top_k=2)
+    assert results[0]['text'] == '今天拉了幾次？'
+
+    reloaded = make_store()
+    index = reloaded.build_ann('dialog_questions', path=tmp_path / 'dialog.npz')
+    assert index.M == 4
+
+
+def test_persisted_ann_index_rebuilds_when_rows_or_model_change(tmp_path):
+    """測試行數相同但內容或模型不同時不沿用持久化的索引"""
+    path = tmp_path / 'dialog.npz'
+    make_store().build_ann('dialog_questions', M=4, path=path)
+
+    changed = VectorStore(HashingEncoder())
+    changed.add_collection('dialog_questions', list(reversed(QUESTIONS)))
+    index = changed.build_ann('dialog_questions', path=path)
+    assert index.M == 16
+    assert changed.search('dialog_questions', '今天拉了幾次', top_k=1)[0]['text'] == '今天拉了幾次？'
+
+    other_model = VectorStore(HashingEncoder(dim=256))
+    other_model.add_collection('dialog_questions', QUESTIONS)
+    index = other_model.build_ann('dialog_questions', M=4, path=path)
+    assert index.model_id == other_model.encoder.model_id
+    assert HNSWIndex.load(path).dim == 256
+
+
+def test_persisted_ann_index_extends_with_appended_rows(tmp_path):
+    """測試集合只在末尾追加行時載入舊索引並只續建新行"""
+    path = tmp_path / 'dialog.npz'
+    make_store().build_ann('dialog_questions', M=4, path=path)
+
+    grown = VectorStore(HashingEncoder())
+    grown.add_collection('dialog_questions', QUESTIONS + ['肚子會痛嗎？'])
+    index = grown.build_ann('dialog_questions', path=path)
+    assert index.M == 4 and len(index) == len(QUESTIONS) + 1
+    assert grown.search('dialog_questions', '肚子痛嗎', top_k=1)[0]['text'] == '肚子會痛嗎？'
+    assert len(HNSWIndex.load(path)) == len(QUESTIONS) + 1
+
+
+def test_hnsw_batches_share_neighbors_within_batch():
+    """測試同一批插入的節點之間互相連接：小批次與整批插入都能找回每個節點自身"""
+    data = random_unit_vectors(300, 16, seed=4)
+    for batch_size in (1, 32, 300):
+        index = HNSWIndex(16, M=6, ef_construction=32, batch_size=batch_size)
+        index.add(data)
+        found = [index.search(vector, 1, ef=32)[1][0] for vector in data[::10]]
+        assert found == list(range(0, 300, 10))
+        assert (index.degrees[0][:len(index)] > 0).all()
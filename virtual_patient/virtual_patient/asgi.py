@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'virtual_patient.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# get_asgi_application() 完成 Django 初始化後才能導入應用代碼
+from conversations.websocket import conversation_websocket  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """HTTP 請求交給 Django，WebSocket 連線交給對話通道"""
+    if scope['type'] == 'websocket':
+        await conversation_websocket(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)